@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Ticket actions on many tickets at once, like "resolve 101-120,135", for
+# triage. Updates run concurrently, up to a limit, and each ticket's result
+# or error is kept for one summary.
+
+log = logging.getLogger(__name__)
+
+BULK_WORKERS = int(os.getenv('BULK_WORKERS', 8)) # concurrent updates
+MAX_TICKETS = 100 # tickets in one bulk action
+
+IDS_RE = re.compile(r"[\s,]+")
+RANGE_RE = re.compile(r"^#?(\d+)(?:-#?(\d+))?$")
+
+
+def parse_ids(text:str, max_tickets:int=MAX_TICKETS) -> list:
+    """ticket ids from a list like "12, 15 20-25 #30", in order, without duplicates"""
+    ids = []
+    for part in IDS_RE.split(text.strip()):
+        if not part:
+            continue
+        match = RANGE_RE.match(part)
+        if match is None:
+            raise ValueError(f"not a ticket number or range: {part}")
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        if last < first:
+            raise ValueError(f"backwards range: {part}")
+        if last - first >= max_tickets:
+            raise ValueError(f"too many tickets: {part}, at most {max_tickets}")
+        for ticket_id in range(first, last + 1):
+            if ticket_id not in ids:
+                ids.append(ticket_id)
+    if not ids:
+        raise ValueError("no ticket numbers")
+    if len(ids) > max_tickets:
+        raise ValueError(f"too many tickets: {len(ids)}, at most {max_tickets}")
+    return ids
+
+
+class Result():
+    """The outcome of an action on one ticket"""
+    def __init__(self, ticket_id:int, ticket=None, error:str=None):
+        self.ticket_id = ticket_id
+        self.ticket = ticket # as updated
+        self.error = error
+
+    def ok(self) -> bool:
+        return self.ticket is not None
+
+
+def run_bulk(action, ticket_ids:list, workers:int=BULK_WORKERS) -> list:
+    """run action(ticket_id) for each ticket, concurrently. the action
+    returns the updated ticket. returns a Result for each ticket, in order."""
+    def run(ticket_id:int) -> Result:
+        try:
+            ticket = action(ticket_id)
+            if ticket is None:
+                return Result(ticket_id, error="not updated")
+            return Result(ticket_id, ticket)
+        except Exception as e:
+            log.warning(f"bulk action on {ticket_id} failed: {e}")
+            return Result(ticket_id, error=str(e))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(ticket_ids)))) as executor:
+        return list(executor.map(run, ticket_ids))
+
+
+def summarize(verb:str, results:list) -> str:
+    """one line for the tickets done, and one for each failure"""
+    done = sum(1 for result in results if result.ok())
+    lines = [f"{verb} {done} of {len(results)} tickets"]
+    for result in results:
+        if not result.ok():
+            lines.append(f"#{result.ticket_id} failed: {result.error}")
+    return "\n".join(lines)
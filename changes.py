@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import logging
+import datetime as dt
+
+import store
+
+# A feed of ticket changes: one query per poll, for the tickets updated since
+# the cursor, compared against their last known state to find what changed.
+# Notes are found in the journals of the changed tickets, fetched one by one,
+# only when a subscriber asks for them.
+
+log = logging.getLogger(__name__)
+
+CURSOR = "tickets" # name of the change feed cursor
+
+CREATED = "created"
+STATUS = "status"
+ASSIGNED = "assigned"
+NOTE = "note" # a note added
+UPDATED = "updated" # any other change
+
+
+class Event():
+    """A change to a ticket. For status and assigned, old and new are names.
+    For a note, journal is the journal with it."""
+    def __init__(self, kind:str, ticket, old:str=None, new:str=None, journal=None):
+        self.kind = kind
+        self.ticket = ticket
+        self.old = old
+        self.new = new
+        self.journal = journal
+
+    def __str__(self):
+        if self.kind in (STATUS, ASSIGNED):
+            return f"#{self.ticket.id} {self.kind}: {self.old} -> {self.new}"
+        if self.kind == NOTE:
+            return f"#{self.ticket.id} {self.kind} by {self.journal.user.name}"
+        return f"#{self.ticket.id} {self.kind}"
+
+
+def ticket_state(ticket):
+    assigned = getattr(ticket, 'assigned_to', None)
+    return (ticket.updated_on, ticket.status.name, assigned.name if assigned else None)
+
+
+class ChangeFeed():
+    """Polls redmine for changed tickets, and passes events to the subscribers"""
+    def __init__(self, redmine, states:store.TicketStates=None):
+        self.redmine = redmine
+        self.states = states or store.TicketStates()
+        self.subscribers = []
+        self.want_notes = False
+
+    def subscribe(self, callback, notes:bool=False):
+        """with notes=True, the journals of each changed ticket are fetched, for NOTE events"""
+        self.subscribers.append(callback)
+        self.want_notes = self.want_notes or notes
+
+    def poll(self) -> list:
+        """the events since the last poll, oldest first"""
+        cursor = self.states.cursor(CURSOR)
+        if cursor is None:
+            # first run: start from now, rather than replaying all of history
+            now = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+            self.states.set_cursor(CURSOR, now)
+            log.info(f"starting change feed at {now}")
+            return []
+
+        # the cursor is inclusive: tickets updated in the same second as the
+        # last poll come back again, and are skipped as their state is unchanged.
+        since = cursor
+        tickets = self.redmine.tickets_updated_since(since)
+        known = self.states.states(ticket.id for ticket in tickets)
+
+        events = []
+        updated = []
+        for ticket in tickets:
+            state = ticket_state(ticket)
+            last = known.get(ticket.id)
+            if last and last[0] == state[0]:
+                continue # already seen
+            updated.append((ticket.id, *state))
+            cursor = max(cursor, ticket.updated_on)
+
+            if last is None and ticket.created_on >= since:
+                events.append(Event(CREATED, ticket))
+                continue
+            found = []
+            if last:
+                if last[1] != state[1]:
+                    found.append(Event(STATUS, ticket, last[1], state[1]))
+                if last[2] != state[2]:
+                    found.append(Event(ASSIGNED, ticket, last[2], state[2]))
+            if self.want_notes:
+                # a ticket not seen before has changed for the first time since the
+                # feed started: its notes since the cursor are new
+                found += self.notes(ticket, last[0] if last else since)
+            events += found or [Event(UPDATED, ticket)]
+
+        if updated:
+            self.states.update(updated, CURSOR, cursor)
+        return events
+
+    def notes(self, ticket, since:str) -> list:
+        """events for the notes added to the ticket after since"""
+        journaled = self.redmine.get_ticket(ticket.id, include_journals=True)
+        if journaled is None:
+            return []
+        return [Event(NOTE, ticket, journal=journal) for journal in getattr(journaled, 'journals', [])
+                if journal.notes and journal.created_on > since]
+
+    def synchronize(self):
+        events = self.poll()
+        for event in events:
+            log.info(f"ticket change: {event}")
+            for callback in self.subscribers:
+                try:
+                    callback(event)
+                except Exception:
+                    log.exception(f"change feed subscriber failed on: {event}")
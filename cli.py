@@ -9,11 +9,14 @@ import random
 import time
 
 import hashlib
+import functools
 import click
 
 from dotenv import load_dotenv
 
 import redmine
+import formatter
+import bulk
 
 ### reimplementing  "tickets" command using click.  https://pypi.org/project/click/
 
@@ -64,10 +67,7 @@ def print_tickets(tickets, fields=["link","status","priority","age","assigned","
         #table.add_column("Date", style="dim", width=12)
         table.add_column(field)
 
-    for ticket in tickets:
-        row = []
-        for field in fields:
-            row.append(get_formatted_field(ticket, field))
+    for row in formatter.RowFormatter(fields, redmine_client.url, RICH_CELLS).rows(tickets):
         table.add_row(*row)
 
     console.print(table)
@@ -88,10 +88,7 @@ def print_tickets_md(tickets, fields=["link","status","priority","age","assigned
         #table.add_column("Date", style="dim", width=12)
         table.add_column(field)
 
-    for ticket in tickets:
-        row = []
-        for field in fields:
-            row.append(redmine_client.get_field(ticket, field))
+    for row in formatter.compile_fields(tuple(fields), redmine_client.url).rows(tickets):
         table.add_row(*row)
 
     console.print(table)
@@ -112,13 +109,12 @@ def print_team(team):
     console.print(table)
 
 
-def print_teams(teams):
+def print_teams(teams:dict):
     if not teams:
         print("no teams found")
     else:
-        for teamname in teams:
-            team = redmine_client.get_team(teamname)
-            print_team(team)
+        for teamname in sorted(teams):
+            print_team(teams[teamname])
 
 
 color_map = {
@@ -139,6 +135,7 @@ color_map = {
 def lookup_color(term:str):
     return color_map.get(term, None)
 
+@functools.lru_cache(maxsize=1024)
 def hash_color(value):
     # consistently-hash the value into a color
     # hash_val = hash(value) <-- this does it inconsistantly (for security reasons)
@@ -148,48 +145,34 @@ def hash_color(value):
     b = hash_val & 0x0000FF;
     return f"rgb({r},{g},{b})"
 
-def get_formatted_field(ticket, field):
-    value = redmine_client.get_field(ticket, field)
-
-    match field:
-        case "link":
-            url = redmine_client.get_field(ticket, "url")
-            return f"[link={url}]{ticket.id}[/link]"
-        case "subject":
-            url = redmine_client.get_field(ticket, "url")
-            return f"[link={url}]{value}[/link]"
-        case "url":
-            url = redmine_client.get_field(ticket, "url")
-            return f"[link={url}]{value}[/link]"
-        case "priority":
-            color = lookup_color(value)
-            return f"[{color}]{value}[/{color}]"
-        case "age":
-            updated = dt.datetime.fromisoformat(ticket.updated_on)
-            age = dt.datetime.now(dt.timezone.utc) - updated
-
-            color = None
-            if age.days == 0:
-                color = "green"
-            elif age.days > 0 and age.days <= 2:
-                pass # no color
-            elif age.days > 2 and age.days <= 7:
-                color = "bright_yellow"
-            elif age.days > 7 and age.days <= 15:
-                color = "dark_orange"
-            else:
-                color = "red"
-            if color:
-                return f"[{color}]{value}[/{color}]"
-            else:
-                return value
-        case "status":
-            color = lookup_color(value)
-            return f"[{color}]{value}[/{color}]"
-        case "assigned":
-            color = hash_color(value)
-            return f"[{color}]{value}[/{color}]"
-    return value
+def colored(value, color):
+    if color:
+        return f"[{color}]{value}[/{color}]"
+    else:
+        return value
+
+def age_color(age:dt.timedelta):
+    if age.days == 0:
+        return "green"
+    elif age.days > 0 and age.days <= 2:
+        return None # no color
+    elif age.days > 2 and age.days <= 7:
+        return "bright_yellow"
+    elif age.days > 7 and age.days <= 15:
+        return "dark_orange"
+    else:
+        return "red"
+
+# rich markup for the fields, on top of the plain formatter
+RICH_CELLS = dict(formatter.CELLS,
+    link=lambda ticket, batch: f"[link={batch.url}/issues/{ticket.id}]{ticket.id}[/link]",
+    subject=lambda ticket, batch: f"[link={batch.url}/issues/{ticket.id}]{ticket.subject}[/link]",
+    url=lambda ticket, batch: f"[link={batch.url}/issues/{ticket.id}]{batch.url}/issues/{ticket.id}[/link]",
+    priority=lambda ticket, batch: colored(ticket.priority.name, lookup_color(ticket.priority.name)),
+    status=lambda ticket, batch: colored(ticket.status.name, lookup_color(ticket.status.name)),
+    assigned=lambda ticket, batch: colored(ticket.assigned_to.name, hash_color(ticket.assigned_to.name)),
+    age=lambda ticket, batch: colored(batch.natural_age(ticket.updated_on), age_color(batch.age(ticket.updated_on))),
+)
 
 def print_ticket(ticket):
     # print details for a single ticket
@@ -299,47 +282,58 @@ def tickets(query):
         print_tickets(redmine_client.my_tickets())
         
                
+def bulk_action(verb:str, ids, action, workers:int):
+    # ids are ticket numbers, lists or ranges: 12 15,16 20-25
+    try:
+        ticket_ids = bulk.parse_ids(" ".join(ids))
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+    results = bulk.run_bulk(action, ticket_ids, workers)
+    if len(results) == 1 and results[0].ok():
+        print_ticket(results[0].ticket)
+    else:
+        print(bulk.summarize(verb, results))
+        print_tickets([result.ticket for result in results if result.ok()])
+
+
 @cli.command()
-@click.argument("id", type=int) 
-def resolve(id:int):   
-    """Reslove ticket""" 
-    # case "resolve":
-    redmine_client.resolve_ticket(id)
-    print_ticket(redmine_client.get_ticket(id))
+@click.argument("ids", nargs=-1, required=True)
+@click.option("--workers", default=bulk.BULK_WORKERS, help="Tickets updated at the same time")
+def resolve(ids, workers:int):
+    """Reslove tickets"""
+    bulk_action("resolved", ids, redmine_client.resolve_ticket, workers)
    
                 
 @cli.command()
-@click.argument("id", type=int)      
-def progress(id:int):  
-    """Mark ticket in-progress"""     
-    #case "progress":
-    redmine_client.progress_ticket(id)
-    print_ticket(redmine_client.get_ticket(id))
+@click.argument("ids", nargs=-1, required=True)
+@click.option("--workers", default=bulk.BULK_WORKERS, help="Tickets updated at the same time")
+def progress(ids, workers:int):
+    """Mark tickets in-progress"""
+    bulk_action("in progress", ids, redmine_client.progress_ticket, workers)
       
         
 @cli.command()
-@click.argument("id", type=int)    
+@click.argument("ids", nargs=-1, required=True)
 @click.argument("asignee", type=str)    
-def assign(id:int, asignee:str):
-    """Assign ticket to user"""
-    # case assign
-    redmine_client.assign_ticket(id, asignee)
-    print_ticket(redmine_client.get_ticket(id))
+@click.option("--workers", default=bulk.BULK_WORKERS, help="Tickets updated at the same time")
+def assign(ids, asignee:str, workers:int):
+    """Assign tickets to user"""
+    bulk_action("assigned", ids, lambda id: redmine_client.assign_ticket(id, asignee), workers)
     
 
 @cli.command()
-@click.argument("id", type=int) 
-def unassign(id:int):
-    """Unassign ticket"""
-    # case "unassign":
-    redmine_client.unassign_ticket(id)
-    print_ticket(redmine_client.get_ticket(id))
+@click.argument("ids", nargs=-1, required=True)
+@click.option("--workers", default=bulk.BULK_WORKERS, help="Tickets updated at the same time")
+def unassign(ids, workers:int):
+    """Unassign tickets"""
+    bulk_action("unassigned", ids, redmine_client.unassign_ticket, workers)
 
 
 @cli.command()
 def teams():
     """List teams"""
-    print_teams(redmine_client.get_teams())
+    print_teams(redmine_client.get_all_teams())
 
 
 @cli.command()
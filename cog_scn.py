@@ -7,6 +7,8 @@ import datetime as dt
 
 import discord
 import redmine
+from responder import Responder
+from pager import PageView
 
 from discord.commands import option
 from discord.commands import SlashCommandGroup
@@ -30,6 +32,15 @@ def setup(bot):
     bot.add_cog(SCNCog(bot))
     log.info(f"initialized SCN cog")
 
+
+# autocomplete, from the in-memory indexes: never waits on redmine
+def autocomplete_teams(ctx: discord.AutocompleteContext):
+    return ctx.bot.redmine.team_index.search(ctx.value)
+
+def autocomplete_logins(ctx: discord.AutocompleteContext):
+    return ctx.bot.redmine.login_index.search(ctx.value)
+
+
 class SCNCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
@@ -40,6 +51,7 @@ class SCNCog(commands.Cog):
     scn = SlashCommandGroup("scn",  "SCN admin commands")
 
     @scn.command()
+    @option("redmine_login", description="Redmine login to pair with", autocomplete=autocomplete_logins)
     async def add(self, ctx:discord.ApplicationContext, redmine_login:str, member:discord.Member=None):
         """add Discord user information to redmine"""
         discord_name = ctx.user.name # by default, assume current user
@@ -60,15 +72,17 @@ class SCNCog(commands.Cog):
     async def sync(self, ctx:discord.ApplicationContext):
         """syncronize an existing ticket thread with redmine"""
         if isinstance(ctx.channel, discord.Thread):
-            # get the ticket id from the thread name
-            # FIXME: notice the series of calls to "self.bot": could be better encapsulated
-            ticket_id = self.bot.parse_thread_title(ctx.channel.name)
-            ticket = self.redmine.get_ticket(ticket_id, include_journals=True)
-            if ticket:
-                await self.bot.synchronize_ticket(ticket, ctx.channel, ctx)
-                await ctx.respond(f"SYNC ticket {ticket.id} to thread id: {ctx.channel.id} complete")
-            else:
-                await ctx.respond(f"cant find ticket# in thread name: {ctx.channel.name}") # error
+            async with Responder(ctx) as responder:
+                # get the ticket id from the routes, or the thread name for threads not routed yet
+                # FIXME: notice the series of calls to "self.bot": could be better encapsulated
+                ticket_id = self.bot.thread_tickets.get(ctx.channel.id) or self.bot.parse_thread_title(ctx.channel.name)
+                ticket = await responder.run(self.redmine.get_ticket, ticket_id, include_journals=True)
+                if ticket:
+                    self.bot.register_thread(ctx.channel.id, ticket.id)
+                    await self.bot.synchronize_ticket(ticket, ctx.channel, progress=responder.update)
+                    await responder.send(f"SYNC ticket {ticket.id} to thread id: {ctx.channel.id} complete")
+                else:
+                    await responder.send(f"cant find ticket# in thread name: {ctx.channel.name}") # error
         else:
             await ctx.respond(f"not a thread") # error
 
@@ -81,6 +95,7 @@ class SCNCog(commands.Cog):
 
 
     @scn.command(description="join the specified team")
+    @option("teamname", description="Name of the team", autocomplete=autocomplete_teams)
     async def join(self, ctx:discord.ApplicationContext, teamname:str , member: discord.Member=None):
         discord_name = ctx.user.name # by default, assume current user
         if member:
@@ -98,6 +113,7 @@ class SCNCog(commands.Cog):
 
 
     @scn.command(description="leave the specified team")
+    @option("teamname", description="Name of the team", autocomplete=autocomplete_teams)
     async def leave(self, ctx:discord.ApplicationContext, teamname:str, member: discord.Member=None):
         discord_name = ctx.user.name # by default, assume current user
         if member:
@@ -114,25 +130,34 @@ class SCNCog(commands.Cog):
 
 
     @scn.command(description="list teams and members")
+    @option("teamname", description="Name of the team", autocomplete=autocomplete_teams)
     async def teams(self, ctx:discord.ApplicationContext, teamname:str=None):
         # list all teams, with members
 
-        if teamname:
-            team = self.redmine.get_team(teamname)
-            if team:
-                #await self.print_team(ctx, team)
-                await ctx.respond(self.format_team(team))
+        async with Responder(ctx) as responder:
+            if teamname:
+                team = await responder.run(self.redmine.get_team, teamname)
+                if team:
+                    #await self.print_team(ctx, team)
+                    await responder.send(self.format_team(team))
+                else:
+                    await responder.send(f"Unknown team name: {teamname}") # error
             else:
-                await ctx.respond(f"Unknown team name: {teamname}") # error
-        else:
-            # all teams
-            teams = self.redmine.get_teams()
-            buff = ""
-            for teamname in teams:
-                team = self.redmine.get_team(teamname)
-                #await self.print_team(ctx, team)
-                buff += self.format_team(team)
-            await ctx.respond(buff[:2000]) # truncate!
+                # all teams, a page at a time, from the membership index
+                teams = await responder.run(self.redmine.get_all_teams)
+                teamnames = sorted(teams)
+                view = PageView(lambda offset, limit: self.fetch_teams(teams, teamnames, offset, limit),
+                                self.format_teams, empty="No teams found.")
+                await view.start(responder)
+
+
+    def fetch_teams(self, teams:dict, teamnames, offset:int, limit:int):
+        # a page of teams, with members, and the total number of teams
+        return [teams[teamname] for teamname in teamnames[offset:offset+limit]], len(teamnames)
+
+
+    def format_teams(self, teams):
+        return "".join(self.format_team(team) for team in teams if team)
 
 
     async def print_team(self, ctx, team):
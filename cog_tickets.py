@@ -7,6 +7,11 @@ import datetime as dt
 
 import discord
 import redmine
+from responder import Responder
+from pager import PageView
+from formatter import compile_fields, DEFAULT_FIELDS
+from query import compile_query, QueryError
+import bulk
 
 from discord.commands import option
 from discord.commands import SlashCommandGroup
@@ -31,6 +36,38 @@ def setup(bot):
     log.info(f"initialized tickets cog")
 
 
+# autocomplete, from the in-memory indexes: never waits on redmine
+def autocomplete_tickets(ctx: discord.AutocompleteContext):
+    return [discord.OptionChoice(name=f"#{ticket_id} {subject}"[:100], value=ticket_id)
+            for ticket_id, subject in ctx.bot.recent_tickets.search(ctx.value)]
+
+def autocomplete_ticket_ids(ctx: discord.AutocompleteContext):
+    # completes the last id of a list, like 12,15-20,3
+    head, sep, word = ctx.value.rpartition(",")
+    return [discord.OptionChoice(name=f"{head}{sep}#{ticket_id} {subject}"[:100], value=f"{head}{sep}{ticket_id}")
+            for ticket_id, subject in ctx.bot.recent_tickets.search(word.strip())]
+
+def autocomplete_params(ctx: discord.AutocompleteContext):
+    # completes the last word of the query, and team: or user: values.
+    # discord names complete to the logins they're paired with.
+    client = ctx.bot.redmine
+    head, _, word = ctx.value.rpartition(" ")
+    key, sep, value = word.rpartition(":")
+    if key in ("team", "user", "assigned", "to"):
+        prefix = head + " " + key + sep
+        word = value
+    else:
+        prefix = head + " "
+    choices = ["me"] if "me".startswith(word.lower()) else []
+    choices += client.team_index.search(word)
+    choices += client.login_index.search(word)
+    for name in client.discord_index.search(word):
+        user = client.find_discord_user(name)
+        if user:
+            choices.append(user.login)
+    return [(prefix + choice).strip() for choice in list(dict.fromkeys(choices))[:25]]
+
+
 
 class TicketsCog(commands.Cog):
     def __init__(self, bot):
@@ -47,23 +84,8 @@ class TicketsCog(commands.Cog):
 #ticket # note - add a note to the specific ticket. same as commenting in the ticket thread (if there is one, works without)
 #ticket # sync - creates new synced thread for ticket in the current text channel, or errors
 
-    # figure out what the term refers to
-    # could be ticket#, team name, user name or search term
-    def resolve_query_term(self, term):
-        # special cases: ticket num and team name
-        try:
-            id = int(term)
-            ticket = self.redmine.get_ticket(id)
-            return [ticket]
-        except ValueError:
-            # not a numeric id, check team
-            if self.redmine.is_user_or_group(term):
-                return self.redmine.tickets_for_team(term)
-            else:
-                # assume a search term
-                return self.redmine.search_tickets(term)
-            
     @commands.slash_command()     # guild_ids=[...] # Create a slash command for the supplied guilds.
+    @option("params", description="me, ticket numbers, team, user, search terms, or key:value like status:open prio>=high sort:age", autocomplete=autocomplete_params)
     async def tickets(self, ctx: discord.ApplicationContext, params: str = ""):
         """List tickets for you, or filtered by parameter"""
         # different options: none, me (default), [group-name], intake, tracker name
@@ -76,59 +98,79 @@ class TicketsCog(commands.Cog):
         user = self.redmine.find_discord_user(ctx.user.name)
         log.debug(f"found user mapping for {ctx.user.name}: {user}")
 
-        args = params.split()
+        try:
+            query = compile_query(params, self.redmine, user)
+        except QueryError as e:
+            await ctx.respond(str(e))
+            return
 
-        if len(args) == 0 or args[0] == "me":
-            await self.print_tickets(self.redmine.my_tickets(user.login), ctx)
-        elif len(args) == 1:
-            await self.print_tickets(self.resolve_query_term(args[0]), ctx)
+        await self.print_tickets(query.fetch_page, ctx)
             
 
     @commands.slash_command()
-    async def ticket(self, ctx: discord.ApplicationContext, ticket_id:int, action:str="show"):
-        """Update status on a ticket, using: unassign, resolve, progress"""
+    @option("ticket_id", description="ID of the ticket, or a list or range like 12,15-20", autocomplete=autocomplete_ticket_ids)
+    async def ticket(self, ctx: discord.ApplicationContext, ticket_id:str, action:str="show"):
+        """Update status on tickets, using: unassign, resolve, progress"""
+        try:
+            ticket_ids = bulk.parse_ids(ticket_id)
+        except ValueError as e:
+            await ctx.respond(f"Error {action} {ticket_id}: {e}")
+            return
+
         try:
             # lookup the user
             user = self.redmine.find_discord_user(ctx.user.name)
             log.debug(f"found user mapping for {ctx.user.name}: {user}")
 
             match action:
-                case "show":
-                    ticket = self.redmine.get_ticket(ticket_id)
+                case "show" | "details": # FIXME details
+                    if len(ticket_ids) > 1:
+                        query = compile_query(" ".join(str(id) for id in ticket_ids), self.redmine, user)
+                        await self.print_tickets(query.fetch_page, ctx)
+                        return
+                    ticket = self.redmine.get_ticket(ticket_ids[0])
                     if ticket:
+                        self.bot.recent_tickets.add([ticket])
                         await ctx.respond(self.format_ticket(ticket)[:2000]) #trunc
                     else:
                         await ctx.respond(f"Ticket {ticket_id} not found.")
-                case "details":
-                    # FIXME
-                    ticket = self.redmine.get_ticket(ticket_id)
-                    if ticket:
-                        await ctx.respond(self.format_ticket(ticket)[:2000]) #trunc
-                    else:
-                        await ctx.respond(f"Ticket {ticket_id} not found.")                
                 case "unassign":
-                    self.redmine.unassign_ticket(ticket_id, user.login)
-                    await self.print_ticket(self.redmine.get_ticket(ticket_id), ctx)
+                    await self.bulk_action(ctx, "unassigned", ticket_ids,
+                        lambda id: self.redmine.unassign_ticket(id, user.login))
                 case "resolve":
-                    self.redmine.resolve_ticket(ticket_id, user.login)
-                    await self.print_ticket(self.redmine.get_ticket(ticket_id), ctx)
+                    await self.bulk_action(ctx, "resolved", ticket_ids,
+                        lambda id: self.redmine.resolve_ticket(id, user.login))
                 case "progress":
-                    self.redmine.progress_ticket(ticket_id, user.login)
-                    await self.print_ticket(self.redmine.get_ticket(ticket_id), ctx)
+                    await self.bulk_action(ctx, "in progress", ticket_ids,
+                        lambda id: self.redmine.progress_ticket(id, user.login))
                 #case "note":
                 #    msg = ???
                 #    self.redmine.append_message(ticket_id, user.login, msg)
                 case "assign":
-                    self.redmine.assign_ticket(ticket_id, user.login)
-                    await self.print_ticket(self.redmine.get_ticket(ticket_id), ctx)
+                    await self.bulk_action(ctx, "assigned", ticket_ids,
+                        lambda id: self.redmine.assign_ticket(id, user.login))
                 case _:
-                    await ctx.respond("unknown command: {action}")
+                    await ctx.respond(f"unknown command: {action}")
         except Exception as e:
             msg = f"Error {action} {ticket_id}: {e}"
             log.error(msg)
             await ctx.respond(msg)
 
 
+    async def bulk_action(self, ctx: discord.ApplicationContext, verb:str, ticket_ids:list, action):
+        # action(ticket_id) returns the updated ticket, so there's no need to get it again
+        async with Responder(ctx) as responder:
+            await responder.expect(len(ticket_ids))
+            results = await responder.run(bulk.run_bulk, action, ticket_ids)
+            tickets = self.bot.recent_tickets.add([result.ticket for result in results if result.ok()])
+            if len(results) == 1 and results[0].ok():
+                await responder.send(self.format_ticket(results[0].ticket))
+            elif tickets:
+                await responder.send(bulk.summarize(verb, results) + "\n" + self.format_tickets(tickets))
+            else:
+                await responder.send(bulk.summarize(verb, results))
+
+
     @commands.slash_command(name="new", description="Create a new ticket") 
     @option("title", description="Title of the new SCN ticket")
     @option("add_thread", description="Create a Discord thread for the new ticket", default=False)
@@ -142,6 +184,7 @@ class TicketsCog(commands.Cog):
         text = f"ticket created by Discord user {ctx.user.name} -> {user.login}, with the text: {title}"
         ticket = self.redmine.create_ticket(user, title, text)
         if ticket:
+            self.bot.recent_tickets.add([ticket])
             await ctx.respond(self.format_ticket(ticket)[:2000]) #trunc
         # error handling? exception? 
         else:
@@ -155,39 +198,41 @@ class TicketsCog(commands.Cog):
 
 
     @commands.slash_command(description="Create a Discord thread for the specified ticket") 
-    @option("ticket_id", description="ID of tick to create thread for")
+    @option("ticket_id", description="ID of tick to create thread for", autocomplete=autocomplete_tickets)
     async def thread(self, ctx: discord.ApplicationContext, ticket_id:int):
-        ticket = self.redmine.get_ticket(ticket_id)
-        if ticket:
-            # create the thread...
-            thread = await self.create_thread(ticket, ctx)
-
-            # update the discord flag on tickets, add a note with url of thread; thread.jump_url
-            # TODO message templates
-            note = f"Created Discord thread: {thread.name}: {thread.jump_url}"
-            user = self.redmine.find_discord_user(ctx.user.name)
-            self.redmine.enable_discord_sync(ticket.id, user, note)
-
-            # sync the ticket, so everything is up to date
-            await self.bot.synchronize_ticket(ticket, thread, ctx)
-
-            # TODO format command for single ticket
-            await ctx.respond(f"Created new thread for {ticket.id}: {thread}") # todo add some fancy formatting
-        else:
-            await ctx.respond(f"ERROR: Unkown ticket ID: {ticket_id}") # todo add some fancy formatting
+        async with Responder(ctx) as responder:
+            ticket = await responder.run(self.redmine.get_ticket, ticket_id)
+            if ticket:
+                # create the thread...
+                thread = await self.create_thread(ticket, ctx)
+                self.bot.register_thread(thread.id, ticket.id)
+
+                # update the discord flag on tickets, add a note with url of thread; thread.jump_url
+                # TODO message templates
+                note = f"Created Discord thread: {thread.name}: {thread.jump_url}"
+                user = self.redmine.find_discord_user(ctx.user.name)
+                await responder.run(self.redmine.enable_discord_sync, ticket.id, user, note)
+
+                # sync the ticket, so everything is up to date
+                await self.bot.synchronize_ticket(ticket, thread, progress=responder.update)
+
+                # TODO format command for single ticket
+                await responder.send(f"Created new thread for {ticket.id}: {thread}") # todo add some fancy formatting
+            else:
+                await responder.send(f"ERROR: Unkown ticket ID: {ticket_id}") # todo add some fancy formatting
 
 
     ### formatting ###
 
-    async def print_tickets(self, tickets, ctx):
-        msg = self.format_tickets(tickets)
-        
-        if len(msg) > 2000:
-            log.warning("message over 2000 chars. truncing.")
-            msg = msg[:2000]
-        await ctx.respond(msg)
+    async def print_tickets(self, fetch_page, ctx):
+        # a page of tickets at a time, fetched as they're viewed
+        async with Responder(ctx) as responder:
+            view = PageView(fetch_page, lambda tickets: self.format_tickets(self.bot.recent_tickets.add(tickets)),
+                            empty="No tickets found.")
+            await view.start(responder)
 
     async def print_ticket(self, ticket, ctx):
+        self.bot.recent_tickets.add([ticket])
         msg = self.format_ticket(ticket)
         
         if len(msg) > 2000:
@@ -195,17 +240,10 @@ class TicketsCog(commands.Cog):
             msg = msg[:2000]
         await ctx.respond(msg)
 
-    def format_tickets(self, tickets, fields=["link","priority","updated","assigned","subject"]):
+    def format_tickets(self, tickets, fields=DEFAULT_FIELDS):
         if tickets is None:
             return "No tickets found."
-        
-        section = ""
-        for ticket in tickets:
-            section += self.format_ticket(ticket, fields) + "\n" # append each ticket
-        return section.strip()
-
-    def format_ticket(self, ticket, fields=["link","priority","updated","assigned","subject"]):
-        section = ""
-        for field in fields:
-            section += self.redmine.get_field(ticket, field) + " " # spacer, one space
-        return section.strip() # remove trailing whitespace
\ No newline at end of file
+        return compile_fields(tuple(fields), self.redmine.url).format(tickets)
+
+    def format_ticket(self, ticket, fields=DEFAULT_FIELDS):
+        return self.format_tickets([ticket], fields)
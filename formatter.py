@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import logging
+import datetime as dt
+from functools import lru_cache
+
+import humanize
+
+# Ticket tables, as for /tickets and the cli. A field list is compiled once
+# into a row function, and values shared by the rows, like the time now, are
+# worked out once per batch of tickets rather than once per cell.
+
+log = logging.getLogger(__name__)
+
+DEFAULT_FIELDS = ("link", "priority", "updated", "assigned", "subject")
+
+
+class Batch():
+    """values shared by the rows formatted together"""
+    def __init__(self, url:str, now:dt.datetime=None):
+        self.url = url
+        self.now = now or dt.datetime.now(dt.timezone.utc)
+        self.ages = {} # timestamp string -> age
+        self.natural_ages = {} # timestamp string -> humanized age
+
+    def age(self, timestr:str) -> dt.timedelta:
+        age = self.ages.get(timestr)
+        if age is None:
+            age = self.now - dt.datetime.fromisoformat(timestr) ### UTC
+            self.ages[timestr] = age
+        return age
+
+    def natural_age(self, timestr:str) -> str:
+        age = self.natural_ages.get(timestr)
+        if age is None:
+            age = humanize.naturaldelta(self.age(timestr))
+            self.natural_ages[timestr] = age
+        return age
+
+
+# field name -> cell(ticket, batch), matching redmine.Client.get_field
+CELLS = {
+    "id": lambda ticket, batch: str(ticket.id),
+    "url": lambda ticket, batch: f"{batch.url}/issues/{ticket.id}",
+    "link": lambda ticket, batch: f"[{ticket.id}]({batch.url}/issues/{ticket.id})",
+    "priority": lambda ticket, batch: ticket.priority.name,
+    "updated": lambda ticket, batch: ticket.updated_on,
+    "assigned": lambda ticket, batch: ticket.assigned_to.name,
+    "status": lambda ticket, batch: ticket.status.name,
+    "subject": lambda ticket, batch: ticket.subject,
+    "title": lambda ticket, batch: ticket.title,
+    "age": lambda ticket, batch: batch.natural_age(ticket.updated_on),
+}
+
+
+class RowFormatter():
+    """A field list, compiled to the cell functions for the fields"""
+    def __init__(self, fields, url:str, cells:dict=CELLS):
+        unknown = [field for field in fields if field not in cells]
+        if unknown:
+            raise ValueError(f"unknown fields: {', '.join(unknown)}")
+        self.fields = tuple(fields)
+        self.url = url
+        self.cells = tuple(cells[field] for field in fields)
+
+    def row(self, ticket, batch:Batch) -> list:
+        """the cells of a ticket, blank where the ticket has no value"""
+        row = []
+        for cell in self.cells:
+            try:
+                row.append(cell(ticket, batch))
+            except AttributeError:
+                row.append("") # unassigned, and the like
+        return row
+
+    def rows(self, tickets, now:dt.datetime=None) -> list:
+        batch = Batch(self.url, now)
+        return [self.row(ticket, batch) for ticket in tickets]
+
+    def format(self, tickets, now:dt.datetime=None) -> str:
+        """a line of space-separated cells for each ticket"""
+        batch = Batch(self.url, now)
+        return "\n".join(" ".join(self.row(ticket, batch)).strip() for ticket in tickets)
+
+
+@lru_cache(maxsize=64)
+def compile_fields(fields:tuple, url:str) -> RowFormatter:
+    """a formatter for the fields, compiled once and reused"""
+    return RowFormatter(fields, url)
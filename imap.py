@@ -6,16 +6,28 @@ import logging
 import email
 import email.policy
 import re
+import html
+import hashlib
+import binascii
+import tempfile
+import time
+import socket
+import imaplib
+import threading
 import traceback
+import datetime as dt
+from contextlib import contextmanager
 
 import redmine
+import store
+import minhash
+import spam
 
 from imapclient import IMAPClient, SEEN, DELETED
+from imapclient.exceptions import LoginError
+import click
 from dotenv import load_dotenv
 
-from io import StringIO
-from html.parser import HTMLParser
-
 # imapclient docs: https://imapclient.readthedocs.io/en/3.0.0/index.html
 # source code: https://github.com/mjs/imapclient
 
@@ -23,22 +35,193 @@ from html.parser import HTMLParser
 ## logging ##
 log = logging.getLogger(__name__)
 
+SPOOL_MAX_SIZE = 1024 * 1024 # attachments larger than this are spooled to disk
+LEASE_TTL = 600 # seconds, renewed for every message handled
+REPLAY_BATCH = 100 # dead letters retried per replay
+DUPLICATE_WINDOW = 7 # days of open tickets checked for near-duplicate messages
+DUPLICATE_MIN_WORDS = 8 # shorter notes ("thanks!") aren't matched as duplicates
+POOL_SIZE = 2 # imap sessions kept open
+NOOP_INTERVAL = 60 # seconds a session can be idle before it's checked with a NOOP
+RECONNECT_DELAY = 1 # seconds before reconnecting, doubled after each failure
+MAX_RECONNECT_DELAY = 60
+RECONNECT_ATTEMPTS = 5
+
+# a dropped or broken connection. IMAPClient's errors are imaplib's.
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError)
+
+
+# strip any re: and forwarded from a subject line
+# from: https://stackoverflow.com/questions/9153629/regex-code-for-removing-fwd-re-etc-from-email-subject
+SUBJECT_PREFIX_RE = re.compile(r'^([\[\(] *)?(RE?S?|FYI|RIF|I|FS|VB|RV|ENC|ODP|PD|YNT|ILT|SV|VS|VL|AW|WG|ΑΠ|ΣΧΕΤ|ΠΡΘ|תגובה|הועבר|主题|转发|FWD?) *([-:;)\]][ :;\])-]*|$)|\]+ *$', re.IGNORECASE)
+
+
+def prefix_trie_regex(prefixes) -> str:
+    """Build a regex matching any of the prefixes, factored as a trie so the
+    cost of a match depends on the prefix length, not the number of prefixes."""
+    trie = {}
+    for prefix in prefixes:
+        node = trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[''] = True # end of a prefix
+
+    def build(node) -> str:
+        if '' in node:
+            # a shorter prefix already matches, anything longer is redundant
+            return ''
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items())]
+        if len(branches) == 1:
+            return branches[0]
+        return '(?:' + '|'.join(branches) + ')'
+
+    return build(trie)
+
+
+class RuleSet():
+    """Cleaning rules for message bodies: lines starting with any of the
+    prefixes are dropped, and the body is cut at the first cutoff regex match."""
+    def __init__(self, name:str, prefixes=(), cutoffs=()):
+        self.name = name
+        self.prefixes = list(prefixes)
+        self.cutoffs = list(cutoffs)
+
+
+class BodyCleaner():
+    """Compiles any number of rule sets into one prefix automaton and one cutoff
+    regex, so adding rules doesn't add per-line cost."""
+    def __init__(self, rule_sets=()):
+        self.rule_sets = list(rule_sets)
+        self.compile()
+
+    def add_rules(self, rules:RuleSet):
+        self.rule_sets.append(rules)
+        self.compile()
+
+    def compile(self):
+        prefixes = [prefix for rules in self.rule_sets for prefix in rules.prefixes]
+        cutoffs = [cutoff for rules in self.rule_sets for cutoff in rules.cutoffs]
+
+        self.prefix_re = re.compile(prefix_trie_regex(prefixes)) if prefixes else None
+        self.cutoff_re = re.compile('|'.join(f"(?:{cutoff})" for cutoff in cutoffs), re.MULTILINE) if cutoffs else None
+
+    def clean(self, text:str) -> str:
+        # cut at the first forward, quote or signature marker, in one search
+        if self.cutoff_re:
+            match = self.cutoff_re.search(text)
+            if match:
+                text = text[0:match.start()]
+
+        lines = text.splitlines()
+        if self.prefix_re:
+            matcher = self.prefix_re.match
+            lines = [line for line in lines if not matcher(line)]
+
+        return '\n'.join(lines).strip()
+
+
+QUOTE_RULES = RuleSet("quotes",
+    cutoffs=[
+        re.escape("------ Forwarded message ---------"), # strip any forwarded messages
+        r"^On .* <.*>\s+wrote:", # "On ... wrote:"
+        r"^-- $", # standard signature separator
+    ])
+
+# google content, as in http://10.10.0.218/issues/323
+GOOGLE_VOICE_RULES = RuleSet("google voice",
+    prefixes=[
+        "<https://voice.google.com>",
+        "YOUR ACCOUNT <https://voice.google.com> HELP CENTER",
+        "<https://support.google.com/voice#topic=1707989> HELP FORUM",
+        "<https://productforums.google.com/forum/#!forum/voice>",
+        "This email was sent to you because you indicated that you'd like to receive",
+        "email notifications for text messages. If you don't want to receive such",
+        "emails in the future, please update your email notification settings",
+        "<https://voice.google.com/settings#messaging>.",
+        "Google LLC",
+        "1600 Amphitheatre Pkwy",
+        "Mountain View CA 94043 USA",
+    ])
+
 
 # Parsing compound forwarded emails messages is more complex than expected, so
 # Message will represent everything needed for creating and updating tickets,
 # including attachments.
 class Attachment():
-    def __init__(self, name:str, type:str, payload):
+    """An attachment's content is spooled: kept in memory when small, in a
+    temp file when large, and read back in chunks to upload it."""
+    def __init__(self, name:str, type:str, payload:bytes=None):
         self.name = name
         self.content_type = type
-        self.payload = payload
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        if payload:
+            self.write(payload)
+
+    def write(self, data:bytes):
+        self.file.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def clear(self):
+        self.file.seek(0)
+        self.file.truncate()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def digest(self) -> str:
+        # content hash, used to avoid uploading the same payload twice
+        return self.sha256.hexdigest()
+
+    def chunks(self, chunk_size:int=redmine.CHUNK_SIZE):
+        self.file.seek(0)
+        while chunk := self.file.read(chunk_size):
+            yield chunk
+
+    def stream(self) -> redmine.UploadStream:
+        return redmine.UploadStream(self.chunks(), self.size)
+
+    @property
+    def payload(self) -> bytes:
+        # the full content, avoid for large attachments
+        return b''.join(self.chunks())
 
     def upload(self, client, user_id):
-        self.token = client.upload_file(user_id, self.payload, self.name, self.content_type)
+        self.token = client.upload_file(user_id, self.stream(), self.name, self.content_type)
 
     def set_token(self, token):
         self.token = token
 
+    def close(self):
+        self.file.close()
+
+
+def decode_attachment(part, attachment:Attachment):
+    """Decode a MIME part into the attachment a chunk at a time, instead of
+    decoding the whole payload in memory."""
+    encoding = part.get('Content-Transfer-Encoding', '').strip().lower()
+    if encoding != 'base64':
+        attachment.write(part.get_payload(decode=True) or b'')
+        return
+
+    raw = part.get_payload(decode=False)
+    leftover = ''
+    try:
+        # 4 base64 chars make 3 bytes, decode whole quads and carry the rest
+        step = redmine.CHUNK_SIZE * 4 // 3
+        for i in range(0, len(raw), step):
+            chars = leftover + ''.join(raw[i:i+step].split())
+            usable = len(chars) - len(chars) % 4
+            attachment.write(binascii.a2b_base64(chars[:usable]))
+            leftover = chars[usable:]
+        if leftover.rstrip('='):
+            attachment.write(binascii.a2b_base64(leftover + '=' * (-len(leftover) % 4)))
+    except binascii.Error as e:
+        # malformed base64: let the email package do its lenient best
+        log.warning(f"falling back to full decode of {attachment.name}: {e}")
+        attachment.clear()
+        attachment.write(part.get_payload(decode=True))
+
 
 class Message():
     def __init__(self, from_addr:str, subject:str):
@@ -46,6 +229,8 @@ class Message():
         self.subject = subject
         self.attachments = []
         self.note = ""
+        self.key = None # Message-ID, or a hash of the message, for idempotent handling
+        self.headers = {} # lower-case names
 
     # Note: note containts the text of the message, the body of the email
     def set_note(self, note:str):
@@ -54,35 +239,321 @@ class Message():
     def add_attachment(self, attachment:Attachment):
         self.attachments.append(attachment)
         
+    def close(self):
+        # free the spooled attachments, once the message is handled
+        for attachment in self.attachments:
+            attachment.close()
+
     def subject_cleaned(self) -> str:
         # strip any re: and forwarded from a subject line
-        # from: https://stackoverflow.com/questions/9153629/regex-code-for-removing-fwd-re-etc-from-email-subject
-        p = re.compile(r'^([\[\(] *)?(RE?S?|FYI|RIF|I|FS|VB|RV|ENC|ODP|PD|YNT|ILT|SV|VS|VL|AW|WG|ΑΠ|ΣΧΕΤ|ΠΡΘ|תגובה|הועבר|主题|转发|FWD?) *([-:;)\]][ :;\])-]*|$)|\]+ *$', re.IGNORECASE)
-        return p.sub('', self.subject).strip()
+        return SUBJECT_PREFIX_RE.sub('', self.subject).strip()
         
     def __str__(self):
         return f"from:{self.from_address}, subject:{self.subject}, attached:{len(self.attachments)}; {self.note[0:20]}" 
 
-# from https://stackoverflow.com/questions/753052/strip-html-from-strings-in-python
-class MLStripper(HTMLParser):
+# one token per match: comment, start/end tag, declaration, text or a stray '<'
+HTML_TOKEN_RE = re.compile(r'''<!--.*?(?:-->|\Z)|<(/?)([a-zA-Z][^\s/>]*)(?:[^>"']|"[^"]*"|'[^']*')*>|<[!?][^>]*>|[^<]+|<''', re.DOTALL)
+
+
+class HTMLTextConverter():
+    """Streaming HTML to text conversion: script and style are dropped, runs of
+    whitespace collapse to one space and block elements break lines. Feed it
+    any number of chunks, the text is built in a single pass."""
+    SKIP_TAGS = {"script", "style", "head", "title", "noscript", "template"}
+    PARAGRAPH_TAGS = {"p", "table", "ul", "ol", "blockquote", "pre", "hr",
+        "h1", "h2", "h3", "h4", "h5", "h6"}
+    BLOCK_TAGS = PARAGRAPH_TAGS | {"div", "tr", "li", "dd", "dt", "dl", "section",
+        "article", "header", "footer", "nav", "aside", "address", "center", "form", "fieldset"}
+
     def __init__(self):
-        super().__init__()
-        self.reset()
-        self.strict = False
-        self.convert_charrefs= True
-        self.text = StringIO()
-    def handle_data(self, d):
-        self.text.write(d + '\n') # force a newline
-    def get_data(self):
-        return self.text.getvalue()
+        self.chunks = []
+        self.buffer = ""
+        self.skip_tag = None
+        self.skip_end_re = None
+        self.pre_depth = 0
+        self.pending_newlines = 0
+        self.pending_space = False
+
+    def feed(self, data:str):
+        data = self.buffer + data
+        # hold back a trailing tag or entity that might be split across chunks
+        cut = len(data)
+        lt = data.rfind('<')
+        if lt > -1 and data.find('>', lt) == -1:
+            cut = lt
+        # and a comment that isn't closed yet, as it may have tags in it
+        comment = data.rfind('<!--', 0, cut)
+        if comment > -1 and data.find('-->', comment + 4) == -1:
+            cut = comment
+        amp = data.rfind('&', 0, cut)
+        if amp > -1 and data.find(';', amp, cut) == -1 and cut - amp < 32:
+            cut = amp
+        self.buffer = data[cut:]
+        self.convert(data[:cut])
+
+    def close(self):
+        data, self.buffer = self.buffer, ""
+        self.convert(data)
+
+    def convert(self, data:str):
+        pos = 0
+        while pos < len(data):
+            if self.skip_tag:
+                # skipped content isn't tokenized, jump to the closing tag
+                match = self.skip_end_re.search(data, pos)
+                if match is None:
+                    return
+                self.skip_tag = None
+                pos = match.end()
+
+            for match in HTML_TOKEN_RE.finditer(data, pos):
+                tag = match.group(2)
+                if tag:
+                    tag = tag.lower()
+                    if match.group(1):
+                        self.handle_endtag(tag)
+                    else:
+                        self.handle_starttag(tag)
+                        if self.skip_tag:
+                            pos = match.end()
+                            break
+                else:
+                    token = match.group()
+                    if token[0] != '<' or token == '<':
+                        if '&' in token:
+                            token = html.unescape(token)
+                        self.handle_data(token)
+            else:
+                return
+
+    def break_line(self, count:int):
+        self.pending_newlines = max(self.pending_newlines, count)
+        self.pending_space = False
+
+    def write(self, text:str):
+        if self.pending_newlines:
+            if self.chunks:
+                self.chunks.append('\n' * self.pending_newlines)
+            self.pending_newlines = 0
+        elif self.pending_space and self.chunks:
+            self.chunks.append(' ')
+        self.pending_space = False
+        self.chunks.append(text)
+
+    def handle_starttag(self, tag:str):
+        if tag in self.SKIP_TAGS:
+            self.skip_tag = tag
+            self.skip_end_re = re.compile(f"</{tag}\\s*>", re.IGNORECASE)
+        elif tag == "br":
+            self.pending_newlines = min(self.pending_newlines + 1, 2)
+            self.pending_space = False
+        elif tag in self.BLOCK_TAGS:
+            self.break_line(2 if tag in self.PARAGRAPH_TAGS else 1)
+            if tag == "li":
+                self.write("* ")
+            elif tag == "pre":
+                self.pre_depth += 1
+
+    def handle_endtag(self, tag:str):
+        if tag in self.BLOCK_TAGS:
+            self.break_line(2 if tag in self.PARAGRAPH_TAGS else 1)
+            if tag == "pre" and self.pre_depth > 0:
+                self.pre_depth -= 1
+
+    def handle_data(self, data:str):
+        if self.pre_depth:
+            self.write(data)
+            return
+
+        text = ' '.join(data.split())
+        if text:
+            if data[0].isspace():
+                self.pending_space = True
+            self.write(text)
+            self.pending_space = data[-1].isspace()
+        elif data:
+            self.pending_space = True
+
+    def get_text(self) -> str:
+        return ''.join(self.chunks)
+
+
+def html_to_text(html_body:str, chunk_size:int=64*1024) -> str:
+    converter = HTMLTextConverter()
+    for i in range(0, len(html_body), chunk_size):
+        converter.feed(html_body[i:i+chunk_size])
+    converter.close()
+    return converter.get_text()
+
+
+class Session():
+    """An authenticated IMAP connection, and the folder it has selected"""
+    def __init__(self, server:IMAPClient):
+        self.server = server
+        self.folder = None
+        self.last_used = time.monotonic()
+
+    def select(self, folder:str):
+        if self.folder != folder:
+            self.server.select_folder(folder, readonly=False)
+            self.folder = folder
+
+    def idle_time(self) -> float:
+        return time.monotonic() - self.last_used
+
+    def is_alive(self) -> bool:
+        try:
+            self.server.noop()
+            self.last_used = time.monotonic()
+            return True
+        except CONNECTION_ERRORS as e:
+            log.info(f"imap session dropped: {e}")
+            return False
+
+    def logout(self):
+        try:
+            self.server.logout()
+        except CONNECTION_ERRORS:
+            pass # already gone
+
+
+class ConnectionPool():
+    """Keeps a few authenticated IMAP sessions open, for any number of folders.
+    Sessions idle for a while are checked with a NOOP before reuse, and dropped
+    sessions are replaced, reconnecting with backoff."""
+    def __init__(self, host:str, port:int, user:str, passwd:str, size:int=POOL_SIZE, factory=None):
+        self.host = host
+        self.user = user
+        self.passwd = passwd
+        self.size = size
+        self.factory = factory or (lambda: IMAPClient(host=host, port=port, ssl=True))
+        self.idle = [] # open sessions not in use
+        self.count = 0 # open sessions, in use or idle
+        self.condition = threading.Condition()
+        self.stopping = threading.Event()
+        self.keepalive_thread = None
+
+    def connect(self) -> Session:
+        delay = RECONNECT_DELAY
+        attempt = 1
+        while True:
+            try:
+                server = self.factory()
+                server.login(self.user, self.passwd)
+                log.info(f'logged into imap {self.host}')
+                return Session(server)
+            except LoginError:
+                raise # retrying won't fix the credentials
+            except CONNECTION_ERRORS as e:
+                if attempt >= RECONNECT_ATTEMPTS or self.stopping.is_set():
+                    raise
+                log.warning(f"imap connection to {self.host} failed, attempt {attempt}, retrying in {delay} sec: {e}")
+                self.stopping.wait(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                attempt += 1
+
+    def acquire(self, folder:str) -> Session:
+        with self.condition:
+            while not self.idle and self.count >= self.size:
+                self.condition.wait()
+            # prefer a session with the folder already selected, then a new session
+            session = next((s for s in self.idle if s.folder == folder), None)
+            if session is None and self.count >= self.size:
+                session = self.idle[0]
+            if session:
+                self.idle.remove(session)
+            else:
+                self.count += 1
+
+        try:
+            if session and session.idle_time() > NOOP_INTERVAL and not session.is_alive():
+                session.logout()
+                session = None
+            if session is None:
+                session = self.connect()
+            session.select(folder)
+            return session
+        except BaseException:
+            if session:
+                session.logout()
+            self.discard()
+            raise
+
+    def release(self, session:Session, broken:bool=False):
+        if broken:
+            session.logout()
+            self.discard()
+        else:
+            session.last_used = time.monotonic()
+            with self.condition:
+                self.idle.append(session)
+                self.condition.notify()
+
+    def discard(self):
+        with self.condition:
+            self.count -= 1
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self, folder:str="INBOX"):
+        """an IMAPClient with the folder selected, returned to the pool after use"""
+        session = self.acquire(folder)
+        try:
+            yield session.server
+        except CONNECTION_ERRORS:
+            self.release(session, broken=True)
+            raise
+        except BaseException:
+            self.release(session)
+            raise
+        else:
+            self.release(session)
+
+    def keepalive(self):
+        """NOOP the sessions that have been idle a while, dropping dead ones"""
+        with self.condition:
+            stale = [session for session in self.idle if session.idle_time() > NOOP_INTERVAL]
+            for session in stale:
+                self.idle.remove(session)
+        for session in stale:
+            if session.is_alive():
+                self.release(session)
+            else:
+                self.release(session, broken=True)
+
+    def start_keepalive(self, interval:float=NOOP_INTERVAL):
+        def run():
+            while not self.stopping.wait(interval):
+                self.keepalive()
+        self.keepalive_thread = threading.Thread(target=run, name="imap-keepalive", daemon=True)
+        self.keepalive_thread.start()
+
+    def close(self):
+        self.stopping.set()
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.count -= len(idle)
+        for session in idle:
+            session.logout()
+
 
 class Client(): ## imap.Client()
-    def __init__(self):
+    def __init__(self, redmine_client:redmine.Client=None):
         self.host = os.getenv('IMAP_HOST')
         self.user = os.getenv('IMAP_USER')
         self.passwd = os.getenv('IMAP_PASSWORD')
         self.port = 993
-        self.redmine = redmine.Client()
+        self.folders = [folder.strip() for folder in os.getenv('IMAP_FOLDERS', "INBOX").split(',') if folder.strip()]
+        self.pool = ConnectionPool(self.host, self.port, self.user, self.passwd, int(os.getenv('IMAP_POOL_SIZE', POOL_SIZE)))
+        self.redmine = redmine_client or redmine.Client()
+        self.ingest_log = store.IngestLog()
+        self.dead_letters = store.DeadLetters()
+        self.events = store.EventBus()
+        self.duplicates = None # built on first use
+        self.duplicate_authors = {} # ticket id -> author id, for the indexed tickets
+        self.duplicates_lock = threading.Lock()
+        self.spam_filter = spam.SpamFilter()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
 
     # note: not happy with this method of dealing with complex email address
     # but I don't see a better way. open to suggestions
@@ -112,29 +583,33 @@ class Client(): ## imap.Client()
         from_address = root.get("From")
         subject = root.get("Subject")
         message = Message(from_address, subject)
+        message.headers = {name.lower(): str(value) for name, value in root.items()}
+        message_id = root.get("Message-ID")
+        message.key = message_id.strip() if message_id else hashlib.sha256(data).hexdigest()
         payload = ""
+        html_body = ""
 
         for part in root.walk():
             content_type = part.get_content_type()
             #print(f"### type={content_type}: {len(part.as_string())}")
             if part.is_attachment():
-                message.add_attachment( Attachment(
-                    name=part.get_filename(), 
-                    type=content_type,
-                    payload=part.get_payload(decode=True)))
-                log.debug(f"Added attachment: {part.get_filename()} {content_type}")
+                attachment = Attachment(name=part.get_filename(), type=content_type)
+                decode_attachment(part, attachment)
+                message.add_attachment(attachment)
+                log.debug(f"Added attachment: {part.get_filename()} {content_type}, {attachment.size} bytes")
             # FIXME ticket 208 - http://10.10.0.218/issues/208
             elif content_type == 'text/plain': # FIXME std const?
                 payload = part.get_payload(decode=True).decode('UTF-8')
-                
+            elif content_type == 'text/html' and html_body == "":
+                html_body = part.get_content()
+
         # http://10.10.0.218/issues/208
         if payload == "":
-            payload = root.get_body().get_content()
-            # search for HTML
-            if payload.startswith("<html>") or payload.startswith("<HTML>"):
-                # strip HTML
-                payload = self.strip_html_tags(payload)
-                #log.debug(f"HTML payload after: {payload}")
+            if html_body:
+                # HTML-only message, convert to text
+                payload = self.strip_html_tags(html_body)
+            else:
+                payload = root.get_body().get_content()
 
         payload = self.strip_forwards(payload)
         message.set_note(payload)
@@ -143,59 +618,15 @@ class Client(): ## imap.Client()
         return message
 
     def strip_html_tags(self, text:str) -> str:
-        s = MLStripper()
-        s.feed(text)
-        return s.get_data()
+        return html_to_text(text)
 
-    skip_strs = [
-        "<https://voice.google.com>",
-        "YOUR ACCOUNT <https://voice.google.com> HELP CENTER",
-        "<https://support.google.com/voice#topic=1707989> HELP FORUM",
-        "<https://productforums.google.com/forum/#!forum/voice>",
-        "This email was sent to you because you indicated that you'd like to receive",
-        "email notifications for text messages. If you don't want to receive such",
-        "emails in the future, please update your email notification settings",
-        "<https://voice.google.com/settings#messaging>.",
-        "Google LLC",
-        "1600 Amphitheatre Pkwy",
-        "Mountain View CA 94043 USA",
-    ]
-    def strip_forwards(self, text:str) -> str:
-        # strip any forwarded messages
-        # from ^>
-        forward_tag = "------ Forwarded message ---------"
-        idx = text.find(forward_tag)
-        if idx > -1:
-            text = text[0:idx]
-            
-        # search for "On ... wrote:"
-        p = re.compile(r"^On .* <.*>\s+wrote:", flags=re.MULTILINE)
-        match = p.search(text)
-        if match:
-            text = text[0:match.start()]
-            
-        # TODO search for --
-
-        # look for google content, as in http://10.10.0.218/issues/323
-        buffer = ""
-        for line in text.splitlines():
-            skip = False
-            # search for skip_strs
-            for skip_str in self.skip_strs:
-                if line.startswith(skip_str):
-                    skip = True
-                    break;
-            if skip:
-                log.debug(f"skipping {line}")
-            else:
-                buffer += line + '\n'
-
-        return buffer.strip()
+    cleaner = BodyCleaner([QUOTE_RULES, GOOGLE_VOICE_RULES])
 
-    def handle_message(self, msg_id:str, message:Message):
-        first, last, addr = self.parse_email_address(message.from_address)
-        log.debug(f'uid:{msg_id} - from:{last}, {first}, email:{addr}, subject:{message.subject}')
+    def strip_forwards(self, text:str) -> str:
+        # strip any forwarded messages, quoted replies and known boilerplate
+        return self.cleaner.clean(text)
 
+    def find_ticket(self, message:Message):
         ticket = None
         # first, search for a matching subject
         tickets = self.redmine.search_tickets(message.subject_cleaned())
@@ -213,6 +644,62 @@ class Client(): ## imap.Client()
             # this uses a simple REGEX '#\d+' to match ticket numbers
             ticket = self.redmine.find_ticket_from_str(message.subject)
 
+        # last, check for the same message sent again
+        if not ticket:
+            ticket = self.find_duplicate(message)
+
+        return ticket
+
+    def duplicate_index(self) -> minhash.MinHashIndex:
+        # index the descriptions of recent open tickets, once per window
+        with self.duplicates_lock:
+            if self.duplicates is None:
+                duplicates = minhash.MinHashIndex()
+                authors = {}
+                for ticket in self.redmine.recent_open_tickets(DUPLICATE_WINDOW):
+                    if getattr(ticket, 'description', None):
+                        duplicates.add(ticket.id, ticket.description)
+                        authors[ticket.id] = ticket.author.id
+                self.duplicates, self.duplicate_authors = duplicates, authors
+                log.info(f"indexed {len(duplicates)} recent tickets for duplicate detection")
+            return self.duplicates
+
+    def add_duplicate(self, ticket_id:int, author_id:int, text:str):
+        # a new ticket, if the index is built. otherwise it's indexed when it is.
+        with self.duplicates_lock:
+            if self.duplicates is not None:
+                self.duplicates.add(ticket_id, text)
+                self.duplicate_authors[ticket_id] = author_id
+
+    def reset_duplicates(self):
+        # the window moves on: rebuilt on next use, from the tickets open now
+        with self.duplicates_lock:
+            self.duplicates = None
+            self.duplicate_authors = {}
+
+    def find_duplicate(self, message:Message):
+        # find an open ticket from the same sender with a near-identical body,
+        # for repeated requests. a similar message from someone else, like a
+        # shared template or a forwarded notice, is a ticket of its own.
+        if len(minhash.WORD_RE.findall(message.note)) < DUPLICATE_MIN_WORDS:
+            return None
+
+        _, _, addr = self.parse_email_address(message.from_address)
+        sender = self.redmine.find_user(addr)
+        if sender is None:
+            return None # a new sender has no tickets
+
+        duplicates = self.duplicate_index()
+        authors = self.duplicate_authors
+        ticket_id, similarity = duplicates.query(message.note, accept=lambda id: authors.get(id) == sender.id)
+        if ticket_id:
+            log.info(f"message is a near-duplicate of ticket #{ticket_id}, similarity={similarity:.2f}")
+            return self.redmine.get_ticket(ticket_id)
+        return None
+
+    def find_or_create_user(self, message:Message):
+        first, last, addr = self.parse_email_address(message.from_address)
+
         # get user id from from_address
         user = self.redmine.find_user(addr)
         if user == None:
@@ -220,68 +707,231 @@ class Client(): ## imap.Client()
             # create new user
             user = self.redmine.create_user(addr, first, last)
             log.info(f"Unknow user: {addr}, created new account.")
+        return user
+
+    def handle_message(self, msg_id:str, message:Message):
+        first, last, addr = self.parse_email_address(message.from_address)
+        log.debug(f'uid:{msg_id} - from:{last}, {first}, email:{addr}, subject:{message.subject}')
 
-        #  upload any attachments
-        for attachment in message.attachments:
-            # uploading the attachment this way
-            # puts the token in the attachment
-            attachment.upload(self.redmine, user.login)
+        ticket = self.find_ticket(message)
+        user = self.find_or_create_user(message)
+
+        #  upload any attachments, concurrently.
+        # this puts the token in each attachment
+        self.redmine.upload_attachments(user.login, message.attachments)
 
         if ticket:
             # found a ticket, append the message
             self.redmine.append_message(ticket.id, user.login, message.note, message.attachments)
             log.info(f"Updated ticket #{ticket.id} with message from {user.login} and {len(message.attachments)} attachments")
+            # let the bot know, to sync any discord thread for the ticket
+            self.events.publish(store.EventBus.TICKET_UPDATED, ticket.id)
         else:
             # no open tickets, create new ticket for the email message
-            self.redmine.create_ticket(user, message.subject, message.note, message.attachments)
+            ticket = self.redmine.create_ticket(user, message.subject, message.note, message.attachments)
+            self.add_duplicate(ticket.id, user.id, message.note)
             log.info(f"Created new ticket for: {user.login}, with {len(message.attachments)} attachments")
 
 
-    def check_unseen(self):
-        with IMAPClient(host=self.host, port=self.port, ssl=True) as server:
-            server.login(self.user, self.passwd)
-            server.select_folder("INBOX", readonly=False)
-            log.info(f'logged into imap {self.host}')
-
-            messages = server.search("UNSEEN")
-            for uid, message_data in server.fetch(messages, "RFC822").items():
-                data = message_data[b"RFC822"]
+    def ingest(self, msg_id:str, message:Message) -> bool:
+        """handle a message, unless it's already been ingested.
+        the claim is made before any redmine write."""
+        if not self.ingest_log.claim(message.key, self.owner, LEASE_TTL):
+            log.info(f"Message {msg_id} already ingested, skipping: {message.key}")
+            return False
+        try:
+            self.handle_message(msg_id, message)
+            self.ingest_log.complete(message.key)
+            return True
+        except Exception:
+            self.ingest_log.release(message.key)
+            raise
 
-                # process each message returned by the query
+    def check_unseen(self):
+        # only one ingester at a time: overlapping runs would fetch the same UNSEEN messages
+        if not self.ingest_log.acquire_lease("imap", self.owner, LEASE_TTL):
+            log.info("another ingester is running, skipping")
+            return
+
+        try:
+            self.fetch_unseen()
+        finally:
+            self.ingest_log.release_lease("imap", self.owner)
+
+    def fetch_unseen(self):
+        for folder in self.folders:
+            with self.pool.connection(folder) as server:
+                self.fetch_folder(server, folder)
+
+    def fetch_folder(self, server:IMAPClient, folder:str):
+        messages = server.search("UNSEEN")
+        for uid, message_data in server.fetch(messages, "RFC822").items():
+            data = message_data[b"RFC822"]
+            message = None
+
+            # process each message returned by the query
+            try:
+                # keep the lease while working
+                self.ingest_log.acquire_lease("imap", self.owner, LEASE_TTL)
+
+                # decode the message
+                message = self.parse_message(data)
+
+                # hold obvious spam, before it costs any redmine calls
+                if self.check_spam(uid, message, data):
+                    server.add_flags(uid, [SEEN])
+                    continue
+
+                # handle the message, if it's not a duplicate
+                self.ingest(uid, message)
+
+                #  mark msg uid seen and deleted, as per redmine imap.rb
+                server.add_flags(uid, [SEEN, DELETED])
+
+            except Exception as e:
+                log.error(f"Message {uid} can not be processed: {e}")
+                traceback.print_exc()
+                # save the message to be replayed later
+                self.dead_letters.add(hashlib.sha256(data).hexdigest(), str(uid), data, repr(e))
+                server.add_flags(uid, [SEEN])
+            finally:
+                if message:
+                    message.close()
+        log.info(f"processed {len(messages)} new messages in {folder}")
+
+    def check_spam(self, uid, message:Message, data:bytes) -> bool:
+        # score the message locally, and quarantine it if it's spam
+        first, last, addr = self.parse_email_address(message.from_address or "")
+        known_sender = self.redmine.find_user(addr) is not None
+        probability, reasons = self.spam_filter.score(message.headers, addr,
+            f"{message.subject}\n{message.note}", known_sender)
+
+        if probability >= spam.SPAM_THRESHOLD:
+            log.info(f"Message {uid} from {addr} quarantined as spam, p={probability:.3f}: {', '.join(reasons)}")
+            self.spam_filter.stats.quarantine(message.key, str(uid), data, probability, ', '.join(reasons))
+            return True
+        return False
+
+    def release(self, key:str):
+        # a quarantined message that isn't spam: handle it now
+        released = self.spam_filter.stats.release(key)
+        if released is None:
+            log.warning(f"No quarantined message: {key}")
+            return
+        uid, data = released
+        # the sender gets a redmine account, so counts as known from now on.
+        # the ticket itself is trained as ham once it's closed.
+        message = None
+        try:
+            message = self.parse_message(data)
+            self.ingest(uid, message)
+        except Exception as e:
+            # out of quarantine, so saved to be replayed, like any failed message
+            log.error(f"Released message {uid} can not be processed: {e}")
+            self.dead_letters.add(hashlib.sha256(data).hexdigest(), str(uid), data, repr(e))
+        finally:
+            if message:
+                message.close()
+
+    def replay(self, limit:int=REPLAY_BATCH, force:bool=False):
+        """retry failed messages that are due, or all of them with force.
+        runs under its own lease, so it never blocks live ingestion."""
+        if not self.ingest_log.acquire_lease("imap-replay", self.owner, LEASE_TTL):
+            log.info("another replay is running, skipping")
+            return
+
+        replayed = failed = 0
+        try:
+            for key, uid, data, attempts in self.dead_letters.due(limit, force):
+                message = None
                 try:
-                    # decode the message
+                    self.ingest_log.acquire_lease("imap-replay", self.owner, LEASE_TTL)
                     message = self.parse_message(data)
-
-                    # handle the message
-                    self.handle_message(uid, message)
-
-                    #  mark msg uid seen and deleted, as per redmine imap.rb
-                    server.add_flags(uid, [SEEN, DELETED])
-
+                    self.ingest(uid, message)
+                    self.dead_letters.resolve(key)
+                    replayed += 1
                 except Exception as e:
-                    log.error(f"Message {uid} can not be processed: {e}")
-                    traceback.print_exc()
-                    # save the message data in a file
-                    with open(f"message-err-{uid}.eml", "wb") as file:
-                        file.write(data)
-                    server.add_flags(uid, [SEEN])
-            log.info(f"processed {len(messages)} new messages")
+                    log.error(f"Replay of message {uid} failed, attempt {attempts + 1}: {e}")
+                    self.dead_letters.add(key, uid, data, repr(e))
+                    failed += 1
+                finally:
+                    if message:
+                        message.close()
+        finally:
+            self.ingest_log.release_lease("imap-replay", self.owner)
+        log.info(f"replayed {replayed} messages, {failed} failed again")
+
+    def add_dead_letters(self, filenames):
+        # load saved messages, like the old message-err-*.eml files, for replay
+        for filename in filenames:
+            with open(filename, "rb") as file:
+                data = file.read()
+            self.dead_letters.add(hashlib.sha256(data).hexdigest(), os.path.basename(filename), data, "imported")
     
+    def close(self):
+        self.pool.close()
+
     def synchronize(self):
+        try:
+            self.spam_filter.train_from_redmine(self.redmine)
+        except Exception as e:
+            log.error(f"spam filter training failed: {e}")
+        self.events.prune()
         self.check_unseen()
 
+@click.group(invoke_without_command=True)
+@click.pass_context
+def main(ctx):
+    """Check for new email, and manage the messages that failed"""
+    # load credentials
+    load_dotenv()
+
+    if ctx.invoked_subcommand is None:
+        log.info('initializing IMAP threader')
+        # construct the client and run the email check
+        client = Client()
+        client.check_unseen()
+        client.close()
+
+
+@main.command()
+@click.option("--limit", default=REPLAY_BATCH, help="Max messages to replay")
+@click.option("--force", is_flag=True, help="Replay failures that are not due for a retry yet")
+def replay(limit:int, force:bool):
+    """Replay failed messages"""
+    Client().replay(limit, force)
+
+
+@main.command()
+def failures():
+    """List failed messages"""
+    for key, uid, error, attempts, first_failed, last_failed, next_retry in store.DeadLetters().failures():
+        print(f"{uid} attempts={attempts} next_retry={dt.datetime.fromtimestamp(next_retry):%Y-%m-%d %H:%M} {error}")
+
+
+@main.command()
+def quarantine():
+    """List messages quarantined as spam"""
+    for key, uid, score, reasons, received in store.SpamStats().quarantined():
+        print(f"{key} uid={uid} p={score:.3f} {dt.datetime.fromtimestamp(received):%Y-%m-%d %H:%M} {reasons}")
+
+
+@main.command()
+@click.argument("key")
+def release(key:str):
+    """Release a quarantined message, handling it as not spam"""
+    Client().release(key)
+
+
+@main.command()
+@click.argument("files", nargs=-1, type=click.Path(exists=True))
+def add(files):
+    """Add saved .eml files to the failed messages, to be replayed"""
+    Client().add_dead_letters(files)
+
+
 # this behavior mirrors that of threader.py, for now.
 # in the furute, this will run the imap threading, while
 # threader.py will coordinate all the threaders.
 if __name__ == '__main__':
-    log.info('initializing IMAP threader')
-
-    # load credentials 
-    load_dotenv()
-
-    # construct the client and run the email check
-    Client().check_unseen()
-
-    #with open("test_messages/message-126.eml", 'rb') as file:
-    #    message = parse_message(file.read())
-    #    Client().handle_message("126", message)
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import hashlib
+import mmap
+import logging
+import mailbox
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from dotenv import load_dotenv
+
+import imap
+
+# Bulk import of mail archives, mbox files or maildir directories, into redmine
+# tickets. Each message goes through the same parse_message/handle_message path
+# as live IMAP mail, in batches, with a checkpoint saved after every batch so an
+# interrupted import can resume where it stopped.
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+WORKERS = 4
+CHECKPOINT_FILE = "import-checkpoint.json"
+
+# mboxrd escapes "From " at the start of a body line with a ">", and ">From "
+# with another, so the separators can be found. one ">" is removed on read.
+ESCAPED_FROM_RE = re.compile(rb"^>(>*From )", re.MULTILINE)
+
+
+def mbox_messages(path:str, position:int=0):
+    """yield (next_position, data) for each message in an mbox file, starting
+    at byte offset position. The file is memory-mapped, only one message at a
+    time is copied out of the archive."""
+    if os.path.getsize(path) == 0:
+        return
+
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        while position < size:
+            # each message starts with a "From " separator line
+            end = mm.find(b"\nFrom ", position)
+            end = size if end == -1 else end + 1
+            start = position
+            if mm[position:position+5] == b"From ":
+                start = mm.find(b"\n", position, end) + 1
+            if start < end:
+                yield end, unescape_from(mm[start:end])
+            position = end
+
+
+def unescape_from(data:bytes) -> bytes:
+    if b">From " not in data:
+        return data
+    return ESCAPED_FROM_RE.sub(rb"\1", data)
+
+
+def maildir_messages(path:str, position:int=0):
+    """yield (next_position, data) for each message in a maildir, in key order,
+    skipping the first position messages."""
+    box = mailbox.Maildir(path, factory=None, create=False)
+    keys = sorted(box.keys())
+    for i in range(position, len(keys)):
+        yield i + 1, box.get_bytes(keys[i])
+
+
+class Importer():
+    def __init__(self, client:imap.Client, checkpoint_file:str=CHECKPOINT_FILE,
+                 batch_size:int=BATCH_SIZE, workers:int=WORKERS, dry_run:bool=False):
+        self.client = client
+        self.checkpoint_file = checkpoint_file
+        self.batch_size = batch_size
+        self.workers = workers
+        self.dry_run = dry_run
+        self.imported = 0
+        self.failed = 0
+
+    def load_checkpoint(self, source:str) -> int:
+        try:
+            with open(self.checkpoint_file) as file:
+                return json.load(file).get(source, 0)
+        except FileNotFoundError:
+            return 0
+
+    def save_checkpoint(self, source:str, position:int):
+        checkpoints = {}
+        if os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file) as file:
+                checkpoints = json.load(file)
+        checkpoints[source] = position
+
+        # write and rename, so a crash never leaves a partial checkpoint
+        tmp = self.checkpoint_file + ".tmp"
+        with open(tmp, "w") as file:
+            json.dump(checkpoints, file, indent=2)
+        os.replace(tmp, self.checkpoint_file)
+
+    def dead_letter(self, msg_id:str, data:bytes, error:Exception):
+        # saved for replay, like live mail, before the checkpoint moves past it
+        if not self.dry_run:
+            self.client.dead_letters.add(hashlib.sha256(data).hexdigest(), msg_id, data, repr(error))
+
+    def parse(self, msg_id:str, data:bytes):
+        try:
+            return self.client.parse_message(data)
+        except Exception as e:
+            log.error(f"Message {msg_id} can not be parsed: {e}")
+            self.failed += 1
+            self.dead_letter(msg_id, data, e)
+            return None
+
+    def handle_thread(self, items) -> int:
+        # messages with the same subject are handled in order, so replies
+        # find the ticket created by the first message. returns the number handled.
+        handled = 0
+        for msg_id, message, data in items:
+            try:
+                # already-ingested messages are skipped, and count as handled
+                self.client.ingest(msg_id, message)
+                handled += 1
+            except Exception as e:
+                log.error(f"Message {msg_id} can not be processed: {e}")
+                self.dead_letter(msg_id, data, e)
+            finally:
+                message.close()
+        return handled
+
+    def preview(self, msg_id:str, message:imap.Message):
+        ticket = self.client.find_ticket(message)
+        if ticket:
+            log.info(f"[dry-run] {msg_id}: would update ticket #{ticket.id} from {message.from_address}")
+        else:
+            log.info(f"[dry-run] {msg_id}: would create ticket '{message.subject}' from {message.from_address}")
+        self.imported += 1
+
+    def import_batch(self, batch):
+        messages = []
+        for msg_id, data in batch:
+            message = self.parse(msg_id, data)
+            if message:
+                messages.append((msg_id, message, data))
+
+        if self.dry_run:
+            for msg_id, message, _ in messages:
+                self.preview(msg_id, message)
+                message.close()
+            return
+
+        # create unknown senders up front, one at a time, so concurrent
+        # handlers don't race to create the same account
+        senders = {}
+        for msg_id, message, _ in messages:
+            senders.setdefault(message.from_address, message)
+        for message in senders.values():
+            try:
+                self.client.find_or_create_user(message)
+            except Exception as e:
+                log.error(f"Unable to find or create user for {message.from_address}: {e}")
+
+        threads = {}
+        for msg_id, message, data in messages:
+            threads.setdefault(message.subject_cleaned(), []).append((msg_id, message, data))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            handled = sum(executor.map(self.handle_thread, threads.values()))
+        self.imported += handled
+        self.failed += len(messages) - handled
+
+    def run(self, path:str, restart:bool=False):
+        source = os.path.abspath(path)
+        position = 0 if restart else self.load_checkpoint(source)
+        if position:
+            log.info(f"resuming import of {source} at {position}")
+
+        if os.path.isdir(path):
+            messages = maildir_messages(path, position)
+        else:
+            messages = mbox_messages(path, position)
+
+        start = time.time()
+        batch = []
+        for next_position, data in messages:
+            batch.append((f"{os.path.basename(path)}:{position}", data))
+            position = next_position
+            if len(batch) >= self.batch_size:
+                self.import_batch(batch)
+                batch = []
+                if not self.dry_run:
+                    self.save_checkpoint(source, position)
+                log.info(f"{self.imported} imported, {self.failed} failed, {time.time() - start:.1f} sec")
+
+        if batch:
+            self.import_batch(batch)
+            if not self.dry_run:
+                self.save_checkpoint(source, position)
+
+        log.info(f"import of {source} complete: {self.imported} imported, {self.failed} failed, {time.time() - start:.1f} sec")
+
+
+@click.command()
+@click.argument("path", type=click.Path(exists=True))
+@click.option("--batch-size", default=BATCH_SIZE, help="Messages per batch, and per checkpoint")
+@click.option("--workers", default=WORKERS, help="Concurrent message handlers")
+@click.option("--checkpoint", default=CHECKPOINT_FILE, help="File to store resume positions in")
+@click.option("--dry-run", is_flag=True, help="Parse and match messages, without changing redmine")
+@click.option("--restart", is_flag=True, help="Ignore any saved checkpoint for PATH")
+def main(path:str, batch_size:int, workers:int, checkpoint:str, dry_run:bool, restart:bool):
+    """Import an mbox file or maildir directory as tickets"""
+    logging.basicConfig(level=logging.INFO,
+        format="{asctime} {levelname:<8s} {name:<16} {message}", style='{')
+    load_dotenv()
+
+    importer = Importer(imap.Client(), checkpoint, batch_size, workers, dry_run)
+    importer.run(path, restart)
+
+
+if __name__ == '__main__':
+    main()
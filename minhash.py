@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import re
+import random
+import logging
+
+# MinHash signatures with LSH banding, to find texts that are near-duplicates
+# of ones already indexed without comparing against each of them.
+# see https://en.wikipedia.org/wiki/MinHash and chapter 3 of http://www.mmds.org/
+
+log = logging.getLogger(__name__)
+
+NUM_PERM = 64 # hash functions per signature
+BANDS = 16 # LSH bands, of NUM_PERM / BANDS rows each
+SHINGLE_SIZE = 3 # words per shingle
+THRESHOLD = 0.7 # estimated jaccard similarity to count as a duplicate
+SEED = 1234
+MASK64 = (1 << 64) - 1
+
+WORD_RE = re.compile(r"\w+")
+
+
+def shingles(text:str, size:int=SHINGLE_SIZE) -> set:
+    words = WORD_RE.findall(text.lower())
+    if len(words) <= size:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i+size]) for i in range(len(words) - size + 1)}
+
+
+class MinHashIndex():
+    """In-memory LSH index of MinHash signatures. Signatures use the
+    per-process str hash, so they aren't meant to be persisted."""
+    def __init__(self, num_perm:int=NUM_PERM, bands:int=BANDS, threshold:float=THRESHOLD):
+        rng = random.Random(SEED)
+        # xor with a random mask permutes the hash space: one cheap "hash function" per mask
+        self.masks = [rng.getrandbits(64) for _ in range(num_perm)]
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.buckets = [{} for _ in range(bands)] # band -> {band values: set of ids}
+        self.signatures = {}
+
+    def signature(self, text:str):
+        hashes = [hash(shingle) & MASK64 for shingle in shingles(text)]
+        if not hashes:
+            return None
+        return tuple(min(h ^ mask for h in hashes) for mask in self.masks)
+
+    def band_keys(self, signature):
+        rows = self.rows
+        return [signature[i*rows:(i+1)*rows] for i in range(self.bands)]
+
+    def add(self, key, text:str):
+        signature = self.signature(text)
+        if signature is None:
+            return
+        self.remove(key)
+        self.signatures[key] = signature
+        for band, band_key in zip(self.buckets, self.band_keys(signature)):
+            band.setdefault(band_key, set()).add(key)
+
+    def remove(self, key):
+        signature = self.signatures.pop(key, None)
+        if signature:
+            for band, band_key in zip(self.buckets, self.band_keys(signature)):
+                band.get(band_key, set()).discard(key)
+
+    def similarity(self, sig1, sig2) -> float:
+        return sum(1 for a, b in zip(sig1, sig2) if a == b) / len(sig1)
+
+    def query(self, text:str, accept=None):
+        """the most similar indexed key and its estimated similarity, if above
+        the threshold, or (None, 0.0). if given, only keys where accept(key)
+        is true are considered."""
+        signature = self.signature(text)
+        if signature is None:
+            return None, 0.0
+
+        candidates = set()
+        for band, band_key in zip(self.buckets, self.band_keys(signature)):
+            candidates.update(band.get(band_key, ()))
+
+        best, best_similarity = None, 0.0
+        for key in candidates:
+            if accept is not None and not accept(key):
+                continue
+            similarity = self.similarity(signature, self.signatures[key])
+            if similarity > best_similarity:
+                best, best_similarity = key, similarity
+
+        if best_similarity >= self.threshold:
+            return best, best_similarity
+        return None, best_similarity
+
+    def __len__(self):
+        return len(self.signatures)
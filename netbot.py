@@ -3,15 +3,19 @@
 import os
 import re
 import logging
-import datetime as dt
+import asyncio
+import tempfile
+from types import SimpleNamespace
 
 import discord
 import redmine
+import store
+import prefix
 
 
 from dotenv import load_dotenv
 
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 
 def setup_logging():
@@ -29,6 +33,14 @@ log = logging.getLogger(__name__)
 
 log.info('initializing bot')
 
+UPLOAD_LIMIT = 4 # attachments streamed to redmine at once
+DEFAULT_FILESIZE_LIMIT = 25 * 1024 * 1024 # discord's limit, when the guild's isn't known
+SPOOL_MAX_SIZE = 1024 * 1024 # mirrored attachments larger than this are spooled to disk
+EVENT_POLL_INTERVAL = 5 # seconds between checks for tickets updated by the other netbot processes
+EVENT_SUBSCRIBER = "netbot"
+EVENT_RETRIES = 5 # failed syncs of a ticket, re-queued each time, before it's given up
+THREAD_URL_RE = re.compile(r"https://discord(?:app)?\.com/channels/\d+/(\d+)")
+
 class NetBot(commands.Bot):
     def __init__(self, redmine: redmine.Client):
         log.info(f'initializing {self}')
@@ -36,6 +48,19 @@ class NetBot(commands.Bot):
         intents.message_content = True
 
         self.redmine = redmine
+        self.upload_semaphore = asyncio.Semaphore(UPLOAD_LIMIT)
+        self.mirrored = store.MirroredAttachments()
+        self.events = store.EventBus()
+        self.events.subscribe(EVENT_SUBSCRIBER)
+        self.routes = store.ThreadRoutes()
+        self.thread_tickets = self.routes.load() # thread id -> ticket id
+        self.ticket_threads = {ticket_id: thread_id for thread_id, ticket_id in self.thread_tickets.items()}
+        self.routes_rebuilt = False
+        self.unrouted_threads = set() # threads whose titles aren't for a ticket, so aren't checked again
+        self.event_retries = {} # ticket id -> failed syncs, for re-queued events
+        self.sync_state = store.SyncState()
+        self.pending_sync = {} # thread id -> (ticket id, last message id, last journal id), not saved yet
+        self.recent_tickets = prefix.RecentTickets() # for autocomplete
         #guilds = os.getenv('DISCORD_GUILDS').split(', ')
         #if guilds:
         #    log.info(f"setting guilds: {guilds}")
@@ -55,7 +80,72 @@ class NetBot(commands.Bot):
 
     async def on_ready(self):
         log.info(f"Logged in as {self.user} (ID: {self.user.id})")
+        if not self.poll_events.is_running():
+            self.poll_events.start()
         
+    @tasks.loop(seconds=EVENT_POLL_INTERVAL)
+    async def poll_events(self):
+        if not self.routes_rebuilt:
+            # once, retried until redmine can be reached
+            try:
+                await self.rebuild_routes()
+                self.routes_rebuilt = True
+            except Exception:
+                log.exception("unable to rebuild thread routes, will retry")
+        # an error here would stop the loop, so it's logged and retried next time
+        try:
+            await self.handle_events()
+        except Exception:
+            log.exception("unable to handle ticket events, will retry")
+
+    async def handle_events(self):
+        # tickets updated elsewhere, like by email, are synced to their threads right away
+        events = await asyncio.to_thread(self.events.poll, EVENT_SUBSCRIBER)
+        if not events:
+            return
+
+        ticket_ids = dict.fromkeys(ticket_id for _, topic, ticket_id in events if topic == store.EventBus.TICKET_UPDATED)
+        failed = []
+        for ticket_id in ticket_ids:
+            try:
+                await self.sync_ticket_thread(ticket_id)
+                self.event_retries.pop(ticket_id, None)
+            except Exception:
+                log.exception(f"unable to sync ticket {ticket_id}")
+                retries = self.event_retries.get(ticket_id, 0) + 1
+                if retries < EVENT_RETRIES:
+                    self.event_retries[ticket_id] = retries
+                    failed.append(ticket_id)
+                else:
+                    log.error(f"giving up on syncing ticket {ticket_id} after {retries} attempts")
+                    self.event_retries.pop(ticket_id, None)
+        self.flush_sync_state()
+        # failed syncs are queued again, behind newer events, so they don't
+        # hold up the tickets after them
+        for ticket_id in failed:
+            self.events.publish(store.EventBus.TICKET_UPDATED, ticket_id)
+        self.events.ack(EVENT_SUBSCRIBER, events[-1][0])
+
+    def find_thread_id(self, ticket) -> int:
+        # the thread's url is noted on the ticket when the thread is created
+        for journal in reversed(getattr(ticket, 'journals', [])):
+            match = THREAD_URL_RE.search(journal.notes or "")
+            if match:
+                return int(match.group(1))
+        return None
+
+    async def sync_ticket_thread(self, ticket_id: int):
+        # most changed tickets have no thread: dropped without asking redmine.
+        # every synced thread is routed, by rebuild_routes for older ones.
+        thread_id = self.ticket_threads.get(ticket_id)
+        if thread_id is None:
+            return # no thread to sync
+        ticket = await asyncio.to_thread(self.redmine.get_ticket, ticket_id, True)
+        if ticket is None:
+            return
+        thread = self.get_channel(thread_id) or await self.fetch_channel(thread_id)
+        await self.synchronize_ticket(ticket, thread, flush=False)
+
     async def on_guild_join(self, guild):
         log.info(f"Joined guild: {guild}, id={guild.id}")
 
@@ -64,6 +154,31 @@ class NetBot(commands.Bot):
         log.info(f"Joined thread: {thread}")
         
 
+    def register_thread(self, thread_id: int, ticket_id: int):
+        """route messages in the thread to the ticket"""
+        self.thread_tickets[thread_id] = ticket_id
+        self.ticket_threads[ticket_id] = thread_id
+        self.unrouted_threads.discard(thread_id)
+        self.routes.add(thread_id, ticket_id)
+
+    def unregister_thread(self, thread_id: int):
+        ticket_id = self.thread_tickets.pop(thread_id, None)
+        if self.ticket_threads.get(ticket_id) == thread_id:
+            del self.ticket_threads[ticket_id]
+        self.routes.remove(thread_id)
+
+    async def rebuild_routes(self):
+        # find the threads of synced tickets that aren't routed, from the thread urls in their notes
+        tickets = await asyncio.to_thread(self.redmine.discord_tickets) or []
+        for ticket in tickets:
+            if ticket.id in self.ticket_threads:
+                continue
+            ticket = await asyncio.to_thread(self.redmine.get_ticket, ticket.id, True)
+            thread_id = self.find_thread_id(ticket) if ticket else None
+            if thread_id:
+                self.register_thread(thread_id, ticket.id)
+        log.info(f"routing {len(self.thread_tickets)} threads to tickets")
+
     def parse_thread_title(self, title: str) -> int:
         match = re.match(r'^Ticket #(\d+):', title)
         if match:
@@ -74,13 +189,22 @@ class NetBot(commands.Bot):
         # Make sure we won't be replying to ourselves.
         # if message.author.id == bot.user.id:
         #    return
-        if isinstance(message.channel, discord.Thread):
-            # get the ticket id from the thread name
-            ticket_id = self.parse_thread_title(message.channel.name)
-            
+        if not isinstance(message.channel, discord.Thread):
+            return # only threads are synced
+        # only threads synced with a ticket are routed, by id, so renaming a thread is fine
+        ticket_id = self.thread_tickets.get(message.channel.id)
+        if ticket_id is None and message.channel.id not in self.unrouted_threads:
+            # threads synced before routing was kept, and not found by
+            # rebuild_routes, are known by their title. checked once per thread.
+            ticket_id = self.parse_thread_title(message.channel.name or "")
             if ticket_id:
-                await self.sync_new_message(ticket_id, message)
-            # else just a normal thread, do nothing
+                log.info(f"routing thread {message.channel.id} to ticket {ticket_id}, from its title")
+                self.register_thread(message.channel.id, ticket_id)
+            else:
+                self.unrouted_threads.add(message.channel.id)
+        if ticket_id:
+            await self.sync_new_message(ticket_id, message)
+        # else not a ticket thread, do nothing
 
 
     async def sync_new_message(self, ticket_id: int, message: discord.Message):
@@ -89,7 +213,12 @@ class NetBot(commands.Bot):
         # double-check that self.id <> author.id?
         user = self.redmine.find_discord_user(message.author.name)
         if user:
-            self.redmine.append_message(ticket_id, user.login, message.content)
+            uploads = await self.upload_attachments(user.login, message)
+            journal = await asyncio.to_thread(self.redmine.append_message, ticket_id, user.login, message.content, uploads,
+                return_journal=True)
+            # so the next sync passes over them, rather than relaying them again
+            self.sync_state.add_relayed(message.channel.id, store.SyncState.MESSAGE, message.id)
+            self.record_appended(message.channel.id, ticket_id, journal)
             log.debug(
                 f"SYNCED: ticket={ticket_id}, user={user.login}, msg={message.content}")
         else:
@@ -97,43 +226,155 @@ class NetBot(commands.Bot):
                 f"sync_new_message - unknown discord user: {message.author.name}, skipping message")
 
 
-    async def synchronize_ticket(self, ticket, thread, ctx: discord.ApplicationContext):
-        last_sync = self.redmine.get_field(ticket, "sync")
-        log.debug(f"ticket {ticket.id} last sync: {last_sync}, age: {self.redmine.get_field(ticket, 'age')}")
-
-        # start of the process, will become "last update"
-        timestamp = dt.datetime.now(dt.timezone.utc)  # UTC
-
-        notes = self.redmine.get_notes_since(ticket.id, last_sync)
+    def record_appended(self, thread_id: int, ticket_id: int, journal):
+        """the note, and any files, the bot added to the ticket for a message
+        aren't relayed back to the thread it came from"""
+        if journal:
+            self.sync_state.add_relayed(thread_id, store.SyncState.JOURNAL, journal.id)
+            for attachment_id in self.redmine.journal_attachment_ids(journal):
+                self.mirrored.add(attachment_id, ticket_id)
+
+
+    async def upload_attachments(self, user_login: str, message: discord.Message) -> list:
+        """stream the files attached to a message from discord to redmine,
+        returning the uploads to add to the note"""
+        async def upload(attachment: discord.Attachment):
+            content_type = attachment.content_type or "application/octet-stream"
+            token = None
+            try:
+                async with self.upload_semaphore:
+                    # requests blocks, so stream on a worker thread
+                    token = await asyncio.to_thread(self.redmine.upload_url, user_login,
+                        attachment.url, attachment.size, attachment.filename, content_type)
+            except Exception:
+                # one failed file doesn't lose the message, or the others
+                log.exception(f"error uploading {attachment.filename} from message {message.id}")
+            return SimpleNamespace(name=attachment.filename, content_type=content_type, token=token)
+
+        uploads = await asyncio.gather(*(upload(attachment) for attachment in message.attachments))
+        for failed in [u for u in uploads if u.token is None]:
+            log.warning(f"unable to upload {failed.name} from message {message.id}, skipping it")
+        return [u for u in uploads if u.token]
+
+
+    async def mirror_attachments(self, ticket, thread: discord.Thread):
+        """post the ticket's attachments that haven't been mirrored to the thread.
+        files over discord's size limit are linked instead."""
+        attachments = await asyncio.to_thread(self.redmine.get_attachments, ticket.id)
+        mirrored = self.mirrored.mirrored(ticket.id)
+        limit = thread.guild.filesize_limit if thread.guild else DEFAULT_FILESIZE_LIMIT
+
+        for attachment in attachments:
+            if attachment.id in mirrored:
+                continue
+            header = f"> **{attachment.author.name}** attached *{attachment.filename}*"
+            if attachment.filesize > limit:
+                await thread.send(f"{header}\n{attachment.content_url}")
+            else:
+                with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as file:
+                    await asyncio.to_thread(self.redmine.download_attachment, attachment, file)
+                    await thread.send(header, file=discord.File(file, filename=attachment.filename))
+            self.mirrored.add(attachment.id, ticket.id)
+            log.debug(f"mirrored attachment {attachment.id} {attachment.filename} to {thread.name}")
+
+
+    async def synchronize_ticket(self, ticket, thread, flush: bool = True, progress=None):
+        """relay new notes to the thread, and new thread messages to the ticket,
+        from where the last sync stopped. with flush=False, the sync state is
+        saved by the next flush_sync_state(). progress(text), if given, is
+        awaited as each note and message is relayed, like Responder.update."""
+        saved = (ticket.id, *self.sync_state.get(thread.id))
+        synced = self.pending_sync.get(thread.id, saved)
+        if synced[1:] == (None, None):
+            # never synced by id: carry on from the timestamp kept by earlier versions
+            synced = (ticket.id, *await self.legacy_sync_state(ticket))
+        _, last_message_id, last_journal_id = synced
+        log.debug(f"ticket {ticket.id} last synced message: {last_message_id}, journal: {last_journal_id}")
+        self.recent_tickets.add([ticket])
+
+        # the messages and notes the bot relayed itself, as they were sent
+        relayed_messages = self.sync_state.relayed(thread.id, store.SyncState.MESSAGE)
+        relayed_journals = self.sync_state.relayed(thread.id, store.SyncState.JOURNAL)
+
+        notes = await asyncio.to_thread(self.redmine.get_notes_after, ticket.id, last_journal_id)
         log.info(f"syncing {len(notes)} notes from {ticket.id} --> {thread.name}")
 
+        sent = count = 0
+        async def report():
+            if progress:
+                await progress(f"syncing ticket {ticket.id}: {sent} of {len(notes)} notes, {count} messages relayed")
+
         for note in notes:
-            msg = f"> **{note.user.name}** at *{note.created_on}*\n\n{note.notes}\n"
-            await thread.send(msg)
+            if note.id not in relayed_journals:
+                msg = f"> **{note.user.name}** at *{note.created_on}*\n\n{note.notes}\n"
+                await thread.send(msg)
+                sent += 1
+                await report()
+            last_journal_id = note.id
 
-        # query discord for updates to thread since last-update
+        await self.mirror_attachments(ticket, thread)
+
+        # query discord for messages after the last one synced. snowflake ids are
+        # ordered, so this is exact, unlike a timestamp.
         # see https://docs.pycord.dev/en/stable/api/models.html#discord.Thread.history
-        log.debug("calling history with thread={thread}, after={last_sync}")
-        #messages = await thread.history(after=last_sync, oldest_first=True).flatten()
-        async for message in thread.history(after=last_sync, oldest_first=True):
-            # ignore bot messages!
-            if message.author.id != self.user.id:
+        after = discord.Object(id=last_message_id) if last_message_id else None
+        async for message in thread.history(limit=None, after=after, oldest_first=True):
+            last_message_id = message.id
+            # ignore bot messages, and messages already relayed
+            if message.author.id != self.user.id and message.id not in relayed_messages:
                 # for each, create a note with translated discord user id with the update (or one big one?)
                 user = self.redmine.find_discord_user(message.author.name)
 
                 if user:
                     log.debug(f"SYNC: ticket={ticket.id}, user={user.login}, msg={message.content}")
-                    self.redmine.append_message(ticket.id, user.login, message.content)
+                    uploads = await self.upload_attachments(user.login, message)
+                    journal = await asyncio.to_thread(self.redmine.append_message, ticket.id, user.login, message.content, uploads,
+                        return_journal=True)
+                    self.record_appended(thread.id, ticket.id, journal)
+                    count += 1
+                    await report()
                 else:
                     log.warning(
                         f"synchronize_ticket - unknown discord user: {message.author.name}, skipping message")
-        else:
-            log.debug(f"No new discord messages found since {last_sync}")
-
-        # update the SYNC timestamp
-        self.redmine.update_syncdata(ticket.id, timestamp)
+        log.debug(f"synced {count} discord messages after {after}")
+
+        # only saved when something changed
+        state = (ticket.id, last_message_id, last_journal_id)
+        if state != saved:
+            self.pending_sync[thread.id] = state
+        if flush:
+            self.flush_sync_state()
         log.info(f"completed sync for {ticket.id} <--> {thread.name}")
-        
+
+    async def legacy_sync_state(self, ticket):
+        """(last_message_id, last_journal_id) from the sync timestamp earlier
+        versions kept on the ticket, or (None, None) for a ticket never synced"""
+        synced = self.redmine.get_field(ticket, "sync")
+        if not synced or synced.timestamp() <= 0:
+            return None, None
+
+        # the messages after the timestamp, by the snowflake for that time
+        last_message_id = discord.utils.time_snowflake(synced, high=True)
+
+        # and the notes after it. timestamps formatted as by redmine compare as strings
+        timestr = synced.strftime("%Y-%m-%dT%H:%M:%SZ")
+        journals = getattr(ticket, 'journals', None)
+        if journals is None:
+            full = await asyncio.to_thread(self.redmine.get_ticket, ticket.id, True)
+            journals = full.journals if full else []
+        last_journal_id = None
+        for journal in journals:
+            if journal.created_on <= timestr:
+                last_journal_id = max(journal.id, last_journal_id or 0)
+
+        log.info(f"upgrading ticket {ticket.id} sync from {timestr}: message {last_message_id}, journal {last_journal_id}")
+        return last_message_id, last_journal_id
+
+    def flush_sync_state(self):
+        if self.pending_sync:
+            pending, self.pending_sync = self.pending_sync, {}
+            self.sync_state.save(pending)
+
     async def on_application_command_error(self, ctx: discord.ApplicationContext, error: discord.DiscordException):
         """Bot-level error handler"""
         if isinstance(error, commands.CommandOnCooldown):
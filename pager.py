@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import math
+import asyncio
+import logging
+
+import discord
+
+# Long listings, like tickets and teams, shown a page at a time with buttons.
+# Pages are fetched when they're viewed, so only the rows shown are queried.
+
+log = logging.getLogger(__name__)
+
+PAGE_SIZE = 10 # rows per page
+VIEW_TIMEOUT = 600 # seconds the buttons keep working
+MAX_MESSAGE = 2000 # discord's message limit
+
+
+class PageView(discord.ui.View):
+    """Previous and next buttons over pages of rows.
+
+    fetch_page(offset, limit) returns (rows, total), and is run on a worker
+    thread as it's expected to query redmine. format_page(rows) returns the
+    text for a page of rows."""
+    def __init__(self, fetch_page, format_page, page_size:int=PAGE_SIZE, empty:str="Nothing found."):
+        super().__init__(timeout=VIEW_TIMEOUT)
+        self.fetch_page = fetch_page
+        self.format_page = format_page
+        self.page_size = page_size
+        self.empty = empty
+        self.page = 0
+        self.total = 0
+        self.pages = {} # page number -> text, for pages already viewed
+        self.responder = None # that sent the buttons, to edit them when they time out
+
+    def page_count(self) -> int:
+        return max(1, math.ceil(self.total / self.page_size))
+
+    async def render(self) -> str:
+        if self.page not in self.pages:
+            rows, self.total = await asyncio.to_thread(self.fetch_page, self.page * self.page_size, self.page_size)
+            if rows:
+                self.pages[self.page] = self.format_page(rows)
+            else:
+                self.pages[self.page] = self.empty
+
+        self.previous.disabled = self.page == 0
+        self.next.disabled = self.page + 1 >= self.page_count()
+
+        text = self.pages[self.page]
+        if self.page_count() > 1:
+            footer = f"\n*page {self.page + 1} of {self.page_count()}, {self.total} total*"
+            text = text[:MAX_MESSAGE - len(footer)] + footer
+        return text[:MAX_MESSAGE]
+
+    async def start(self, responder):
+        """send the first page, with buttons if there's more than one"""
+        text = await self.render()
+        if self.page_count() > 1:
+            self.responder = responder
+            await responder.send(text, view=self)
+        else:
+            await responder.send(text)
+
+    async def on_timeout(self):
+        # shown disabled, rather than failing when clicked
+        self.disable_all_items()
+        if self.responder:
+            try:
+                await self.responder.edit(view=self)
+            except Exception as e:
+                log.warning(f"unable to disable page buttons: {e}")
+
+    async def show(self, interaction:discord.Interaction):
+        text = await self.render()
+        await interaction.response.edit_message(content=text, view=self)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous(self, button:discord.ui.Button, interaction:discord.Interaction):
+        self.page = max(0, self.page - 1)
+        await self.show(interaction)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next(self, button:discord.ui.Button, interaction:discord.Interaction):
+        self.page = min(self.page + 1, self.page_count() - 1)
+        await self.show(interaction)
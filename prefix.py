@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+
+# In-memory prefix indexes, for slash command autocomplete that answers
+# without a round trip to redmine.
+
+log = logging.getLogger(__name__)
+
+MAX_RESULTS = 25 # discord shows at most 25 autocomplete choices
+RECENT_TICKETS = 200 # tickets remembered for autocomplete
+
+
+class PrefixIndex():
+    """Keys kept sorted, case-insensitive, so all the keys starting with a
+    prefix are found with a binary search and a short scan."""
+    def __init__(self, entries=()):
+        # entries are (key, value) pairs, or plain keys that are their own values
+        pairs = [entry if isinstance(entry, tuple) else (entry, entry) for entry in entries]
+        pairs.sort(key=lambda pair: pair[0].lower())
+        self.keys = [key.lower() for key, _ in pairs]
+        self.values = [value for _, value in pairs]
+
+    def search(self, prefix:str, limit:int=MAX_RESULTS) -> list:
+        """values with keys starting with the prefix, in key order, without duplicates"""
+        prefix = prefix.lower()
+        results = []
+        i = bisect.bisect_left(self.keys, prefix)
+        while i < len(self.keys) and self.keys[i].startswith(prefix) and len(results) < limit:
+            if self.values[i] not in results:
+                results.append(self.values[i])
+            i += 1
+        return results
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class RecentTickets():
+    """The tickets most recently shown or updated, indexed by id and subject"""
+    def __init__(self, size:int=RECENT_TICKETS):
+        self.size = size
+        self.tickets = OrderedDict() # ticket id -> subject, most recent last
+        self.lock = threading.Lock()
+        self.index = None # rebuilt when needed
+
+    def add(self, tickets):
+        with self.lock:
+            for ticket in tickets:
+                if ticket is None:
+                    continue
+                self.tickets.pop(ticket.id, None)
+                self.tickets[ticket.id] = ticket.subject
+            while len(self.tickets) > self.size:
+                self.tickets.popitem(last=False)
+            self.index = None
+        return tickets
+
+    def search(self, prefix:str, limit:int=MAX_RESULTS) -> list:
+        """(ticket id, subject) for tickets with an id or subject starting with the prefix"""
+        with self.lock:
+            if self.index is None:
+                entries = []
+                for ticket_id, subject in self.tickets.items():
+                    entries.append((str(ticket_id), (ticket_id, subject)))
+                    entries.append((subject, (ticket_id, subject)))
+                self.index = PrefixIndex(entries)
+            index = self.index
+        return index.search(prefix.lstrip('#'), limit)
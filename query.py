@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+import re
+import logging
+import datetime as dt
+import urllib.parse
+
+# The /tickets query language. A query like
+#
+#   team:infra status:open prio>=high sort:-age
+#
+# is compiled once into redmine filters, for the terms redmine can evaluate,
+# and local predicates over the fetched tickets for the rest. Bare words are
+# as before: "me", ticket numbers, team or user names, or search terms. Words
+# that look like terms but have no known key, like "10:30", are searched for.
+
+log = logging.getLogger(__name__)
+
+PRIORITIES = ["low", "normal", "high", "urgent", "immediate"] # lowest first
+MAX_LOCAL = 500 # tickets fetched to filter or sort locally
+FETCH_PAGE = 100 # tickets per redmine request, when fetching to filter locally
+
+TERM_RE = re.compile(r"^(\w+)(>=|<=|!=|:|=|>|<)(.+)$")
+DURATION_RE = re.compile(r"^(\d+)([hdw])$")
+DURATION_UNITS = {"h": "hours", "d": "days", "w": "weeks"}
+
+# key aliases
+KEYS = {
+    "team": "assigned",
+    "user": "assigned",
+    "assigned": "assigned",
+    "to": "assigned",
+    "status": "status",
+    "prio": "priority",
+    "priority": "priority",
+    "age": "age",
+    "tracker": "tracker",
+    "subject": "subject",
+    "sort": "sort",
+}
+
+# sort name -> (redmine sort column, local key, reversed)
+SORTS = {
+    "id": ("id", lambda t: t.id, False),
+    "prio": ("priority", lambda t: priority_rank(t.priority.name), False),
+    "priority": ("priority", lambda t: priority_rank(t.priority.name), False),
+    "status": ("status", lambda t: t.status.id, False),
+    "updated": ("updated_on", lambda t: t.updated_on, False),
+    "created": ("created_on", lambda t: t.created_on, False),
+    "subject": ("subject", lambda t: t.subject.lower(), False),
+    "age": ("updated_on", lambda t: t.updated_on, True), # youngest first
+}
+
+
+class QueryError(ValueError):
+    """a query that can't be compiled, with a message for the user"""
+
+
+def priority_rank(name:str) -> int:
+    try:
+        return PRIORITIES.index(name.lower())
+    except ValueError:
+        raise QueryError(f"unknown priority: {name}, expected one of {', '.join(PRIORITIES)}")
+
+
+def parse_duration(value:str) -> dt.timedelta:
+    match = DURATION_RE.match(value.lower())
+    if match is None:
+        raise QueryError(f"unknown duration: {value}, expected a number of hours, days or weeks, like 3d")
+    return dt.timedelta(**{DURATION_UNITS[match.group(2)]: int(match.group(1))})
+
+
+def timestamp(when:dt.datetime) -> str:
+    # as formatted by redmine: 2023-11-19T20:42:09Z
+    return when.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def compare(op:str, left, right) -> bool:
+    match op:
+        case ":" | "=":
+            return left == right
+        case "!=":
+            return left != right
+        case ">":
+            return left > right
+        case ">=":
+            return left >= right
+        case "<":
+            return left < right
+        case "<=":
+            return left <= right
+
+
+def sort_key(key, reverse:bool):
+    """a sort key, with tickets that don't have the value, like ones with an
+    unknown priority, sorted last whichever way the sort goes"""
+    present, missing = (1, (0,)) if reverse else (0, (1,))
+    def keyed(ticket):
+        try:
+            return (present, key(ticket))
+        except (AttributeError, ValueError):
+            return missing
+    return keyed
+
+
+class Predicate():
+    """A test on a ticket, evaluated locally, and the equivalent redmine
+    filter if there is one."""
+    def __init__(self, test, push:str=None):
+        self.test = test
+        self.push = push
+
+    def __call__(self, ticket) -> bool:
+        try:
+            return self.test(ticket)
+        except (AttributeError, QueryError):
+            return False # unassigned, an unknown priority, and the like
+
+
+class Query():
+    """A compiled query. fetch_page(offset, limit) returns (tickets, total),
+    for PageView."""
+    def __init__(self, redmine, user=None):
+        self.redmine = redmine
+        self.user = user # redmine user running the query, for "me"
+        self.login = None # user to run the redmine queries as, when they're about "me"
+        self.predicates = []
+        self.ids = []
+        self.terms = [] # search words
+        self.has_status = False
+        self.sorts = [] # sort names, "-" prefix for reversed
+        self.results = None # tickets fetched and evaluated locally
+
+    def filters(self) -> str:
+        filters = [predicate.push for predicate in self.predicates if predicate.push]
+        if not self.has_status:
+            # a ticket asked for by number is shown whatever its status
+            filters.append("status_id=*" if self.ids else "status_id=open")
+        return "&".join(filters)
+
+    def sort(self) -> str:
+        columns = []
+        for name in self.sorts:
+            column, _, reverse = SORTS[name.lstrip('-')]
+            if name.startswith('-'):
+                reverse = not reverse
+            columns.append(f"{column}:desc" if reverse else column)
+        return ",".join(columns)
+
+    def is_pushed(self) -> bool:
+        """if redmine can evaluate the whole query, and page the results"""
+        return not self.terms and all(predicate.push for predicate in self.predicates)
+
+    def fetch_page(self, offset:int, limit:int):
+        if self.is_pushed():
+            return self.redmine.ticket_page(self.filters(), offset, limit, self.login, self.sort() or None)
+
+        if self.results is None:
+            self.results = self.evaluate(self.fetch_all())
+        return self.results[offset:offset + limit], len(self.results)
+
+    def fetch_all(self) -> list:
+        # search ignores filters, so everything is evaluated locally
+        if self.terms:
+            tickets, _ = self.redmine.search_page(" ".join(self.terms), 0, MAX_LOCAL)
+            return tickets
+
+        tickets = []
+        while len(tickets) < MAX_LOCAL:
+            page, total = self.redmine.ticket_page(self.filters(), len(tickets), FETCH_PAGE, self.login, self.sort() or None)
+            tickets.extend(page)
+            if len(page) == 0 or len(tickets) >= total:
+                break
+        if len(tickets) >= MAX_LOCAL:
+            log.info(f"query limited to {MAX_LOCAL} tickets")
+        return tickets
+
+    def evaluate(self, tickets:list) -> list:
+        tickets = [ticket for ticket in tickets if ticket is not None and all(p(ticket) for p in self.predicates)]
+        if self.terms:
+            # search results aren't sorted by redmine. sorts are applied last
+            # to first, each keyed once per ticket, so the first sort wins.
+            for name in reversed(self.sorts or ["-prio"]):
+                _, key, reverse = SORTS[name.lstrip('-')]
+                if name.startswith('-'):
+                    reverse = not reverse
+                tickets.sort(key=sort_key(key, reverse), reverse=reverse)
+        return tickets
+
+
+def compile_query(text:str, redmine, user=None, now:dt.datetime=None) -> Query:
+    """compile the /tickets params into a Query, or raise QueryError"""
+    now = now or dt.datetime.now(dt.timezone.utc)
+    query = Query(redmine, user)
+    words = text.split()
+
+    if not words:
+        words = ["me"]
+
+    for word in words:
+        match = TERM_RE.match(word)
+        if match is None:
+            compile_word(query, word)
+            continue
+
+        key, op, value = match.groups()
+        if key.lower() not in KEYS:
+            # not a term, like a time "10:30" or "a=b": searched for as is
+            query.terms.append(word)
+            continue
+        key = KEYS[key.lower()]
+
+        match key:
+            case "sort":
+                for name in value.lower().split(','):
+                    if name.lstrip('-') not in SORTS:
+                        raise QueryError(f"unknown sort: {name}, expected one of {', '.join(SORTS)}")
+                    query.sorts.append(name)
+            case "assigned":
+                query.predicates.append(assigned_predicate(query, op, value))
+            case "status":
+                query.has_status = True
+                query.predicates.append(status_predicate(redmine, op, value))
+            case "priority":
+                rank = priority_rank(value)
+                query.predicates.append(Predicate(lambda t, op=op, rank=rank: compare(op, priority_rank(t.priority.name), rank)))
+            case "age":
+                query.predicates.append(age_predicate(op, value, now))
+            case "tracker":
+                if op not in (":", "=", "!="):
+                    raise QueryError("tracker can only be compared with : or !=")
+                name = value.lower()
+                query.predicates.append(Predicate(lambda t, op=op: compare(op, t.tracker.name.lower(), name)))
+            case "subject":
+                if op not in (":", "="):
+                    raise QueryError("subject can only be matched with :")
+                term = value.lower()
+                query.predicates.append(Predicate(lambda t: term in t.subject.lower(),
+                                                  f"subject=~{urllib.parse.quote(value)}"))
+
+    if query.ids:
+        ids = set(query.ids)
+        query.predicates.append(Predicate(lambda t: t.id in ids, f"issue_id={','.join(str(id) for id in query.ids)}"))
+
+    log.debug(f"compiled query '{text}': filters={query.filters()}, sort={query.sort()}, pushed={query.is_pushed()}")
+    return query
+
+
+def compile_word(query:Query, word:str):
+    if word.lstrip('#').isdigit():
+        query.ids.append(int(word.lstrip('#')))
+    elif word == "me" or query.redmine.is_user_or_group(word):
+        query.predicates.append(assigned_predicate(query, ":", word))
+    else:
+        query.terms.append(word)
+
+
+def assigned_predicate(query:Query, op:str, name:str) -> Predicate:
+    if op not in (":", "=", "!="):
+        raise QueryError("assigned can only be compared with : or !=")
+    if name == "me":
+        if query.user is None:
+            raise QueryError("you're not mapped to a redmine user, see /scn add")
+        assignee_id = query.user.id
+        query.login = query.user.login
+        push = "assigned_to_id=me"
+    else:
+        assignee = query.redmine.find_user(name)
+        if assignee is None:
+            raise QueryError(f"unknown team or user: {name}")
+        assignee_id = assignee.id
+        push = f"assigned_to_id={assignee_id}"
+    if op == "!=":
+        push = f"assigned_to_id=!{assignee_id}"
+    return Predicate(lambda t: compare(op, t.assigned_to.id, assignee_id), push)
+
+
+def status_predicate(redmine, op:str, value:str) -> Predicate:
+    if op not in (":", "=", "!="):
+        raise QueryError("status can only be compared with : or !=")
+    negate = op == "!="
+    match value.lower():
+        case "open" | "closed":
+            closed = (value.lower() == "closed") != negate
+            return Predicate(lambda t: getattr(t.status, "is_closed", False) == closed,
+                             "status_id=closed" if closed else "status_id=open")
+        case "*" | "all" | "any":
+            if negate:
+                raise QueryError(f"status!={value} matches nothing")
+            return Predicate(lambda t: True, "status_id=*")
+        case _:
+            status = redmine.find_status(value)
+            if status is None:
+                # names with spaces, like "In Progress", can be given as In-Progress
+                status = redmine.find_status(value.replace('-', ' '))
+            if status is None:
+                raise QueryError(f"unknown status: {value}")
+            push = f"status_id=!{status.id}" if negate else f"status_id={status.id}"
+            return Predicate(lambda t: compare(op, t.status.id, status.id), push)
+
+
+def age_predicate(op:str, value:str, now:dt.datetime) -> Predicate:
+    if op not in (">", ">=", "<", "<="):
+        raise QueryError("age can only be compared with >, >=, < or <=")
+    cutoff = timestamp(now - parse_duration(value))
+    # older is updated earlier: age>3d is updated before 3 days ago
+    updated_op = {">": "<", ">=": "<=", "<": ">", "<=": ">="}[op]
+    # redmine only has >= and <= for dates
+    push = f"updated_on={urllib.parse.quote(updated_op[0] + '=')}{cutoff}"
+    return Predicate(lambda t: compare(updated_op, t.updated_on, cutoff), push)
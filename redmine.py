@@ -6,9 +6,16 @@ import json
 import requests
 import logging
 import datetime as dt
+import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 
 import humanize
 
+from prefix import PrefixIndex
+
 from dotenv import load_dotenv
 from types import SimpleNamespace
 
@@ -16,6 +23,13 @@ log = logging.getLogger(__name__)
 
 DEFAULT_SORT = "status:desc,priority:desc,updated_on:desc"
 TIMEOUT = 2 # seconds
+UPLOAD_WORKERS = 4 # max concurrent uploads
+UPLOAD_TOKEN_TTL = 3600 # seconds, redmine prunes unattached uploads after a day
+CHUNK_SIZE = 64 * 1024 # bytes per read when streaming uploads
+TEAM_WORKERS = 8 # concurrent requests when fetching all the team memberships
+TEAM_TTL = 600 # seconds team memberships are cached, for changes made in redmine
+UNKNOWN_TEAMS = 100 # unknown team names remembered, so they don't each refresh the groups
+UNKNOWN_TEAM_TTL = 300 # seconds an unknown team name is remembered
 
 class RedmineException(Exception):
     def __init__(self, message: str, request_id: str) -> None:
@@ -23,6 +37,20 @@ class RedmineException(Exception):
         self.request_id = request_id
     
 
+class UploadStream():
+    """A request body read in chunks. Having a length means requests sends it
+    with a Content-Length, rather than chunked transfer encoding."""
+    def __init__(self, chunks, size:int):
+        self.chunks = chunks
+        self.size = size
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __len__(self):
+        return self.size
+
+
 class Client(): ## redmine.Client()
     def __init__(self):
         self.url = os.getenv('REDMINE_URL')
@@ -32,7 +60,27 @@ class Client(): ## redmine.Client()
         self.token = os.getenv('REDMINE_TOKEN')
         if self.url is None:
             raise RedmineException("Unable to load REDMINE_TOKEN")
-        
+
+        # (user, sha256 digest) -> (token, timestamp) for uploads not yet attached
+        self.upload_tokens = {}
+
+        # team name -> (group with users, monotonic time fetched)
+        self.team_members = {}
+        self.teams_swept = None # monotonic time all the teams were last fetched
+        self.team_invalidated = {} # team name -> monotonic time its membership last changed
+        self.team_lock = threading.Lock()
+        # unknown team name -> monotonic time last looked up, oldest first
+        self.unknown_teams = OrderedDict()
+        self.groups = {} # team name -> group
+        self.group_ids = {} # group id -> group
+        self.team_index = PrefixIndex()
+        self.users = {} # login -> user id
+        self.user_ids = {} # user id -> user
+        self.user_emails = {} # email -> user id
+        self.discord_users = {} # discord name -> user id
+        self.login_index = PrefixIndex()
+        self.discord_index = PrefixIndex()
+
         self.reindex()
 
     def create_ticket(self, user, subject, body, attachments=None):
@@ -65,6 +113,8 @@ class Client(): ## redmine.Client()
                 
         # check status
         if response.ok:
+            if attachments:
+                self.release_uploads(attachments)
             root = json.loads(response.text, object_hook= lambda x: SimpleNamespace(**x))
             return root.issue
         else:
@@ -114,7 +164,8 @@ class Client(): ## redmine.Client()
             raise RedmineException(f"update_ticket failed, status=[{response.status_code}] {response.reason}", response.headers['X-Request-Id'])
 
 
-    def append_message(self, ticket_id:int, user_login:str, note:str, attachments=None):
+    def append_message(self, ticket_id:int, user_login:str, note:str, attachments=None, return_journal:bool=False):
+        # with return_journal, returns the journal added, found with another request
         # PUT a simple JSON structure
         data = {
             'issue': {
@@ -140,7 +191,10 @@ class Client(): ## redmine.Client()
         # check status
         if r.status_code == 204:
             # all good
-            pass
+            if attachments:
+                self.release_uploads(attachments)
+            if return_journal:
+                return self.find_journal(ticket_id, note)
         elif r.status_code == 403:
             # no access
             #print(f"#### {vars(r)}")
@@ -150,10 +204,25 @@ class Client(): ## redmine.Client()
             #TODO throw exception to show update failed, and why
 
 
+    def find_journal(self, ticket_id:int, note:str):
+        # the PUT has no body, so find the journal just added: the newest with the note
+        ticket = self.get_ticket(ticket_id, include_journals=True)
+        if ticket:
+            for journal in reversed(ticket.journals):
+                if journal.notes == note:
+                    return journal
+        return None
+
+    def journal_attachment_ids(self, journal) -> list:
+        # the attachments added with a journal are in its details
+        return [int(detail.name) for detail in getattr(journal, 'details', [])
+                if detail.property == "attachment"]
+
     def upload_file(self, user_id, data, filename, content_type):
         # POST /uploads.json?filename=image.png
         # Content-Type: application/octet-stream
         # (request body is the file content)
+        # data can be bytes or an UploadStream, which is sent as read.
 
         headers = { 
             'User-Agent': 'netbot/0.0.1', # TODO update to project version, and add version management
@@ -163,8 +232,9 @@ class Client(): ## redmine.Client()
         }
 
         r = requests.post(
-            url=f"{self.url}/uploads.json?filename={filename}", 
-            files={ 'upload_file': (filename, data, content_type) },
+            url=f"{self.url}/uploads.json",
+            params={ 'filename': filename },
+            data=data,
             headers=headers)
         
         # 201 response: {"upload":{"token":"7167.ed1ccdb093229ca1bd0b043618d88743"}}
@@ -180,20 +250,86 @@ class Client(): ## redmine.Client()
             # todo throw exception
             #TODO throw exception to show upload failed, and why
 
+    def upload_url(self, user_id, url:str, size:int, filename:str, content_type:str):
+        # stream a file from a URL, like the discord CDN, into /uploads.json
+        # a chunk at a time, without holding the whole file.
+        with requests.get(url, stream=True, timeout=TIMEOUT) as response:
+            if not response.ok:
+                log.error(f"upload_url, unable to get {url}, status={response.status_code}: {response.reason}")
+                return None
+            stream = UploadStream(response.iter_content(CHUNK_SIZE), size)
+            return self.upload_file(user_id, stream, filename, content_type)
+
     def upload_attachments(self, user_id, attachments):
-        # uploads all the attachments, 
-        # sets the upload token for each 
+        # uploads all the attachments, concurrently, and
+        # sets the upload token for each.
+        # identical payloads are only uploaded once, and a token is reused
+        # until it's attached to a ticket or expires.
+        now = time.time()
+        pending = {} # digest -> attachments with that payload
         for a in attachments:
-            token = self.upload_file(user_id, a.payload, a.name, a.content_type)
-            a.set_token(token)
+            digest = a.digest()
+            cached = self.upload_tokens.get((user_id, digest))
+            if cached and now - cached[1] < UPLOAD_TOKEN_TTL:
+                log.debug(f"reusing upload token for {a.name}: {cached[0]}")
+                a.set_token(cached[0])
+            else:
+                pending.setdefault(digest, []).append(a)
+
+        if len(pending) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(UPLOAD_WORKERS, len(pending))) as executor:
+            futures = {}
+            for digest, group in pending.items():
+                a = group[0]
+                futures[digest] = executor.submit(self.upload_file, user_id, a.stream(), a.name, a.content_type)
+
+            for digest, future in futures.items():
+                token = future.result()
+                for a in pending[digest]:
+                    a.set_token(token)
+                if token:
+                    self.upload_tokens[(user_id, digest)] = (token, now)
+
+    def release_uploads(self, attachments):
+        # tokens can only be attached once: forget any that have been used
+        used = {getattr(a, "token", None) for a in attachments}
+        for key, (token, _) in list(self.upload_tokens.items()):
+            if token in used:
+                del self.upload_tokens[key]
 
     def find_team(self, name):
-        response = self.query(f"/groups.json")
-        for group in response.groups:
-            if group.name == name:
-                return group
-        # not found
-        return None
+        """a team by name or id, from the group index. the index is refreshed
+        when the team isn't in it, unless it was recently looked up and not found."""
+        team = self.lookup_team(name)
+        if team:
+            return team
+
+        now = time.monotonic()
+        with self.team_lock:
+            missed = self.unknown_teams.get(name)
+        if missed and now - missed < UNKNOWN_TEAM_TTL:
+            return None
+
+        # maybe a new team
+        self.reindex_groups()
+        team = self.lookup_team(name)
+        if team is None:
+            with self.team_lock:
+                self.unknown_teams[name] = now
+                self.unknown_teams.move_to_end(name)
+                while len(self.unknown_teams) > UNKNOWN_TEAMS:
+                    self.unknown_teams.popitem(last=False)
+        return team
+
+    def lookup_team(self, name):
+        if name in self.groups:
+            return self.groups[name]
+        try:
+            return self.group_ids.get(int(name))
+        except (TypeError, ValueError):
+            return None # not an id
         
     def get_user(self, id:int):
         if id:
@@ -239,6 +375,24 @@ class Client(): ## redmine.Client()
             log.warning(f"Unknown ticket number: {ticket_id}")
             return None
         
+    def get_attachments(self, ticket_id:int) -> list:
+        response = self.query(f"/issues/{ticket_id}.json?include=attachments")
+        if response:
+            return getattr(response.issue, 'attachments', [])
+        else:
+            log.warning(f"Unknown ticket number: {ticket_id}")
+            return []
+
+    def download_attachment(self, attachment, file):
+        # stream the attachment content into a file, a chunk at a time
+        with requests.get(attachment.content_url, headers=self.get_headers(), stream=True, timeout=TIMEOUT) as response:
+            if not response.ok:
+                raise RedmineException(f"download_attachment failed, status=[{response.status_code}] {response.reason}",
+                    response.headers.get('X-Request-Id', "[n/a]"))
+            for chunk in response.iter_content(CHUNK_SIZE):
+                file.write(chunk)
+        file.seek(0)
+
     #GET /issues.xml?issue_id=1,2
     def get_tickets(self, ticket_ids):
         response = self.query(f"/issues.json?issue_id={','.join(ticket_ids)}&sort={DEFAULT_SORT}")
@@ -357,6 +511,64 @@ class Client(): ## redmine.Client()
             log.debug(f"No tickets created since {timestamp}")
             return None
 
+    def recent_open_tickets(self, days:int, page_size:int=100):
+        # all open tickets updated in the last few days, most recent first, a page at a time
+        since = (dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=days)).strftime("%Y-%m-%d")
+        tickets = []
+        while True:
+            response = self.query(f"/issues.json?status_id=open&updated_on=%3E%3D{since}&sort=updated_on:desc&offset={len(tickets)}&limit={page_size}")
+            if response is None or len(response.issues) == 0:
+                break
+            tickets.extend(response.issues)
+            if len(tickets) >= response.total_count:
+                break
+        if not tickets:
+            log.debug(f"No open tickets updated in the last {days} days")
+        return tickets
+
+    def tickets_updated_since(self, timestr:str, page_size:int=100):
+        # all tickets, open or closed, updated at or after the timestamp (as
+        # formatted by redmine: 2023-11-19T20:42:09Z), oldest first, a page at a time.
+        # pages follow the updated_on of the last ticket, rather than an offset,
+        # so tickets updated while paging don't shift the pages and get skipped.
+        # the cursor is inclusive, so the tickets at it come back on the next page too.
+        tickets = {} # id -> ticket, in order
+        cursor = timestr
+        skip = 0
+        while True:
+            response = self.query(f"/issues.json?status_id=*&updated_on=%3E%3D{cursor}&sort=updated_on,id&offset={skip}&limit={page_size}")
+            if response is None or len(response.issues) == 0:
+                break
+            for ticket in response.issues:
+                seen = tickets.get(ticket.id)
+                if seen is None or seen.updated_on != ticket.updated_on:
+                    tickets.pop(ticket.id, None) # updated again while paging: moved to the end
+                    tickets[ticket.id] = ticket
+            if len(response.issues) < page_size:
+                break
+            last = response.issues[-1].updated_on
+            if last == cursor:
+                skip += len(response.issues) # a whole page updated in the same second
+            else:
+                cursor, skip = last, 0
+        return list(tickets.values())
+
+    def find_status(self, name:str):
+        response = self.query("/issue_statuses.json")
+        if response:
+            for status in response.issue_statuses:
+                if status.name == name:
+                    return status
+        return None
+
+    def tickets_with_status(self, status_id, limit:int=100):
+        # status_id can be an id, or "open", "closed" or "*"
+        response = self.query(f"/issues.json?status_id={status_id}&sort=updated_on:desc&limit={limit}")
+        if response and response.total_count > 0:
+            return response.issues
+        else:
+            return []
+
     
     def find_tickets(self):
         # "kanban" query: all ticket open or closed recently
@@ -367,42 +579,66 @@ class Client(): ## redmine.Client()
 
         return response.issues
 
-    def my_tickets(self, user=None):
-        response = self.query(f"/issues.json?assigned_to_id=me&status_id=open&sort={DEFAULT_SORT}&limit=100", user)
+    def ticket_page(self, filters:str, offset:int=0, limit:int=100, user=None, sort:str=None):
+        # one page of the tickets matching the filters, and the total number of them
+        response = self.query(f"/issues.json?{filters}&sort={sort or DEFAULT_SORT}&offset={offset}&limit={limit}", user)
+        if response:
+            return response.issues, response.total_count
+        else:
+            return [], 0
 
-        if response.total_count > 0:
-            return response.issues
+    def my_tickets(self, user=None, offset:int=0, limit:int=100):
+        tickets, total = self.ticket_page("assigned_to_id=me&status_id=open", offset, limit, user)
+
+        if total > 0:
+            return tickets
         else:
             log.info(f"No open ticket for me.")
             return None
 
-    def tickets_for_team(self, team_str:str):
+    def team_filter(self, team_str:str) -> str:
         # validate team?
         team = self.find_user(team_str) # find_user is dsigned to be broad
+        return f"assigned_to_id={team.id}&status_id=open"
 
-        query = f"/issues.json?assigned_to_id={team.id}&status_id=open&sort={DEFAULT_SORT}&limit=100"
-        response = self.query(query)
+    def tickets_for_team(self, team_str:str, offset:int=0, limit:int=100):
+        tickets, total = self.ticket_page(self.team_filter(team_str), offset, limit)
 
-        if response.total_count > 0:
-            return response.issues
+        if total > 0:
+            return tickets
         else:
-            log.info(f"No open ticket found for: {team}")
+            log.info(f"No open ticket found for: {team_str}")
             return None
 
-    def search_tickets(self, term):
+    def search_page(self, term, offset:int=0, limit:int=100):
+        # one page of the search results, and the total number of them
         # todo url-encode term?
         # note: sort doesn't seem to be working for search
-        query = f"/search.json?q={term}&titles_only=1&open_issues=1&limit=100"
+        query = f"/search.json?q={term}&titles_only=1&open_issues=1&offset={offset}&limit={limit}"
 
         response = self.query(query)
+        if response is None or len(response.results) == 0:
+            return [], 0
 
         ids = []
         for result in response.results:
             ids.append(str(result.id))
 
-        return self.get_tickets(ids)
+        return self.get_tickets(ids), response.total_count
+
+    def search_tickets(self, term):
+        tickets, _ = self.search_page(term)
+        return tickets
 
     # get the 
+    def get_notes_after(self, ticket_id, journal_id:int=None):
+        # notes with a journal id after the given one, or all of them
+        ticket = self.get_ticket(ticket_id, include_journals=True)
+        if ticket is None:
+            return []
+        return [journal for journal in ticket.journals
+                if journal.notes and (journal_id is None or journal.id > journal_id)]
+
     def get_notes_since(self, ticket_id, timestamp=None):
         notes = []
 
@@ -429,18 +665,20 @@ class Client(): ## redmine.Client()
     def discord_tickets(self):
         # todo: check updated field and track what's changed
         threaded_issue_query = "/issues.json?status_id=open&cf_1=1&sort=updated_on:desc"
-        response = self.redmine.query(threaded_issue_query)
+        response = self.query(threaded_issue_query)
 
-        if response.total_count > 0:
+        if response and response.total_count > 0:
             return response.issues
         else:
-            log.info(f"No open tickets found for: {response.request.url}")
+            log.info(f"No open tickets found for: {threaded_issue_query}")
             return None
 
     def enable_discord_sync(self, ticket_id, user, note):
         fields = {
-            "note": note, #f"Created Discord thread: {thread.name}: {thread.jump_url}",
-            "cf_1": "1",
+            "notes": note, #f"Created Discord thread: {thread.name}: {thread.jump_url}",
+            "custom_fields": [
+                { "id": 1, "value": "1" } # cf_1, custom field discord sync
+            ]
         }
         
         self.update_ticket(ticket_id, fields, user.login)
@@ -525,6 +763,7 @@ class Client(): ## redmine.Client()
         # check status
         if response.ok:
             log.info(f"join_team {username}, {teamname}")
+            self.invalidate_team(team.name)
         else:
             raise RedmineException(f"join_team failed, status=[{response.status_code}] {response.reason}", response.headers['X-Request-Id'])
         
@@ -551,6 +790,7 @@ class Client(): ## redmine.Client()
         if r.status_code != 204:
             log.error(f"Error removing user from group status={r.status_code}, url={r.request.url}")
             return None
+        self.invalidate_team(team.name)
 
     def get_headers(self, impersonate_id:str=None):
         headers = {
@@ -590,9 +830,10 @@ class Client(): ## redmine.Client()
             if user_id is None:
                 # use the user-id to self-assign
                 user_id = user.login
-            self.update_ticket(id, fields, user_id)
+            return self.update_ticket(id, fields, user_id)
         else:
             log.error(f"unknow user: {target}")
+            return None
     
 
     def progress_ticket(self, id, user_id=None): # TODO notes
@@ -601,7 +842,7 @@ class Client(): ## redmine.Client()
             "assigned_to_id": "me",
             "status_id": "2", # "In Progress"
         }
-        self.update_ticket(id, fields, user_id)
+        return self.update_ticket(id, fields, user_id)
 
 
     def unassign_ticket(self, id, user_id=None):
@@ -609,14 +850,85 @@ class Client(): ## redmine.Client()
             "assigned_to_id": "", # FIXME this *should* be the team it was assigned to, but there's no way to calculate.
             "status_id": "1", # New
         }
-        self.update_ticket(id, fields, user_id)
+        return self.update_ticket(id, fields, user_id)
 
 
     def resolve_ticket(self, ticket_id, user_id=None):
-        self.update_ticket(ticket_id, {"status_id": "3"}, user_id) # '3' is the status_id, it doesn't accept "Resolved"
+        return self.update_ticket(ticket_id, {"status_id": "3"}, user_id) # '3' is the status_id, it doesn't accept "Resolved"
 
 
     def get_team(self, teamname:str):
+        # from the membership index, when it's fresh. cached by name, however it's asked for.
+        group = self.find_team(teamname)
+        if group is None:
+            log.debug(f"Unknown team name: {teamname}")
+            return None
+        teamname = group.name
+        with self.team_lock:
+            cached = self.team_members.get(teamname)
+        if cached and time.monotonic() - cached[1] < TEAM_TTL:
+            return cached[0]
+
+        start = time.monotonic()
+        team = self.fetch_team(teamname)
+        if team:
+            with self.team_lock:
+                # not cached if it changed while being fetched
+                if self.team_invalidated.get(teamname, 0) < start:
+                    self.team_members[teamname] = (team, start)
+        return team
+
+    def get_all_teams(self) -> dict:
+        """team name -> team with users, for all the teams. fetched in one
+        concurrent sweep, and cached."""
+        with self.team_lock:
+            fresh = self.teams_swept is not None and time.monotonic() - self.teams_swept < TEAM_TTL
+        if not fresh:
+            self.sweep_teams()
+        else:
+            # teams invalidated since the sweep, by joins and leaves
+            with self.team_lock:
+                missing = [name for name in self.groups if name not in self.team_members]
+            for name in missing:
+                self.get_team(name)
+        with self.team_lock:
+            return {name: team for name, (team, _) in self.team_members.items()}
+
+    def sweep_teams(self):
+        groups = list(self.groups.values())
+        if not groups:
+            return
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=min(TEAM_WORKERS, len(groups))) as executor:
+            responses = list(executor.map(lambda group: self.query(f"/groups/{group.id}.json?include=users"), groups))
+        members = {}
+        for group, response in zip(groups, responses):
+            if response:
+                members[group.name] = (response.group, start)
+            else:
+                log.warning(f"unable to get members of team {group.name}")
+        with self.team_lock:
+            # merged with the cache as it is now: a team invalidated during
+            # the sweep, or fetched again since, keeps what's cached for it
+            merged = {}
+            for group in groups:
+                current = self.team_members.get(group.name)
+                swept = members.get(group.name)
+                if swept and self.team_invalidated.get(group.name, 0) < start and (current is None or current[1] <= start):
+                    merged[group.name] = swept
+                elif current:
+                    merged[group.name] = current
+            self.team_members = merged
+            self.teams_swept = start
+        log.info(f"fetched members of {len(members)} teams in {time.monotonic() - start:.2f} sec")
+
+    def invalidate_team(self, teamname:str):
+        # membership changed: fetched again when next needed
+        with self.team_lock:
+            self.team_members.pop(teamname, None)
+            self.team_invalidated[teamname] = time.monotonic()
+
+    def fetch_team(self, teamname:str):
         team = self.find_team(teamname)
         if team is None:
             log.debug(f"Unknown team name: {teamname}")
@@ -685,46 +997,67 @@ class Client(): ## redmine.Client()
 
     # python method sync?
     def reindex_users(self):
-        # reset the indices
-        self.users = {}
-        self.user_ids = {}
-        self.user_emails = {}
-        self.discord_users = {}
-
-        # rebuild the indicies
+        # rebuild the indicies, and swap them in, so lookups never see them half-built
         response = self.query(f"/users.json?limit=1000") ## fixme max limit? paging?
-        if response.users:
-            for user in response.users:
-                self.users[user.login] = user.id
-                self.user_ids[user.id] = user
-                self.user_emails[user.mail] = user.id
-
-                discord_id = self.get_discord_id(user)
-                if discord_id:
-                    self.discord_users[discord_id] = user.id
-            log.info(f"indexed {len(self.users)} users")
-        else:
-            log.error(f"No users: {response}")
+        if response is None or not response.users:
+            log.error(f"No users, keeping the {len(self.users)} indexed: {response}")
+            return
+
+        users = {}
+        user_ids = {}
+        user_emails = {}
+        discord_users = {}
+        for user in response.users:
+            users[user.login] = user.id
+            user_ids[user.id] = user
+            user_emails[user.mail] = user.id
+
+            discord_id = self.get_discord_id(user)
+            if discord_id:
+                discord_users[discord_id] = user.id
+
+        # users by id first, so the ids in the other indexes are always found
+        self.user_ids = user_ids
+        self.users = users
+        self.user_emails = user_emails
+        self.discord_users = discord_users
+        # for autocomplete: logins, and discord names
+        self.login_index = PrefixIndex(users.keys())
+        self.discord_index = PrefixIndex(discord_users.keys())
+        log.info(f"indexed {len(users)} users")
 
 
     def get_teams(self):
         return self.groups.keys()
 
     def reindex_groups(self):
-        # reset the indices
-        self.groups = {}
-
-        # rebuild the indicies
+        # rebuild the indicies, and swap them in, so lookups never see them half-built
         response = self.query(f"/groups.json?limit=1000") ## FIXME max limit? paging?
-        for group in response.groups:
-            self.groups[group.name] = group
+        if response is None:
+            log.error(f"No groups, keeping the {len(self.groups)} indexed")
+            return
 
+        groups = {}
+        group_ids = {}
+        for group in response.groups:
+            groups[group.name] = group
+            group_ids[group.id] = group
+
+        self.groups = groups
+        self.group_ids = group_ids
+        self.team_index = PrefixIndex(groups.keys())
+        with self.team_lock:
+            # members of removed teams are forgotten, and known teams aren't unknown
+            self.team_members = {name: members for name, members in self.team_members.items() if name in groups}
+            for name in list(self.unknown_teams):
+                if self.lookup_team(name):
+                    del self.unknown_teams[name]
         log.info(f"indexed {len(self.groups)} groups")
 
 
     def is_user_in_team(self, username:str, teamname:str) -> bool:
         user_id = self.find_user(username).id
-        team = self.get_team(teamname) # requires an API call, could be cashed? only used for testing
+        team = self.get_team(teamname) # from the membership index
 
         if team:
             for user in team.users:
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import time
+import asyncio
+import logging
+
+import discord
+
+# Discord needs a response to an interaction within 3 seconds. A Responder
+# defers the response when the work runs over budget, or is expected to, runs
+# blocking redmine calls off the event loop, and sends results that don't fit
+# in one message as followups.
+
+log = logging.getLogger(__name__)
+
+DEFER_BUDGET = 1.5 # seconds of work before deferring, leaving margin for discord's 3
+CALL_ESTIMATE = 0.3 # expected seconds per redmine call
+UPDATE_INTERVAL = 1.0 # min seconds between edits of the response with partial results
+MAX_MESSAGE = 2000 # discord's message limit
+
+
+def split_message(text:str, size:int=MAX_MESSAGE) -> list:
+    """split text into messages, at line breaks where possible"""
+    messages = []
+    while len(text) > size:
+        cut = text.rfind('\n', 0, size)
+        if cut <= 0:
+            cut = size
+        messages.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text or not messages:
+        messages.append(text)
+    return messages
+
+
+class Responder():
+    """Responds to an interaction within Discord's deadline. Use as:
+
+        async with Responder(ctx) as responder:
+            teams = await responder.run(redmine.get_teams)
+            await responder.send(format(teams))
+    """
+    def __init__(self, ctx:discord.ApplicationContext, budget:float=DEFER_BUDGET):
+        self.ctx = ctx
+        self.budget = budget
+        self.start = time.monotonic()
+        self.deferred = False
+        self.responded = False # something has been sent
+        self.last_update = 0.0
+        self.lock = asyncio.Lock()
+        self.watchdog = None
+
+    async def __aenter__(self):
+        self.watchdog = asyncio.create_task(self.defer_after(self.budget))
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.watchdog.cancel()
+
+    async def defer_after(self, delay:float):
+        await asyncio.sleep(delay)
+        try:
+            await self.defer()
+        except Exception:
+            # nothing awaits the watchdog, so its errors would go unseen
+            log.exception(f"unable to defer response after {time.monotonic() - self.start:.2f} sec")
+
+    async def defer(self):
+        async with self.lock:
+            if not self.deferred and not self.responded:
+                log.debug(f"deferring response after {time.monotonic() - self.start:.2f} sec")
+                await self.ctx.defer()
+                self.deferred = True
+
+    async def expect(self, calls:int):
+        """defer now if the calls are expected to run over budget"""
+        if time.monotonic() - self.start + calls * CALL_ESTIMATE > self.budget:
+            await self.defer()
+
+    async def run(self, func, *args, **kwargs):
+        """run a blocking call, like a redmine query, on a worker thread"""
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def update(self, content:str):
+        """show partial results, replacing any shown before. edits are throttled."""
+        now = time.monotonic()
+        if now - self.last_update < UPDATE_INTERVAL:
+            return
+        self.last_update = now
+        async with self.lock:
+            if self.responded or self.deferred:
+                await self.ctx.edit(content=content[:MAX_MESSAGE])
+            else:
+                await self.ctx.respond(content[:MAX_MESSAGE])
+            self.responded = True
+
+    async def edit(self, **kwargs):
+        """change the response already sent, like its view"""
+        async with self.lock:
+            await self.ctx.edit(**kwargs)
+
+    async def send(self, content:str, **kwargs):
+        """send the final result, replacing any partial results. text over the
+        message limit is sent in followups."""
+        messages = split_message(content)
+        async with self.lock:
+            if self.last_update:
+                await self.ctx.edit(content=messages[0], **kwargs)
+            else:
+                await self.ctx.respond(messages[0], **kwargs)
+            self.responded = True
+            for message in messages[1:]:
+                await self.ctx.followup.send(message)
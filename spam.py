@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import re
+import math
+import logging
+
+import store
+
+# Local spam scoring for inbound mail, so obvious spam never reaches redmine.
+# Combines header heuristics, sender reputation and a token model (naive bayes,
+# as per http://www.paulgraham.com/spam.html with Robinson's smoothing) trained
+# from tickets marked spam, and from closed tickets as ham.
+
+log = logging.getLogger(__name__)
+
+SPAM_THRESHOLD = 0.95 # probability above which a message is quarantined
+SPAM_STATUS = "Rejected/Spam"
+MAX_TOKENS = 1000 # tokens used from a message
+INTERESTING_TOKENS = 20 # most decisive tokens used for scoring
+TRAIN_LIMIT = 100 # tickets of each kind checked per training run
+
+TOKEN_RE = re.compile(r"[a-z0-9$'][a-z0-9$'.\-]{2,20}")
+
+# (reason, log-odds weight, test on lower-case header dict)
+HEADER_RULES = [
+    ("x-spam-flag", 4.0, lambda h: h.get("x-spam-flag", "").strip().upper() == "YES"),
+    ("spf fail", 2.0, lambda h: "spf=fail" in h.get("authentication-results", "")),
+    ("dkim fail", 1.5, lambda h: "dkim=fail" in h.get("authentication-results", "")),
+    ("dmarc fail", 2.5, lambda h: "dmarc=fail" in h.get("authentication-results", "")),
+    ("bulk precedence", 1.0, lambda h: h.get("precedence", "").strip().lower() in ("bulk", "junk")),
+    ("list-unsubscribe", 0.5, lambda h: "list-unsubscribe" in h),
+    ("no message-id", 1.0, lambda h: "message-id" not in h),
+    ("no date", 1.0, lambda h: "date" not in h),
+]
+KNOWN_SENDER_WEIGHT = -6.0 # senders with a redmine account
+
+
+def tokenize(text:str) -> set:
+    tokens = set()
+    for token in TOKEN_RE.findall(text.lower()):
+        tokens.add(token)
+        if len(tokens) >= MAX_TOKENS:
+            break
+    return tokens
+
+
+def logit(p:float) -> float:
+    return math.log(p / (1.0 - p))
+
+
+def sigmoid(x:float) -> float:
+    if x < -40:
+        return 0.0
+    return 1.0 / (1.0 + math.exp(-x))
+
+
+class SpamFilter():
+    def __init__(self, stats:store.SpamStats=None):
+        self.stats = stats or store.SpamStats()
+
+    def header_score(self, headers:dict):
+        score = 0.0
+        reasons = []
+        for reason, weight, test in HEADER_RULES:
+            if test(headers):
+                score += weight
+                reasons.append(reason)
+        return score, reasons
+
+    def sender_score(self, spam:int, ham:int):
+        if spam == 0 and ham == 0:
+            return 0.0
+        # smoothed log-odds of this sender sending spam
+        return logit((spam + 0.5) / (spam + ham + 1.0))
+
+    def token_score(self, tokens) -> float:
+        nspam, nham = self.stats.totals()
+        if nspam == 0 or nham == 0:
+            return 0.0 # untrained
+
+        probabilities = []
+        for spam, ham in self.stats.token_counts(tokens).values():
+            spam_freq = spam / nspam
+            ham_freq = ham / nham
+            p = spam_freq / (spam_freq + ham_freq)
+            # Robinson: pull rare tokens towards 0.5
+            n = spam + ham
+            p = (0.5 + n * p) / (1.0 + n)
+            probabilities.append(p)
+
+        # only the most decisive tokens count
+        probabilities.sort(key=lambda p: abs(p - 0.5), reverse=True)
+        return sum(logit(p) for p in probabilities[:INTERESTING_TOKENS])
+
+    def score(self, headers:dict, address:str, text:str, known_sender:bool=False):
+        """probability the message is spam, and the reasons"""
+        score, reasons = self.header_score(headers)
+
+        sent_spam, sent_ham = self.stats.sender(address)
+        sender = self.sender_score(sent_spam, sent_ham)
+        if sender:
+            score += sender
+            reasons.append(f"sender {sender:+.1f}")
+
+        tokens = self.token_score(tokenize(text))
+        if tokens:
+            score += tokens
+            reasons.append(f"tokens {tokens:+.1f}")
+
+        # an account doesn't vouch for an address that has sent spam: it may
+        # have been created by a spam message, or the address spoofed
+        if known_sender and sent_spam == 0:
+            score += KNOWN_SENDER_WEIGHT
+            reasons.append("known sender")
+
+        return sigmoid(score), reasons
+
+    def train(self, ticket_id:int, address:str, text:str, is_spam:bool):
+        self.stats.train(ticket_id, address, tokenize(text), is_spam)
+
+    def train_from_redmine(self, redmine):
+        """train on tickets marked spam, and on closed tickets as ham, that
+        haven't been seen before"""
+        status = redmine.find_status(SPAM_STATUS)
+        if status is None:
+            log.warning(f"unknown spam status: {SPAM_STATUS}")
+            return
+
+        trained = 0
+        spam_tickets = redmine.tickets_with_status(status.id, TRAIN_LIMIT)
+        ham_tickets = [ticket for ticket in redmine.tickets_with_status("closed", TRAIN_LIMIT)
+                       if ticket.status.id != status.id]
+
+        for tickets, is_spam in ((spam_tickets, True), (ham_tickets, False)):
+            for ticket in tickets:
+                if self.stats.is_trained(ticket.id):
+                    continue
+                address = None
+                try:
+                    address = redmine.get_user(ticket.author.id).mail
+                except (AttributeError, KeyError):
+                    pass # unknown, or locked, author
+                text = f"{ticket.subject}\n{getattr(ticket, 'description', '') or ''}"
+                self.train(ticket.id, address, text, is_spam)
+                trained += 1
+
+        if trained:
+            log.info(f"trained spam filter on {trained} tickets")
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+# Local state shared by the netbot processes, kept in a single sqlite file.
+# Each store creates the tables it needs; the file is safe to share between
+# the threader cron job and the bot, as sqlite serializes the writers.
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DB = "netbot.db"
+BUSY_TIMEOUT = 30 # seconds to wait for another writer
+
+
+def db_path() -> str:
+    return os.getenv('NETBOT_DB', DEFAULT_DB)
+
+
+class Store():
+    """Base for the sqlite-backed stores. Subclasses define SCHEMA."""
+    SCHEMA = ""
+
+    def __init__(self, path:str=None):
+        self.path = path or db_path()
+        self.lock = threading.RLock()
+        # isolation_level=None: autocommit, with explicit transactions where needed
+        self.db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.SCHEMA)
+
+    def execute(self, sql:str, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+class IngestLog(Store):
+    """Single-instance leases, and a log of ingested messages keyed by
+    Message-ID or content hash, so overlapping runs never handle a message twice."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS ingested (
+            key TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            updated REAL NOT NULL
+        );
+    """
+    PROCESSING = "processing"
+    DONE = "done"
+
+    def acquire_lease(self, name:str, owner:str, ttl:float) -> bool:
+        """take, or renew, the named lease. False if someone else holds it."""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT owner, expires FROM leases WHERE name = ?", (name,)).fetchone()
+                if row and row[0] != owner and row[1] > now:
+                    self.db.execute("ROLLBACK")
+                    log.info(f"lease {name} held by {row[0]} for another {row[1] - now:.0f} sec")
+                    return False
+                self.db.execute("INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)",
+                    (name, owner, now + ttl))
+                self.db.execute("COMMIT")
+                return True
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def release_lease(self, name:str, owner:str):
+        self.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def claim(self, key:str, owner:str, stale_after:float) -> bool:
+        """claim a message before handling it. False if it's already been
+        ingested, or is being handled by another live run."""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT status, owner, updated FROM ingested WHERE key = ?", (key,)).fetchone()
+                if row and (row[0] == self.DONE or (row[1] != owner and now - row[2] < stale_after)):
+                    self.db.execute("ROLLBACK")
+                    return False
+                self.db.execute("INSERT OR REPLACE INTO ingested (key, status, owner, updated) VALUES (?, ?, ?, ?)",
+                    (key, self.PROCESSING, owner, now))
+                self.db.execute("COMMIT")
+                return True
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def complete(self, key:str):
+        self.execute("UPDATE ingested SET status = ?, updated = ? WHERE key = ?", (self.DONE, time.time(), key))
+
+    def release(self, key:str):
+        # handling failed, allow the message to be tried again
+        self.execute("DELETE FROM ingested WHERE key = ? AND status = ?", (key, self.PROCESSING))
+
+    def is_ingested(self, key:str) -> bool:
+        return len(self.execute("SELECT 1 FROM ingested WHERE key = ? AND status = ?", (key, self.DONE))) > 0
+
+
+class DeadLetters(Store):
+    """Messages that failed to process, with the error and retry schedule,
+    so they can be replayed once the cause is fixed."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            key TEXT PRIMARY KEY,
+            uid TEXT,
+            data BLOB NOT NULL,
+            error TEXT,
+            attempts INTEGER NOT NULL,
+            first_failed REAL NOT NULL,
+            last_failed REAL NOT NULL,
+            next_retry REAL NOT NULL,
+            resolved REAL
+        );
+    """
+    RETRY_DELAY = 300 # seconds before the first retry, doubled after each failure
+    MAX_RETRY_DELAY = 24 * 60 * 60
+
+    def retry_delay(self, attempts:int) -> float:
+        return min(self.RETRY_DELAY * 2 ** (attempts - 1), self.MAX_RETRY_DELAY)
+
+    def add(self, key:str, uid:str, data:bytes, error:str):
+        """record a failure, or another failed attempt, for a message"""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT attempts, first_failed FROM dead_letters WHERE key = ?", (key,)).fetchone()
+            attempts, first_failed = (row[0] + 1, row[1]) if row else (1, now)
+            self.db.execute("""INSERT OR REPLACE INTO dead_letters
+                (key, uid, data, error, attempts, first_failed, last_failed, next_retry, resolved)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL)""",
+                (key, uid, data, error, attempts, first_failed, now, now + self.retry_delay(attempts)))
+        log.info(f"dead letter {uid} {key}, attempt {attempts}: {error}")
+
+    def due(self, limit:int=100, force:bool=False):
+        """unresolved messages ready for a retry, oldest first: (key, uid, data, attempts)"""
+        if force:
+            return self.execute("""SELECT key, uid, data, attempts FROM dead_letters
+                WHERE resolved IS NULL ORDER BY first_failed LIMIT ?""", (limit,))
+        return self.execute("""SELECT key, uid, data, attempts FROM dead_letters
+            WHERE resolved IS NULL AND next_retry <= ? ORDER BY first_failed LIMIT ?""", (time.time(), limit))
+
+    def resolve(self, key:str):
+        self.execute("UPDATE dead_letters SET resolved = ? WHERE key = ?", (time.time(), key))
+
+    def failures(self):
+        """unresolved failures, without the message data"""
+        return self.execute("""SELECT key, uid, error, attempts, first_failed, last_failed, next_retry
+            FROM dead_letters WHERE resolved IS NULL ORDER BY first_failed""")
+
+
+class SpamStats(Store):
+    """Token counts, sender reputation and training progress for the spam filter."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS spam_tokens (
+            token TEXT PRIMARY KEY,
+            spam INTEGER NOT NULL DEFAULT 0,
+            ham INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS spam_senders (
+            address TEXT PRIMARY KEY,
+            spam INTEGER NOT NULL DEFAULT 0,
+            ham INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS spam_trained (
+            ticket_id INTEGER PRIMARY KEY,
+            is_spam INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS quarantine (
+            key TEXT PRIMARY KEY,
+            uid TEXT,
+            data BLOB NOT NULL,
+            score REAL NOT NULL,
+            reasons TEXT,
+            received REAL NOT NULL
+        );
+    """
+
+    def totals(self):
+        """(spam, ham) trained message counts"""
+        rows = self.execute("SELECT SUM(is_spam), COUNT(*) - SUM(is_spam) FROM spam_trained")
+        return (rows[0][0] or 0, rows[0][1] or 0)
+
+    def token_counts(self, tokens) -> dict:
+        counts = {}
+        tokens = list(tokens)
+        # sqlite limits the number of parameters per statement
+        for i in range(0, len(tokens), 500):
+            chunk = tokens[i:i+500]
+            sql = f"SELECT token, spam, ham FROM spam_tokens WHERE token IN ({','.join('?' * len(chunk))})"
+            for token, spam, ham in self.execute(sql, chunk):
+                counts[token] = (spam, ham)
+        return counts
+
+    def sender(self, address:str):
+        """(spam, ham) counts for a sender address"""
+        rows = self.execute("SELECT spam, ham FROM spam_senders WHERE address = ?", (address,))
+        return tuple(rows[0]) if rows else (0, 0)
+
+    def is_trained(self, ticket_id:int) -> bool:
+        return len(self.execute("SELECT 1 FROM spam_trained WHERE ticket_id = ?", (ticket_id,))) > 0
+
+    def train(self, ticket_id:int, address:str, tokens, is_spam:bool):
+        column = "spam" if is_spam else "ham"
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany(f"""INSERT INTO spam_tokens (token, {column}) VALUES (?, 1)
+                    ON CONFLICT(token) DO UPDATE SET {column} = {column} + 1""", [(token,) for token in tokens])
+                if address:
+                    self.db.execute(f"""INSERT INTO spam_senders (address, {column}) VALUES (?, 1)
+                        ON CONFLICT(address) DO UPDATE SET {column} = {column} + 1""", (address,))
+                self.db.execute("INSERT OR REPLACE INTO spam_trained (ticket_id, is_spam) VALUES (?, ?)",
+                    (ticket_id, 1 if is_spam else 0))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def quarantine(self, key:str, uid:str, data:bytes, score:float, reasons:str):
+        self.execute("INSERT OR REPLACE INTO quarantine (key, uid, data, score, reasons, received) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, uid, data, score, reasons, time.time()))
+
+    def quarantined(self):
+        """quarantined messages, without the message data"""
+        return self.execute("SELECT key, uid, score, reasons, received FROM quarantine ORDER BY received")
+
+    def release(self, key:str):
+        """remove a message from quarantine, returning (uid, data)"""
+        # in one transaction, so a message is only released once, whichever
+        # process releases it
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.db.execute("SELECT uid, data FROM quarantine WHERE key = ?", (key,)).fetchall()
+                self.db.execute("DELETE FROM quarantine WHERE key = ?", (key,))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return tuple(rows[0]) if rows else None
+
+
+class MirroredAttachments(Store):
+    """Redmine attachments already relayed to Discord, so they're only sent once."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS mirrored_attachments (
+            attachment_id INTEGER PRIMARY KEY,
+            ticket_id INTEGER NOT NULL,
+            mirrored REAL NOT NULL
+        );
+    """
+
+    def mirrored(self, ticket_id:int) -> set:
+        """ids of the ticket's attachments that have been mirrored"""
+        rows = self.execute("SELECT attachment_id FROM mirrored_attachments WHERE ticket_id = ?", (ticket_id,))
+        return {row[0] for row in rows}
+
+    def add(self, attachment_id:int, ticket_id:int):
+        self.execute("INSERT OR REPLACE INTO mirrored_attachments (attachment_id, ticket_id, mirrored) VALUES (?, ?, ?)",
+            (attachment_id, ticket_id, time.time()))
+
+
+class TicketStates(Store):
+    """The last known state of each ticket, and the change feed cursor, so
+    changes can be found by comparing against them."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS ticket_states (
+            ticket_id INTEGER PRIMARY KEY,
+            updated_on TEXT NOT NULL,
+            status TEXT,
+            assigned TEXT
+        );
+        CREATE TABLE IF NOT EXISTS cursors (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def cursor(self, name:str) -> str:
+        rows = self.execute("SELECT value FROM cursors WHERE name = ?", (name,))
+        return rows[0][0] if rows else None
+
+    def set_cursor(self, name:str, value:str):
+        self.execute("INSERT OR REPLACE INTO cursors (name, value) VALUES (?, ?)", (name, value))
+
+    def states(self, ticket_ids) -> dict:
+        """ticket id -> (updated_on, status, assigned)"""
+        states = {}
+        ticket_ids = list(ticket_ids)
+        # sqlite limits the number of parameters per statement
+        for i in range(0, len(ticket_ids), 500):
+            chunk = ticket_ids[i:i+500]
+            sql = f"SELECT ticket_id, updated_on, status, assigned FROM ticket_states WHERE ticket_id IN ({','.join('?' * len(chunk))})"
+            for ticket_id, updated_on, status, assigned in self.execute(sql, chunk):
+                states[ticket_id] = (updated_on, status, assigned)
+        return states
+
+    def update(self, states, cursor_name:str, cursor:str):
+        """save (ticket_id, updated_on, status, assigned) states, and the cursor, together"""
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany("INSERT OR REPLACE INTO ticket_states (ticket_id, updated_on, status, assigned) VALUES (?, ?, ?, ?)",
+                    states)
+                self.db.execute("INSERT OR REPLACE INTO cursors (name, value) VALUES (?, ?)", (cursor_name, cursor))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+
+class EventBus(Store):
+    """Events passed between the netbot processes, like the ingester telling the
+    bot a ticket was updated. Each subscriber reads from its own position."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT NOT NULL,
+            ticket_id INTEGER,
+            created REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS subscribers (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL
+        );
+    """
+    RETENTION = 7 * 24 * 60 * 60 # seconds events are kept
+    TICKET_UPDATED = "ticket.updated"
+
+    def publish(self, topic:str, ticket_id:int):
+        self.execute("INSERT INTO events (topic, ticket_id, created) VALUES (?, ?, ?)", (topic, ticket_id, time.time()))
+
+    def subscribe(self, name:str):
+        """start a subscriber at the current end of the events, if it's new"""
+        self.execute("INSERT OR IGNORE INTO subscribers (name, last_id) VALUES (?, (SELECT IFNULL(MAX(id), 0) FROM events))", (name,))
+
+    def poll(self, name:str, limit:int=100):
+        """events the subscriber hasn't acknowledged, oldest first: (id, topic, ticket_id)"""
+        return self.execute("""SELECT id, topic, ticket_id FROM events
+            WHERE id > IFNULL((SELECT last_id FROM subscribers WHERE name = ?), 0) ORDER BY id LIMIT ?""", (name, limit))
+
+    def ack(self, name:str, last_id:int):
+        self.execute("INSERT OR REPLACE INTO subscribers (name, last_id) VALUES (?, ?)", (name, last_id))
+
+    def prune(self):
+        self.execute("DELETE FROM events WHERE created < ?", (time.time() - self.RETENTION,))
+
+
+class ThreadRoutes(Store):
+    """Which ticket each Discord thread is synced with."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS thread_tickets (
+            thread_id INTEGER PRIMARY KEY,
+            ticket_id INTEGER NOT NULL
+        );
+    """
+
+    def load(self) -> dict:
+        """thread id -> ticket id"""
+        return dict(self.execute("SELECT thread_id, ticket_id FROM thread_tickets"))
+
+    def add(self, thread_id:int, ticket_id:int):
+        self.execute("INSERT OR REPLACE INTO thread_tickets (thread_id, ticket_id) VALUES (?, ?)", (thread_id, ticket_id))
+
+    def remove(self, thread_id:int):
+        self.execute("DELETE FROM thread_tickets WHERE thread_id = ?", (thread_id,))
+
+
+class SyncState(Store):
+    """How far each Discord thread has been synced with its ticket: the last
+    Discord message (a snowflake id) and the last Redmine journal relayed.
+    Messages relayed as they're sent, and the notes the bot adds for them,
+    are kept until the cursors pass them, so a sync doesn't relay them again."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS thread_sync (
+            thread_id INTEGER PRIMARY KEY,
+            ticket_id INTEGER NOT NULL,
+            last_message_id INTEGER,
+            last_journal_id INTEGER,
+            updated REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS thread_relayed (
+            thread_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            PRIMARY KEY (thread_id, kind, item_id)
+        );
+    """
+    MESSAGE = "message" # a discord message relayed to the ticket
+    JOURNAL = "journal" # a note the bot added to the ticket
+
+    def add_relayed(self, thread_id:int, kind:str, item_id:int):
+        self.execute("INSERT OR IGNORE INTO thread_relayed (thread_id, kind, item_id) VALUES (?, ?, ?)",
+                     (thread_id, kind, item_id))
+
+    def relayed(self, thread_id:int, kind:str) -> set:
+        """ids relayed by the bot, not yet passed by the cursors"""
+        rows = self.execute("SELECT item_id FROM thread_relayed WHERE thread_id = ? AND kind = ?", (thread_id, kind))
+        return {row[0] for row in rows}
+
+    def get(self, thread_id:int):
+        """(last_message_id, last_journal_id), None for a thread never synced"""
+        rows = self.execute("SELECT last_message_id, last_journal_id FROM thread_sync WHERE thread_id = ?", (thread_id,))
+        return tuple(rows[0]) if rows else (None, None)
+
+    def save(self, states:dict):
+        """save thread id -> (ticket_id, last_message_id, last_journal_id), in one transaction"""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany("""INSERT OR REPLACE INTO thread_sync
+                    (thread_id, ticket_id, last_message_id, last_journal_id, updated) VALUES (?, ?, ?, ?, ?)""",
+                    [(thread_id, *state, now) for thread_id, state in states.items()])
+                # relayed items the cursors have passed aren't needed
+                for kind, column in ((self.MESSAGE, 1), (self.JOURNAL, 2)):
+                    self.db.executemany("DELETE FROM thread_relayed WHERE thread_id = ? AND kind = ? AND item_id <= ?",
+                        [(thread_id, kind, state[column]) for thread_id, state in states.items() if state[column]])
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+import unittest
+import logging
+from types import SimpleNamespace
+
+import bulk
+
+
+log = logging.getLogger(__name__)
+
+
+class TestParseIds(unittest.TestCase):
+
+    def test_lists_and_ranges(self):
+        self.assertEqual([12], bulk.parse_ids("12"))
+        self.assertEqual([12, 15, 20, 21, 22, 30], bulk.parse_ids("12, 15 20-22,#30"))
+        self.assertEqual([5, 6, 7], bulk.parse_ids("5-7 6"))
+
+    def test_errors(self):
+        for text in ["", "abc", "7-5", "1-1000", "12,x"]:
+            with self.assertRaises(ValueError, msg=text):
+                bulk.parse_ids(text)
+
+
+class TestRunBulk(unittest.TestCase):
+
+    def test_results_in_order(self):
+        def action(ticket_id):
+            if ticket_id == 2:
+                raise Exception("no access")
+            if ticket_id == 3:
+                return None
+            return SimpleNamespace(id=ticket_id)
+
+        results = bulk.run_bulk(action, [1, 2, 3, 4])
+        self.assertEqual([1, 2, 3, 4], [result.ticket_id for result in results])
+        self.assertEqual([True, False, False, True], [result.ok() for result in results])
+
+        summary = bulk.summarize("resolved", results)
+        self.assertEqual("resolved 2 of 4 tickets\n#2 failed: no access\n#3 failed: not updated", summary)
+
+    def test_bounded(self):
+        lock = threading.Lock()
+        running = [0, 0] # now, max
+        def action(ticket_id):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            return SimpleNamespace(id=ticket_id)
+
+        start = time.monotonic()
+        results = bulk.run_bulk(action, list(range(20)), workers=4)
+        elapsed = time.monotonic() - start
+
+        self.assertTrue(all(result.ok() for result in results))
+        self.assertLessEqual(running[1], 4)
+        self.assertLess(elapsed, 20 * 0.02) # concurrent
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import os
+import unittest
+import logging
+import tempfile
+from types import SimpleNamespace
+
+import changes
+import store
+
+
+log = logging.getLogger(__name__)
+
+
+def ticket(id:int, updated_on:str, status:str="New", assigned:str=None, created_on:str="2023-11-01T10:00:00Z", journals=()):
+    return SimpleNamespace(id=id, created_on=created_on, updated_on=updated_on,
+        status=SimpleNamespace(name=status), assigned_to=SimpleNamespace(name=assigned) if assigned else None,
+        journals=list(journals))
+
+
+def journal(id:int, created_on:str, notes:str=""):
+    return SimpleNamespace(id=id, created_on=created_on, notes=notes, user=SimpleNamespace(name="alice"))
+
+
+class FakeRedmine():
+    def __init__(self):
+        self.tickets = []
+        self.queries = []
+
+    def tickets_updated_since(self, timestr:str):
+        self.queries.append(timestr)
+        return [t for t in self.tickets if t.updated_on >= timestr]
+
+    def get_ticket(self, ticket_id:int, include_journals:bool=False):
+        self.queries.append(ticket_id)
+        return next((t for t in self.tickets if t.id == ticket_id), None)
+
+
+class TestChangeFeed(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.states = store.TicketStates(os.path.join(self.tmpdir.name, "test.db"))
+        self.redmine = FakeRedmine()
+        self.feed = changes.ChangeFeed(self.redmine, self.states)
+        self.states.set_cursor(changes.CURSOR, "2023-11-10T00:00:00Z")
+
+    def tearDown(self):
+        self.states.close()
+        self.tmpdir.cleanup()
+
+    def kinds(self, events):
+        return [(event.ticket.id, event.kind) for event in events]
+
+    def test_first_run(self):
+        self.states.execute("DELETE FROM cursors")
+        self.assertEqual([], self.feed.poll())
+        self.assertIsNotNone(self.states.cursor(changes.CURSOR))
+        self.assertEqual([], self.redmine.queries)
+
+    def test_events(self):
+        self.redmine.tickets = [
+            ticket(1, "2023-11-10T09:00:00Z", created_on="2023-11-10T09:00:00Z"),
+            ticket(2, "2023-11-10T09:30:00Z"),
+        ]
+        self.assertEqual([(1, changes.CREATED), (2, changes.UPDATED)], self.kinds(self.feed.poll()))
+        self.assertEqual("2023-11-10T09:30:00Z", self.states.cursor(changes.CURSOR))
+        # without subscribers for notes, one query per poll
+        self.assertEqual(["2023-11-10T00:00:00Z"], self.redmine.queries)
+
+        # nothing new: the tickets at the cursor aren't repeated, or fetched
+        self.redmine.queries.clear()
+        self.assertEqual([], self.feed.poll())
+        self.assertEqual(["2023-11-10T09:30:00Z"], self.redmine.queries)
+
+        self.redmine.tickets = [
+            ticket(1, "2023-11-10T10:00:00Z", status="In Progress", assigned="infra", created_on="2023-11-10T09:00:00Z"),
+            ticket(2, "2023-11-10T10:05:00Z"),
+        ]
+        events = self.feed.poll()
+        self.assertEqual([(1, changes.STATUS), (1, changes.ASSIGNED), (2, changes.UPDATED)], self.kinds(events))
+        self.assertEqual(("New", "In Progress"), (events[0].old, events[0].new))
+        self.assertEqual((None, "infra"), (events[1].old, events[1].new))
+
+    def test_notes(self):
+        self.feed.subscribe(lambda event: None, notes=True)
+        self.redmine.tickets = [ticket(1, "2023-11-10T09:00:00Z", journals=[journal(10, "2023-11-09T12:00:00Z", "old")])]
+        self.assertEqual([(1, changes.UPDATED)], self.kinds(self.feed.poll()))
+
+        # a note, and a change without one
+        self.redmine.tickets = [ticket(1, "2023-11-10T10:00:00Z", status="In Progress", journals=[
+            journal(10, "2023-11-09T12:00:00Z", "old"),
+            journal(11, "2023-11-10T10:00:00Z", "on it"),
+            journal(12, "2023-11-10T10:00:00Z"),
+        ])]
+        events = self.feed.poll()
+        self.assertEqual([(1, changes.STATUS), (1, changes.NOTE)], self.kinds(events))
+        self.assertEqual(11, events[1].journal.id)
+        self.assertEqual("#1 note by alice", str(events[1]))
+
+    def test_subscribers(self):
+        received = []
+        self.feed.subscribe(received.append)
+        self.feed.subscribe(lambda event: 1/0) # failing subscribers don't stop the others
+        self.redmine.tickets = [ticket(3, "2023-11-10T11:00:00Z")]
+        self.feed.synchronize()
+        self.assertEqual([(3, changes.UPDATED)], self.kinds(received))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -94,10 +94,11 @@ class TestSCNCog(test_utils.BotTestCase):
         ctx = self.build_context()
         ctx.channel = unittest.mock.AsyncMock(discord.Thread)
         ctx.channel.name = f"Ticket #{test_ticket}: Search for subject match in email threading"
-        ctx.channel.id = self.tag
+        ctx.channel.id = 1000 + test_ticket # thread ids are ints, they're stored
         
         await self.cog.sync(ctx)
-        ctx.respond.assert_called_with(f"SYNC ticket {test_ticket} to thread id: {self.tag} complete")
+        ctx.respond.assert_called_with(f"SYNC ticket {test_ticket} to thread id: {ctx.channel.id} complete")
+        self.bot.unregister_thread(ctx.channel.id)
         # check for actual changes! updated timestamp!
 
 
@@ -8,12 +8,14 @@ import os
 from dotenv import load_dotenv
 
 from typing import Any
+from types import SimpleNamespace
 
 from redmine import Client
 from netbot import NetBot
 import discord
 import test_utils
-import datetime as dt
+import cog_tickets
+from prefix import PrefixIndex
 
 #logging.basicConfig(level=logging.DEBUG)
 
@@ -100,8 +102,6 @@ class TestTicketsCog(test_utils.BotTestCase):
 
     # create thread/sync 
     async def test_thread_sync(self):
-        timestamp = dt.datetime.now().astimezone(dt.timezone.utc).replace(microsecond=0) # strip microseconds
-
         # create a ticket and add a note
         subject = f"Test Thread Ticket {self.tag}"
         text = f"This is a test thread ticket tagged with {self.tag}"
@@ -117,6 +117,7 @@ class TestTicketsCog(test_utils.BotTestCase):
         ctx.channel.name = f"Test Channel {self.tag}"
         ctx.channel.id = self.tag
         thread = unittest.mock.AsyncMock(discord.Thread)
+        thread.id = 1000 + ticket.id # any id, to be routed to the ticket
         # setup history with a message from the user - disabled while I work out the history mock.
         #member = unittest.mock.AsyncMock(discord.Member)
         #member.name=self.discord_user
@@ -138,19 +139,48 @@ class TestTicketsCog(test_utils.BotTestCase):
 
         # test note appended to thread
         #log.info(f"#### send args: {thread.send.call_args}")
-        send_args = str(thread.send.call_args) # hacky
+        send_args = str(thread.send.call_args_list) # hacky, the thread url note comes last
         # call('> **test-s5xyrj Testy** at *2023-12-20T01:28:32Z*\n\nThis is a test note tagged with s5xyrj\n')
         self.assertIn(self.fullName, send_args)
         self.assertIn(note, send_args)
+        self.assertEqual(ticket.id, self.bot.thread_tickets[thread.id])
+        self.bot.unregister_thread(thread.id)
         
-        # test redmine syncdata
-        ticket = self.redmine.get_ticket(ticket.id)
-        last_update = self.redmine.get_field(ticket, "sync")
-        self.assertLessEqual(timestamp, last_update) # hack for TCs that complete in the same second
+        # test the sync state: up to the last note, without writing to redmine
+        ticket = self.redmine.get_ticket(ticket.id, include_journals=True)
+        _, last_journal_id = self.bot.sync_state.get(thread.id)
+        self.assertEqual(ticket.journals[-1].id, last_journal_id)
         
         # delete the ticket
         self.redmine.remove_ticket(ticket.id)
 
 
+class TestAutocomplete(unittest.TestCase):
+    """Query completion, from the redmine indexes"""
+
+    def setUp(self):
+        alice = SimpleNamespace(id=7, login="alice")
+        client = SimpleNamespace(
+            team_index=PrefixIndex(["infra", "install"]),
+            login_index=PrefixIndex(["alice", "ian"]),
+            discord_index=PrefixIndex(["alicat", "icarus"]),
+            find_discord_user={"alicat": alice}.get)
+        self.bot = SimpleNamespace(redmine=client)
+
+    def complete(self, value:str) -> list:
+        return cog_tickets.autocomplete_params(SimpleNamespace(bot=self.bot, value=value))
+
+    def test_params(self):
+        self.assertEqual(["status:open infra", "status:open install"], self.complete("status:open in"))
+        self.assertEqual(["team:infra", "team:install"], self.complete("team:in"))
+
+    def test_discord_names(self):
+        # paired discord names complete to the login, once
+        self.assertEqual(["user:alice"], self.complete("user:ali"))
+        self.assertEqual(["alice"], self.complete("alic"))
+        # and unpaired ones don't complete
+        self.assertEqual([], self.complete("ica"))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
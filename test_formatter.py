@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+import logging
+import datetime as dt
+from types import SimpleNamespace
+
+import formatter
+
+
+log = logging.getLogger(__name__)
+
+URL = "http://redmine.example.com"
+NOW = dt.datetime(2024, 1, 10, 12, 0, tzinfo=dt.timezone.utc)
+
+
+def ticket(ticket_id:int, assigned:str=None, updated_on:str="2024-01-09T12:00:00Z"):
+    t = SimpleNamespace(
+        id=ticket_id,
+        subject=f"Ticket {ticket_id}",
+        priority=SimpleNamespace(name="Normal"),
+        status=SimpleNamespace(name="New"),
+        updated_on=updated_on)
+    if assigned:
+        t.assigned_to = SimpleNamespace(name=assigned)
+    return t
+
+
+class TestRowFormatter(unittest.TestCase):
+
+    def test_format(self):
+        rows = formatter.RowFormatter(formatter.DEFAULT_FIELDS, URL).format(
+            [ticket(1, "Alice"), ticket(2)], NOW)
+
+        lines = rows.split("\n")
+        self.assertEqual(2, len(lines))
+        self.assertEqual(f"[1]({URL}/issues/1) Normal 2024-01-09T12:00:00Z Alice Ticket 1", lines[0])
+        # unassigned is blank
+        self.assertEqual(f"[2]({URL}/issues/2) Normal 2024-01-09T12:00:00Z  Ticket 2", lines[1])
+
+    def test_rows(self):
+        rows = formatter.RowFormatter(["id", "status", "assigned"], URL).rows([ticket(3)], NOW)
+        self.assertEqual([["3", "New", ""]], rows)
+
+    def test_age(self):
+        batch = formatter.Batch(URL, NOW)
+        self.assertEqual(dt.timedelta(days=1), batch.age("2024-01-09T12:00:00Z"))
+        self.assertIs(batch.natural_age("2024-01-09T12:00:00Z"), batch.natural_age("2024-01-09T12:00:00Z"))
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            formatter.RowFormatter(["id", "bogus"], URL)
+
+    def test_compiled_once(self):
+        first = formatter.compile_fields(("id", "subject"), URL)
+        self.assertIs(first, formatter.compile_fields(("id", "subject"), URL))
+
+    def test_speed(self):
+        tickets = [ticket(i, f"user{i % 7}", f"2024-01-0{1 + i % 9}T12:00:00Z") for i in range(500)]
+        row_formatter = formatter.RowFormatter(formatter.DEFAULT_FIELDS + ("age",), URL)
+
+        start = time.perf_counter()
+        row_formatter.format(tickets)
+        per_row = (time.perf_counter() - start) / len(tickets)
+        log.info(f"formatted {len(tickets)} tickets at {per_row * 1e6:.1f} usec per row")
+        self.assertLess(per_row, 0.0005)
+
+
+if __name__ == '__main__':
+    unittest.main()
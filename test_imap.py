@@ -3,7 +3,15 @@
 import unittest
 import logging
 import os, glob
+import time
+import email
+import email.policy
+import imaplib
+import tempfile
+import threading
 import datetime as dt
+from types import SimpleNamespace
+from unittest import mock
 
 from dotenv import load_dotenv
 
@@ -52,13 +60,6 @@ class TestMessages(unittest.TestCase):
                 self.assertNotIn("1600 Amphitheatre Pkwy", message.note)
                 self.assertNotIn("Mountain View CA 94043 USA", message.note)
                 
-    def test_email_address_parsing(self):
-        from_address =  "Fred Example <freddy@example.com>"
-        first, last, addr = self.imap.parse_email_address(from_address)
-        self.assertEqual(first, "Esther")
-        self.assertEqual(last, "Jang")
-        self.assertEqual(addr, "freddy@example.com")
-
     # disabled so I don't flood the system with files
     @unittest.skip
     def test_upload(self):
@@ -126,5 +127,312 @@ class TestMessages(unittest.TestCase):
             self.assertEqual(int(item["id"]), tickets[0].id)
 
 
+class TestBodyCleaner(unittest.TestCase):
+
+    def test_prefix_trie_regex(self):
+        pattern = imap.prefix_trie_regex(["abc", "abd", "x", "xy"])
+        self.assertEqual("(?:ab(?:c|d)|x)", pattern)
+
+    def test_cutoffs(self):
+        cleaner = imap.BodyCleaner([imap.QUOTE_RULES])
+        text = "Hello\n\nOn Tue, Oct 31, 2023 Fred <fred@example.com>\nwrote:\n> quoted"
+        self.assertEqual("Hello", cleaner.clean(text))
+        text = "Thanks!\n-- \nFred Example\nExample Corp"
+        self.assertEqual("Thanks!", cleaner.clean(text))
+
+    def test_added_rules(self):
+        cleaner = imap.BodyCleaner([imap.QUOTE_RULES, imap.GOOGLE_VOICE_RULES])
+        cleaner.add_rules(imap.RuleSet("test gateway", prefixes=["Sent via Test SMS"]))
+        text = "Call me back\nSent via Test SMS gateway\nGoogle LLC\n1600 Amphitheatre Pkwy"
+        self.assertEqual("Call me back", cleaner.clean(text))
+
+    def test_subject_cleaned(self):
+        message = imap.Message("Fred <fred@example.com>", "Re: Fwd: Broken router")
+        self.assertEqual("Fwd: Broken router", message.subject_cleaned())
+
+
+class TestHTMLConversion(unittest.TestCase):
+    # minimum conversion rate for the HTML parts of the test/*.eml corpus
+    THROUGHPUT_TARGET = 2_000_000 # chars per second
+
+    def html_parts(self) -> list[str]:
+        parts = []
+        for filename in glob.glob('test/*.eml'):
+            with open(filename, 'rb') as file:
+                root = email.message_from_bytes(file.read(), policy=email.policy.default)
+                for part in root.walk():
+                    if part.get_content_type() == 'text/html' and not part.is_attachment():
+                        parts.append(part.get_content())
+        return parts
+
+    def test_html_to_text(self):
+        html = ("<html><head><style>p { color: red }</style></head><body>"
+            "<p>Hello   <b>world</b>!</p><script>if (a<b) alert('x')</script>"
+            "<ul><li>one</li><li>two</li></ul>a<br>b &amp; c</body></html>")
+        expected = "Hello world!\n\n* one\n* two\n\na\nb & c"
+        self.assertEqual(expected, imap.html_to_text(html))
+        # same result when streamed in small chunks
+        self.assertEqual(expected, imap.html_to_text(html, chunk_size=5))
+
+    def test_chunked_comment(self):
+        # conditional comments, as in Outlook mail, split across chunks
+        html = ("<p>Hi</p><!--[if mso]><table><tr><td>outlook only</td></tr></table><![endif]-->"
+            "<p>Bye</p>")
+        for chunk_size in (5, 40, 64 * 1024):
+            self.assertEqual("Hi\n\nBye", imap.html_to_text(html, chunk_size=chunk_size), chunk_size)
+
+    def test_corpus_throughput(self):
+        parts = self.html_parts()
+        self.assertGreater(len(parts), 0)
+        size = sum(len(part) for part in parts)
+
+        start = time.perf_counter()
+        for part in parts:
+            imap.html_to_text(part)
+        elapsed = time.perf_counter() - start
+
+        log.info(f"converted {size} chars of HTML in {elapsed:.3f} sec")
+        self.assertGreater(size / elapsed, self.THROUGHPUT_TARGET)
+
+
+class TestAttachments(unittest.TestCase):
+
+    def test_spooled_decode(self):
+        with open("test/message-161.eml", 'rb') as file:
+            root = email.message_from_bytes(file.read(), policy=email.policy.default)
+
+        for part in root.walk():
+            if part.is_attachment():
+                expected = part.get_payload(decode=True)
+                attachment = imap.Attachment(part.get_filename(), part.get_content_type())
+                imap.decode_attachment(part, attachment)
+
+                self.assertEqual(len(expected), attachment.size)
+                self.assertEqual(len(expected), len(attachment.stream()))
+                self.assertEqual(expected, b''.join(attachment.chunks(chunk_size=1000)))
+
+
+class FakeRedmine():
+    """Recent open tickets and their authors, for duplicate detection"""
+    def __init__(self, tickets:list, users:dict):
+        self.tickets = {ticket.id: ticket for ticket in tickets}
+        self.users = users # email -> user
+        self.fetches = 0
+
+    def recent_open_tickets(self, days:int):
+        self.fetches += 1
+        return list(self.tickets.values())
+
+    def find_user(self, addr:str):
+        return self.users.get(addr)
+
+    def get_ticket(self, ticket_id:int):
+        return self.tickets.get(ticket_id)
+
+
+class TestDuplicates(unittest.TestCase):
+    NOTE = "The wifi router on the third floor keeps dropping connections every few minutes since yesterday"
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {"NETBOT_DB": os.path.join(self.tmp.name, "netbot.db")})
+        self.env.start()
+        alice, bob = SimpleNamespace(id=7, login="alice"), SimpleNamespace(id=8, login="bob")
+        self.redmine = FakeRedmine(
+            [SimpleNamespace(id=101, description=self.NOTE, author=SimpleNamespace(id=alice.id))],
+            {"alice@example.com": alice, "bob@example.com": bob})
+        self.imap = imap.Client(self.redmine)
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def message(self, from_addr:str) -> imap.Message:
+        message = imap.Message(from_addr, "wifi")
+        message.set_note(self.NOTE + "!")
+        return message
+
+    def test_same_sender(self):
+        self.assertEqual(101, self.imap.find_duplicate(self.message("Alice <alice@example.com>")).id)
+
+    def test_other_sender(self):
+        self.assertIsNone(self.imap.find_duplicate(self.message("Bob <bob@example.com>")))
+        self.assertIsNone(self.imap.find_duplicate(self.message("Carol <carol@example.com>")))
+
+    def test_built_once(self):
+        threads = [threading.Thread(target=self.imap.duplicate_index) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, self.redmine.fetches)
+
+        self.imap.reset_duplicates()
+        self.imap.find_duplicate(self.message("Alice <alice@example.com>"))
+        self.assertEqual(2, self.redmine.fetches)
+
+
+class TestRelease(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {"NETBOT_DB": os.path.join(self.tmp.name, "netbot.db")})
+        self.env.start()
+        self.imap = imap.Client(FakeRedmine([], {}))
+        self.data = b"From: Alice <alice@example.com>\r\nSubject: wifi\r\nMessage-ID: <1@example.com>\r\n\r\nnot spam\r\n"
+        self.imap.spam_filter.stats.quarantine("<1@example.com>", "101", self.data, 0.99, "x-spam-flag")
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def test_release(self):
+        with mock.patch.object(self.imap, "ingest") as ingest:
+            self.imap.release("<1@example.com>")
+        self.assertEqual("not spam", ingest.call_args.args[1].note.strip())
+        self.assertEqual([], self.imap.spam_filter.stats.quarantined())
+
+    def test_release_fails(self):
+        # out of quarantine, and into the dead letters to be replayed
+        with mock.patch.object(self.imap, "ingest", side_effect=ConnectionError("redmine down")):
+            with self.assertLogs(imap.log, logging.ERROR):
+                self.imap.release("<1@example.com>")
+        self.assertEqual([], self.imap.spam_filter.stats.quarantined())
+        [(key, uid, data, attempts)] = self.imap.dead_letters.due(force=True)
+        self.assertEqual(("101", self.data), (uid, data))
+
+
+class TestFetchFolder(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {"NETBOT_DB": os.path.join(self.tmp.name, "netbot.db")})
+        self.env.start()
+        self.imap = imap.Client(FakeRedmine([], {}))
+        self.server = mock.Mock()
+        self.server.search.return_value = [101, 102]
+        self.server.fetch.return_value = {uid: {b"RFC822": b"Subject: wifi\r\n\r\nit's down\r\n"} for uid in (101, 102)}
+        # each message parsed with an attachment
+        self.attachments = []
+        parse = self.imap.parse_message
+        def parse_message(data):
+            message = parse(data)
+            self.attachments.append(imap.Attachment("log.txt", "text/plain", b"log"))
+            message.add_attachment(self.attachments[-1])
+            return message
+        self.imap.parse_message = parse_message
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def test_attachments_closed(self):
+        # once handled, or failed
+        with mock.patch.object(self.imap, "check_spam", return_value=False), \
+                mock.patch.object(self.imap, "ingest", side_effect=[True, ConnectionError("redmine down")]):
+            with self.assertLogs(imap.log, logging.ERROR):
+                self.imap.fetch_folder(self.server, "INBOX")
+        self.assertEqual([True, True], [attachment.file.closed for attachment in self.attachments])
+
+
+class FakeServer():
+    """Stands in for IMAPClient, counting the calls made"""
+    def __init__(self, log):
+        self.log = log
+        self.alive = True
+
+    def login(self, user, passwd):
+        self.log.append("login")
+
+    def select_folder(self, folder, readonly=False):
+        self.log.append(f"select {folder}")
+
+    def noop(self):
+        self.log.append("noop")
+        if not self.alive:
+            raise imaplib.IMAP4.abort("socket error: EOF")
+
+    def logout(self):
+        self.log.append("logout")
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.servers = []
+        self.failures = 0 # connections to refuse before succeeding
+
+        def factory():
+            if self.failures > 0:
+                self.failures -= 1
+                raise ConnectionRefusedError("connection refused")
+            server = FakeServer(self.calls)
+            self.servers.append(server)
+            return server
+
+        self.pool = imap.ConnectionPool("imap.example.com", 993, "user", "passwd", size=2, factory=factory)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_reuse(self):
+        for _ in range(3):
+            with self.pool.connection("INBOX"):
+                pass
+        self.assertEqual(["login", "select INBOX"], self.calls)
+        self.assertEqual(1, len(self.servers))
+
+    def test_folders(self):
+        with self.pool.connection("INBOX"):
+            with self.pool.connection("Intake"):
+                pass
+        # each folder keeps its own session selected
+        with self.pool.connection("Intake"):
+            pass
+        with self.pool.connection("INBOX"):
+            pass
+        self.assertEqual(2, len(self.servers))
+        self.assertEqual(2, self.calls.count("select INBOX") + self.calls.count("select Intake"))
+
+    def test_reconnect(self):
+        with self.pool.connection("INBOX"):
+            pass
+        session = self.pool.idle[0]
+        session.last_used -= imap.NOOP_INTERVAL + 1 # idle long enough to check
+        self.servers[0].alive = False
+
+        with self.pool.connection("INBOX") as server:
+            self.assertIs(self.servers[1], server)
+        self.assertEqual(["login", "select INBOX", "noop", "logout", "login", "select INBOX"], self.calls)
+        self.assertEqual(1, self.pool.count)
+
+    def test_broken_connection(self):
+        with self.assertRaises(imaplib.IMAP4.abort):
+            with self.pool.connection("INBOX"):
+                raise imaplib.IMAP4.abort("socket error: EOF")
+        self.assertEqual(0, self.pool.count)
+        self.assertEqual(0, len(self.pool.idle))
+
+    def test_backoff(self):
+        self.failures = 2
+        saved = imap.RECONNECT_DELAY
+        imap.RECONNECT_DELAY = 0.01
+        try:
+            with self.pool.connection("INBOX"):
+                pass
+        finally:
+            imap.RECONNECT_DELAY = saved
+        self.assertEqual(1, len(self.servers))
+
+    def test_keepalive(self):
+        with self.pool.connection("INBOX"):
+            pass
+        self.pool.idle[0].last_used -= imap.NOOP_INTERVAL + 1
+        self.pool.keepalive()
+        self.assertEqual("noop", self.calls[-1])
+        self.assertEqual(1, len(self.pool.idle))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import os
+import unittest
+import logging
+import tempfile
+from unittest import mock
+
+import imap
+import importer
+
+
+log = logging.getLogger(__name__)
+
+
+MBOX = b"""From alice@example.com Mon Oct 19 10:00:00 2026
+From: Alice <alice@example.com>
+Subject: router
+Message-ID: <1@example.com>
+
+the router is down
+>From the roof, it looks fine
+>>From here, quoted
+
+From bob@example.com Mon Oct 19 11:00:00 2026
+From: Bob <bob@example.com>
+Subject: broken
+Message-ID: <2@example.com>
+
+this one fails
+"""
+
+
+class FakeClient(imap.Client):
+    """Parses messages as imap.Client does, without redmine, failing to handle some"""
+    def __init__(self, dead_letters):
+        self.dead_letters = dead_letters
+        self.ingested = []
+
+    def find_or_create_user(self, message):
+        pass
+
+    def ingest(self, msg_id:str, message:imap.Message):
+        if "fails" in message.note:
+            raise Exception("redmine unavailable")
+        self.ingested.append(message)
+
+
+class TestImporter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.mbox = os.path.join(self.tmpdir.name, "archive.mbox")
+        with open(self.mbox, "wb") as file:
+            file.write(MBOX)
+        self.dead_letters = mock.Mock()
+        self.client = FakeClient(self.dead_letters)
+        self.importer = importer.Importer(self.client, os.path.join(self.tmpdir.name, "checkpoint.json"))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_unescape_from(self):
+        messages = [data for _, data in importer.mbox_messages(self.mbox)]
+        self.assertEqual(2, len(messages))
+        self.assertIn(b"\nFrom the roof", messages[0])
+        self.assertIn(b"\n>From here", messages[0])
+
+    def test_failures_dead_lettered(self):
+        self.importer.run(self.mbox)
+
+        self.assertEqual(1, self.importer.imported)
+        self.assertEqual(1, self.importer.failed)
+        self.dead_letters.add.assert_called_once()
+        key, msg_id, data, error = self.dead_letters.add.call_args.args
+        self.assertIn(b"this one fails", data)
+        self.assertIn("redmine unavailable", error)
+        # the checkpoint moved past both, the failure can be replayed
+        self.assertEqual(len(MBOX), self.importer.load_checkpoint(os.path.abspath(self.mbox)))
+
+    def test_attachments_closed(self):
+        attachments = []
+        parse = self.client.parse_message
+        def parse_message(data):
+            message = parse(data)
+            attachments.append(imap.Attachment("log.txt", "text/plain", b"log"))
+            message.add_attachment(attachments[-1])
+            return message
+        self.client.parse_message = parse_message
+
+        self.importer.run(self.mbox)
+
+        # once handled, or failed
+        self.assertEqual([True, True], [attachment.file.closed for attachment in attachments])
+
+
+if __name__ == '__main__':
+    unittest.main()
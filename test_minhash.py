@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import unittest
+import logging
+import time
+
+import minhash
+
+
+log = logging.getLogger(__name__)
+
+
+class TestMinHash(unittest.TestCase):
+
+    def setUp(self):
+        self.index = minhash.MinHashIndex()
+        self.index.add(101, "The wifi router on the third floor keeps dropping connections every few minutes since yesterday")
+        self.index.add(102, "Please reset my password for the community portal, I can no longer log in with my email")
+        self.index.add(103, "New text message from 555-1212: is the network down in the south building? nothing loads")
+
+    def test_shingles(self):
+        self.assertEqual({"a b c", "b c d"}, minhash.shingles("A b, c D"))
+        self.assertEqual({"hi there"}, minhash.shingles("Hi there!"))
+        self.assertEqual(set(), minhash.shingles("  "))
+
+    def test_near_duplicate(self):
+        ticket_id, similarity = self.index.query(
+            "The wifi router on the third floor keeps dropping connections every few minutes since yesterday!!")
+        self.assertEqual(101, ticket_id)
+        self.assertGreaterEqual(similarity, minhash.THRESHOLD)
+
+    def test_not_duplicate(self):
+        ticket_id, _ = self.index.query("Can someone add me to the infrastructure team so I can help with installs")
+        self.assertIsNone(ticket_id)
+
+    def test_accept(self):
+        text = "The wifi router on the third floor keeps dropping connections every few minutes since yesterday"
+        ticket_id, _ = self.index.query(text, accept=lambda key: key != 101)
+        self.assertIsNone(ticket_id)
+
+    def test_remove(self):
+        self.index.remove(102)
+        ticket_id, _ = self.index.query("Please reset my password for the community portal, I can no longer log in with my email")
+        self.assertIsNone(ticket_id)
+        self.assertEqual(2, len(self.index))
+
+    def test_lookup_time(self):
+        text = "New text message from 555-1212: is the network down in the south building? nothing loads"
+        start = time.perf_counter()
+        for _ in range(100):
+            self.index.query(text)
+        elapsed = (time.perf_counter() - start) / 100
+        log.info(f"query took {elapsed * 1000:.3f} ms")
+        self.assertLess(elapsed, 0.001)
+
+
+if __name__ == '__main__':
+    unittest.main()
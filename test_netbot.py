@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 
+import os
 import unittest
 import logging
+import tempfile
+import sqlite3
 import discord
 import asyncio
+import datetime as dt
+from unittest import mock
+from types import SimpleNamespace
 
 from dotenv import load_dotenv
 
 import netbot
+import redmine
+import store
 
 import test_utils
 
@@ -32,8 +40,11 @@ class TestNetbot(test_utils.BotTestCase):
         
         message = unittest.mock.AsyncMock(discord.Message)
         message.content = note
+        message.attachments = []
         message.channel = unittest.mock.AsyncMock(discord.Thread)
         message.channel.name = f"Ticket #{test_ticket}: Search for subject match in email threading"
+        message.channel.id = 1000 + test_ticket # any id, as long as it's routed
+        self.bot.register_thread(message.channel.id, test_ticket)
         message.author = unittest.mock.AsyncMock(discord.Member)
         message.author.name = self.discord_user
         
@@ -43,7 +54,296 @@ class TestNetbot(test_utils.BotTestCase):
         ticket = self.redmine.get_ticket(218, include_journals=True) # get the notes
         self.assertIsNotNone(ticket)
         self.assertIn(note, ticket.journals[-1].notes)
+        self.bot.unregister_thread(message.channel.id)
     
 
+class FakeRedmine():
+    """The redmine calls used to sync a thread, over tickets in memory"""
+    get_field = redmine.Client.get_field
+
+    def __init__(self):
+        self.url = "http://redmine.example.com"
+        self.users = {} # discord name -> user
+        self.journals = [] # for one ticket
+        self.attachments = []
+        self.uploads = {} # url -> token, or exception to raise
+
+    def add_user(self, discord_name:str, user_id:int):
+        self.users[discord_name] = SimpleNamespace(id=user_id, login=f"user{user_id}", name=f"User {user_id}")
+
+    def add_journal(self, user_id:int, notes:str, created_on:str="2024-01-10T12:00:00Z", details=[]):
+        journal = SimpleNamespace(id=100 + len(self.journals), notes=notes, created_on=created_on, details=details,
+                                  user=SimpleNamespace(id=user_id, name=f"User {user_id}"))
+        self.journals.append(journal)
+        return journal
+
+    def find_discord_user(self, name:str):
+        return self.users.get(name)
+
+    def get_ticket(self, ticket_id:int, include_journals:bool=False):
+        return SimpleNamespace(id=ticket_id, subject="a ticket", custom_fields=[], journals=list(self.journals))
+
+    def get_notes_after(self, ticket_id:int, journal_id:int=None):
+        return [journal for journal in self.journals
+                if journal.notes and (journal_id is None or journal.id > journal_id)]
+
+    def get_attachments(self, ticket_id:int):
+        return self.attachments
+
+    def append_message(self, ticket_id:int, user_login:str, note:str, attachments=None, return_journal:bool=False):
+        user = next(user for user in self.users.values() if user.login == user_login)
+        # uploads become attachments of the ticket
+        details = []
+        for upload in attachments or []:
+            attachment = SimpleNamespace(id=len(self.attachments) + 1, filename=upload.name, filesize=10,
+                                         author=SimpleNamespace(name=user.name), content_url=f"{self.url}/{upload.name}")
+            self.attachments.append(attachment)
+            details.append(SimpleNamespace(property="attachment", name=str(attachment.id)))
+        journal = self.add_journal(user.id, note, details=details)
+        return journal if return_journal else None
+
+    journal_attachment_ids = redmine.Client.journal_attachment_ids
+
+    def download_attachment(self, attachment, file):
+        file.write(b"content")
+        file.seek(0)
+
+    def upload_url(self, user_id, url:str, size:int, filename:str, content_type:str):
+        token = self.uploads[url]
+        if isinstance(token, Exception):
+            raise token
+        return token
+
+
+class FakeThread(discord.Thread):
+    """A discord thread, with its message history"""
+    def __init__(self, thread_id:int, bot_user):
+        self.id = thread_id
+        self.name = f"Ticket #{thread_id}"
+        self.guild = None
+        self.bot_user = bot_user
+        self.messages = []
+        self.next_id = 1000
+
+    def add_message(self, author, content:str, attachments=[]):
+        self.next_id += 1
+        message = SimpleNamespace(id=self.next_id, author=author, content=content,
+                                  attachments=attachments, channel=self)
+        self.messages.append(message)
+        return message
+
+    async def send(self, content:str, **kwargs):
+        return self.add_message(self.bot_user, content)
+
+    async def history(self, limit=None, after=None, oldest_first=True):
+        for message in list(self.messages):
+            if after is None or message.id > after.id:
+                yield message
+
+
+class TestThreadSync(unittest.IsolatedAsyncioTestCase):
+    """Syncing threads and tickets, with redmine and discord faked"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {"NETBOT_DB": os.path.join(self.tmpdir.name, "test.db")})
+        self.env.start()
+        self.redmine = FakeRedmine()
+        self.redmine.add_user("alice", 7)
+        self.bot_user = SimpleNamespace(id=1, name="netbot")
+        self.user_patch = mock.patch.object(netbot.NetBot, "user", new_callable=mock.PropertyMock,
+                                            return_value=self.bot_user)
+        self.user_patch.start()
+        self.bot = netbot.NetBot(self.redmine)
+        self.thread = FakeThread(500, self.bot_user)
+        self.alice = SimpleNamespace(id=7, name="alice")
+
+    def tearDown(self):
+        self.user_patch.stop()
+        self.env.stop()
+        self.tmpdir.cleanup()
+
+    def sent(self) -> list:
+        return [message.content for message in self.thread.messages if message.author is self.bot_user]
+
+    async def test_upgrade_from_sync_timestamp(self):
+        # synced by an earlier version, at noon: the time is kept on the ticket
+        synced = dt.datetime(2024, 1, 10, 12, 0, tzinfo=dt.timezone.utc)
+        ticket = self.redmine.get_ticket(42)
+        ticket.custom_fields = [SimpleNamespace(id=1, value="1"), SimpleNamespace(id=4, value="2024-01-10T12:00:00Z")]
+        self.redmine.add_journal(7, "old note", "2024-01-10T11:00:00Z")
+        self.redmine.add_journal(7, "new note", "2024-01-10T13:00:00Z")
+        ticket.journals = list(self.redmine.journals)
+        old = self.thread.add_message(self.alice, "old message")
+        old.id = discord.utils.time_snowflake(synced - dt.timedelta(hours=1))
+        new = self.thread.add_message(self.alice, "new message")
+        new.id = discord.utils.time_snowflake(synced + dt.timedelta(hours=1))
+
+        await self.bot.synchronize_ticket(ticket, self.thread)
+
+        # only what's new since the last sync is relayed, each way
+        self.assertEqual(1, len(self.sent()))
+        self.assertIn("new note", self.sent()[0])
+        self.assertEqual(["old note", "new note", "new message"], [j.notes for j in self.redmine.journals])
+
+    async def test_never_synced(self):
+        self.redmine.add_journal(7, "a note")
+        self.thread.add_message(self.alice, "a message")
+
+        await self.bot.synchronize_ticket(self.redmine.get_ticket(42), self.thread)
+
+        self.assertEqual(1, len(self.sent()))
+        self.assertEqual(["a note", "a message"], [j.notes for j in self.redmine.journals])
+
+
+    async def test_sync_progress(self):
+        self.redmine.add_journal(7, "a note")
+        self.thread.add_message(self.alice, "a message")
+        progress = mock.AsyncMock()
+
+        await self.bot.synchronize_ticket(self.redmine.get_ticket(42), self.thread, progress=progress)
+
+        # reported as each note and message is relayed
+        self.assertEqual(2, progress.await_count)
+        self.assertIn("1 of 1 notes, 1 messages", progress.await_args.args[0])
+
+
+    async def test_relay_then_resync(self):
+        await self.bot.synchronize_ticket(self.redmine.get_ticket(42), self.thread)
+        self.bot.register_thread(self.thread.id, 42)
+
+        # relayed as it's sent, then the ticket is synced
+        message = self.thread.add_message(self.alice, "live message")
+        await self.bot.on_message(message)
+        self.assertEqual(["live message"], [j.notes for j in self.redmine.journals])
+
+        await self.bot.synchronize_ticket(self.redmine.get_ticket(42), self.thread)
+        await self.bot.synchronize_ticket(self.redmine.get_ticket(42), self.thread)
+
+        # not appended again, and the note added for it isn't echoed to the thread
+        self.assertEqual(["live message"], [j.notes for j in self.redmine.journals])
+        self.assertEqual([], self.sent())
+        # and the cursors have moved past them
+        self.assertEqual((message.id, self.redmine.journals[-1].id), self.bot.sync_state.get(self.thread.id))
+
+    async def test_resync_without_echo(self):
+        self.thread.add_message(self.alice, "a message")
+        await self.bot.synchronize_ticket(self.redmine.get_ticket(42), self.thread)
+        await self.bot.synchronize_ticket(self.redmine.get_ticket(42), self.thread)
+
+        # the note added for the message isn't relayed back
+        self.assertEqual(["a message"], [j.notes for j in self.redmine.journals])
+        self.assertEqual([], self.sent())
+
+    async def test_route_from_title(self):
+        # a thread synced before routes were kept
+        self.thread.name = "Ticket #42: Printer on fire"
+        message = self.thread.add_message(self.alice, "hello")
+        await self.bot.on_message(message)
+
+        self.assertEqual(["hello"], [j.notes for j in self.redmine.journals])
+        self.assertEqual(42, self.bot.thread_tickets[self.thread.id])
+
+        # channels that aren't threads aren't looked at
+        message.channel = SimpleNamespace(id=501, name="Ticket #42: general")
+        await self.bot.on_message(message)
+        self.assertEqual(1, len(self.redmine.journals))
+        self.assertNotIn(501, self.bot.thread_tickets)
+
+    async def test_unrouted_title_parsed_once(self):
+        self.thread.name = "printer chat"
+        with mock.patch.object(self.bot, "parse_thread_title", wraps=self.bot.parse_thread_title) as parse:
+            for _ in range(3):
+                await self.bot.on_message(self.thread.add_message(self.alice, "hello"))
+        parse.assert_called_once_with("printer chat")
+        self.assertEqual([], self.redmine.journals)
+
+    async def test_rebuild_routes_retried(self):
+        self.redmine.discord_tickets = mock.Mock(side_effect=[ConnectionError("redmine down"), []])
+        with self.assertLogs(netbot.log, logging.ERROR):
+            await self.bot.poll_events()
+        self.assertFalse(self.bot.routes_rebuilt)
+
+        await self.bot.poll_events()
+        self.assertTrue(self.bot.routes_rebuilt)
+
+    async def test_failed_event_requeued(self):
+        self.bot.routes_rebuilt = True
+        synced = []
+        async def sync_ticket_thread(ticket_id):
+            if ticket_id == 41:
+                raise ConnectionError("discord down")
+            synced.append(ticket_id)
+        self.bot.sync_ticket_thread = sync_ticket_thread
+        self.bot.events.publish(store.EventBus.TICKET_UPDATED, 41)
+        self.bot.events.publish(store.EventBus.TICKET_UPDATED, 42)
+
+        with self.assertLogs(netbot.log, logging.ERROR):
+            await self.bot.poll_events()
+        # the ticket after the failure is synced, and only the failure is left
+        self.assertEqual([42], synced)
+        self.assertEqual([41], [ticket_id for _, _, ticket_id in self.bot.events.poll(netbot.EVENT_SUBSCRIBER)])
+
+        # until it's given up
+        for _ in range(netbot.EVENT_RETRIES - 1):
+            with self.assertLogs(netbot.log, logging.ERROR):
+                await self.bot.poll_events()
+        self.assertEqual([], self.bot.events.poll(netbot.EVENT_SUBSCRIBER))
+
+    async def test_events_for_unrouted_tickets(self):
+        # only tickets with a thread are fetched
+        self.bot.routes_rebuilt = True
+        self.bot.register_thread(self.thread.id, 42)
+        self.bot.get_channel = lambda channel_id: self.thread if channel_id == self.thread.id else None
+        self.redmine.add_journal(7, "from email")
+        self.redmine.get_ticket = mock.Mock(wraps=self.redmine.get_ticket)
+        for ticket_id in (40, 41, 42):
+            self.bot.events.publish(store.EventBus.TICKET_UPDATED, ticket_id)
+
+        await self.bot.poll_events()
+        self.assertEqual([42], [call.args[0] for call in self.redmine.get_ticket.call_args_list])
+        self.assertIn("from email", "".join(self.sent()))
+
+    async def test_poll_errors_logged(self):
+        self.bot.routes_rebuilt = True
+        self.bot.events.poll = mock.Mock(side_effect=sqlite3.OperationalError("database is locked"))
+        with self.assertLogs(netbot.log, logging.ERROR):
+            await self.bot.poll_events()
+
+    async def test_uploads_not_mirrored_back(self):
+        self.bot.register_thread(self.thread.id, 42)
+        self.redmine.uploads["https://cdn.discord.example/photo.png"] = "token-1"
+        attachment = SimpleNamespace(url="https://cdn.discord.example/photo.png", size=10,
+                                     filename="photo.png", content_type="image/png")
+        message = self.thread.add_message(self.alice, "a photo", [attachment])
+        await self.bot.on_message(message)
+        self.assertEqual(1, len(self.redmine.attachments))
+
+        await self.bot.synchronize_ticket(self.redmine.get_ticket(42), self.thread)
+        self.assertEqual([], self.sent())
+
+
+    async def test_upload_attachments(self):
+        self.redmine.uploads["https://cdn.discord.example/good.png"] = "token-1"
+        self.redmine.uploads["https://cdn.discord.example/bad.png"] = ConnectionError("cdn unreachable")
+        attachments = [
+            SimpleNamespace(url="https://cdn.discord.example/good.png", size=10, filename="good.png", content_type="image/png"),
+            SimpleNamespace(url="https://cdn.discord.example/bad.png", size=10, filename="bad.png", content_type=None),
+        ]
+        message = self.thread.add_message(self.alice, "two files", attachments)
+
+        with self.assertLogs(netbot.log, logging.ERROR):
+            uploads = await self.bot.upload_attachments("user7", message)
+        self.assertEqual(["good.png"], [upload.name for upload in uploads])
+        self.assertEqual("token-1", uploads[0].token)
+
+        # the message is still synced, with the file that uploaded
+        self.bot.register_thread(self.thread.id, 42)
+        with self.assertLogs(netbot.log, logging.ERROR):
+            await self.bot.on_message(message)
+        self.assertEqual(["two files"], [j.notes for j in self.redmine.journals])
+        self.assertEqual(["good.png"], [a.filename for a in self.redmine.attachments])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import unittest
+import logging
+from unittest import mock
+
+import pager
+
+
+log = logging.getLogger(__name__)
+
+
+class TestPageView(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.rows = [f"row {i}" for i in range(25)]
+        self.fetches = []
+
+    def fetch_page(self, offset, limit):
+        self.fetches.append((offset, limit))
+        return self.rows[offset:offset+limit], len(self.rows)
+
+    def format_page(self, rows):
+        return "\n".join(rows)
+
+    async def test_pages(self):
+        view = pager.PageView(self.fetch_page, self.format_page)
+        text = await view.render()
+        self.assertIn("row 0", text)
+        self.assertNotIn("row 10", text)
+        self.assertIn("page 1 of 3", text)
+        self.assertTrue(view.previous.disabled)
+        self.assertFalse(view.next.disabled)
+
+        view.page = 2
+        text = await view.render()
+        self.assertIn("row 24", text)
+        self.assertTrue(view.next.disabled)
+
+        # only the pages viewed are fetched, once each
+        view.page = 0
+        await view.render()
+        self.assertEqual([(0, 10), (20, 10)], self.fetches)
+
+    async def test_single_page(self):
+        self.rows = self.rows[:3]
+        view = pager.PageView(self.fetch_page, self.format_page)
+        responder = mock.AsyncMock()
+        await view.start(responder)
+        responder.send.assert_called_once_with("row 0\nrow 1\nrow 2") # no buttons, no footer
+
+    async def test_timeout(self):
+        view = pager.PageView(self.fetch_page, self.format_page)
+        responder = mock.AsyncMock()
+        await view.start(responder)
+        await view.on_timeout()
+
+        self.assertTrue(view.previous.disabled)
+        self.assertTrue(view.next.disabled)
+        responder.edit.assert_awaited_once_with(view=view)
+
+    async def test_timeout_edit_fails(self):
+        view = pager.PageView(self.fetch_page, self.format_page)
+        responder = mock.AsyncMock()
+        responder.edit.side_effect = Exception("Invalid Webhook Token")
+        await view.start(responder)
+        with self.assertLogs(pager.log, logging.WARNING):
+            await view.on_timeout()
+
+    async def test_empty(self):
+        self.rows = []
+        view = pager.PageView(self.fetch_page, self.format_page, empty="No tickets found.")
+        self.assertEqual("No tickets found.", await view.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
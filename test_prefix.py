@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import unittest
+import logging
+from types import SimpleNamespace
+
+from prefix import PrefixIndex, RecentTickets
+
+
+log = logging.getLogger(__name__)
+
+
+class TestPrefixIndex(unittest.TestCase):
+
+    def test_search(self):
+        index = PrefixIndex(["alice", "Bob", "bobby", "carol"])
+        self.assertEqual(["Bob", "bobby"], index.search("bo"))
+        self.assertEqual(["Bob", "bobby"], index.search("BO"))
+        self.assertEqual(["carol"], index.search("c"))
+        self.assertEqual([], index.search("d"))
+        self.assertEqual(4, len(index.search("")))
+
+    def test_limit(self):
+        index = PrefixIndex([f"user{i:03}" for i in range(100)])
+        self.assertEqual(25, len(index.search("user")))
+        self.assertEqual(["user010", "user011"], index.search("user01", limit=2))
+
+    def test_values(self):
+        index = PrefixIndex([("one", 1), ("only", 1), ("two", 2)])
+        self.assertEqual([1], index.search("o"))
+
+
+class TestRecentTickets(unittest.TestCase):
+
+    def ticket(self, ticket_id:int, subject:str):
+        return SimpleNamespace(id=ticket_id, subject=subject)
+
+    def test_search(self):
+        recent = RecentTickets()
+        recent.add([self.ticket(123, "Printer on fire"), self.ticket(456, "Password reset")])
+
+        self.assertEqual([(123, "Printer on fire")], recent.search("12"))
+        self.assertEqual([(123, "Printer on fire")], recent.search("#123"))
+        self.assertEqual(2, len(recent.search("p")))
+        self.assertEqual([(456, "Password reset")], recent.search("pass"))
+
+    def test_bounded(self):
+        recent = RecentTickets(size=2)
+        recent.add([self.ticket(1, "one"), self.ticket(2, "two")])
+        recent.add([self.ticket(1, "one")]) # most recent again
+        recent.add([self.ticket(3, "three")])
+
+        self.assertEqual([(1, "one")], recent.search("1"))
+        self.assertEqual([], recent.search("2"))
+        self.assertEqual([(3, "three")], recent.search("3"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import unittest
+import logging
+import datetime as dt
+from types import SimpleNamespace
+
+from query import compile_query, QueryError
+
+
+log = logging.getLogger(__name__)
+
+NOW = dt.datetime(2024, 1, 10, 12, 0, tzinfo=dt.timezone.utc)
+
+
+def ticket(ticket_id:int, priority:str="Normal", assigned_id:int=None, updated_on:str="2024-01-09T12:00:00Z",
+           status_id:int=1, is_closed:bool=False, subject:str="a ticket"):
+    t = SimpleNamespace(
+        id=ticket_id,
+        subject=subject,
+        priority=SimpleNamespace(name=priority),
+        status=SimpleNamespace(id=status_id, name="New", is_closed=is_closed),
+        tracker=SimpleNamespace(name="Bug"),
+        updated_on=updated_on,
+        created_on=updated_on)
+    if assigned_id:
+        t.assigned_to = SimpleNamespace(id=assigned_id, name=f"user{assigned_id}")
+    return t
+
+
+class FakeRedmine():
+    """the lookups and queries used by queries, recording the queries"""
+    def __init__(self, tickets=[]):
+        self.tickets = tickets
+        self.pages = []
+        self.searches = []
+        self.principals = {"infra": SimpleNamespace(id=42), "alice": SimpleNamespace(id=7)}
+
+    def is_user_or_group(self, name):
+        return name in self.principals
+
+    def find_user(self, name):
+        return self.principals.get(name)
+
+    def find_status(self, name):
+        if name == "In Progress":
+            return SimpleNamespace(id=2, name=name)
+        return None
+
+    def ticket_page(self, filters, offset=0, limit=100, user=None, sort=None):
+        self.pages.append((filters, offset, limit, user, sort))
+        return self.tickets[offset:offset + limit], len(self.tickets)
+
+    def search_page(self, term, offset=0, limit=100):
+        self.searches.append(term)
+        return self.tickets[offset:offset + limit], len(self.tickets)
+
+
+class TestQuery(unittest.TestCase):
+
+    def test_me(self):
+        redmine = FakeRedmine()
+        user = SimpleNamespace(id=7, login="alice")
+        q = compile_query("", redmine, user)
+
+        self.assertTrue(q.is_pushed())
+        q.fetch_page(0, 10)
+        self.assertEqual([("assigned_to_id=me&status_id=open", 0, 10, "alice", None)], redmine.pages)
+
+    def test_unmapped_me(self):
+        with self.assertRaises(QueryError):
+            compile_query("me", FakeRedmine())
+
+    def test_pushed(self):
+        redmine = FakeRedmine()
+        q = compile_query("team:infra status:In-Progress age>3d sort:-age", redmine, now=NOW)
+
+        self.assertTrue(q.is_pushed())
+        self.assertEqual("assigned_to_id=42&status_id=2&updated_on=%3C%3D2024-01-07T12:00:00Z", q.filters())
+        self.assertEqual("updated_on", q.sort())
+
+    def test_bare_words(self):
+        q = compile_query("infra", FakeRedmine())
+        self.assertEqual("assigned_to_id=42&status_id=open", q.filters())
+
+        q = compile_query("#123", FakeRedmine())
+        self.assertEqual("issue_id=123&status_id=*", q.filters())
+
+    def test_local(self):
+        tickets = [ticket(1, "Low"), ticket(2, "High"), ticket(3, "Urgent", is_closed=True), ticket(4, "Normal")]
+        redmine = FakeRedmine(tickets)
+        q = compile_query("status:all prio>=normal", redmine)
+
+        self.assertFalse(q.is_pushed())
+        page, total = q.fetch_page(0, 2)
+        self.assertEqual(3, total)
+        self.assertEqual([2, 3], [t.id for t in page])
+        # the second page comes from the tickets already fetched
+        page, total = q.fetch_page(2, 2)
+        self.assertEqual([4], [t.id for t in page])
+        self.assertEqual(1, len(redmine.pages))
+        self.assertEqual("status_id=*", redmine.pages[0][0])
+
+    def test_unknown_priority(self):
+        # a priority added in redmine, but not known here, doesn't match
+        redmine = FakeRedmine([ticket(1, "Critical"), ticket(2, "High")])
+        page, total = compile_query("prio>=high", redmine).fetch_page(0, 10)
+        self.assertEqual([2], [t.id for t in page])
+
+    def test_search(self):
+        tickets = [ticket(1, "Low", assigned_id=42), ticket(2, "High", assigned_id=42), ticket(3, "Urgent", assigned_id=7)]
+        redmine = FakeRedmine(tickets)
+        q = compile_query("printer fire team:infra sort:-prio", redmine)
+
+        page, total = q.fetch_page(0, 10)
+        self.assertEqual(["printer fire"], redmine.searches)
+        self.assertEqual([2, 1], [t.id for t in page])
+
+    def test_unknown_keys_searched(self):
+        q = compile_query("outage 10:30 a=b", FakeRedmine())
+        self.assertEqual(["outage", "10:30", "a=b"], q.terms)
+        self.assertFalse(q.is_pushed())
+
+    def test_sort_missing_values(self):
+        # unassigned, or an unexpected priority: sorted last, either way
+        tickets = [ticket(1, "Low"), ticket(2, "Custom"), ticket(3, "High"), ticket(4, "Urgent")]
+        del tickets[0].priority
+        for sort, expected in [("sort:prio", [3, 4, 1, 2]), ("sort:-prio", [4, 3, 1, 2])]:
+            q = compile_query(f"router {sort}", FakeRedmine(tickets))
+            page, _ = q.fetch_page(0, 10)
+            self.assertEqual(expected, [t.id for t in page], sort)
+
+    def test_unassigned(self):
+        q = compile_query("status:open assigned!=alice", FakeRedmine())
+        self.assertEqual("status_id=open&assigned_to_id=!7", q.filters())
+        # unassigned tickets don't match local tests on the assignee
+        self.assertFalse(q.predicates[1](ticket(1)))
+
+    def test_errors(self):
+        redmine = FakeRedmine()
+        for text in ["prio>=extreme", "age>soon", "sort:color", "team:nobody", "status:unknown", "age:3d"]:
+            with self.assertRaises(QueryError, msg=text):
+                compile_query(text, redmine)
+
+
+if __name__ == '__main__':
+    unittest.main()
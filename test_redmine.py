@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+import time
+import hashlib
+import threading
+import unittest
+import logging
+from collections import OrderedDict
+from types import SimpleNamespace
+from unittest import mock
+
+import redmine
+
+
+log = logging.getLogger(__name__)
+
+
+class FakeClient(redmine.Client):
+    """A redmine client answering group queries locally, counting the queries"""
+    def __init__(self, teams:dict):
+        self.url = "http://redmine.example.com"
+        self.token = None
+        self.teams = teams # team name -> member names
+        self.queries = []
+        self.on_query = None # called with each query, before it's answered
+        self.lock = threading.Lock()
+        self.team_members = {}
+        self.teams_swept = None
+        self.team_invalidated = {}
+        self.team_lock = threading.Lock()
+        self.unknown_teams = OrderedDict()
+        self.groups = {}
+        self.group_ids = {}
+        self.reindex_groups()
+
+    def group(self, name:str):
+        return SimpleNamespace(id=list(self.teams).index(name) + 1, name=name)
+
+    def query(self, query_str:str, user:str=None):
+        with self.lock:
+            self.queries.append(query_str)
+        if self.on_query:
+            self.on_query(query_str)
+        if query_str.startswith("/groups.json"):
+            return SimpleNamespace(groups=[self.group(name) for name in self.teams])
+        if query_str.startswith("/groups/"):
+            group_id = int(query_str.split('/')[2].split('.')[0])
+            name = list(self.teams)[group_id - 1]
+            group = self.group(name)
+            group.users = [SimpleNamespace(id=i, name=member) for i, member in enumerate(self.teams[name])]
+            return SimpleNamespace(group=group)
+        return None
+
+
+class TestTeamMembers(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeClient({"infra": ["alice", "bob"], "users": ["alice"], "admin": []})
+        self.client.queries.clear()
+
+    def test_sweep(self):
+        teams = self.client.get_all_teams()
+        self.assertEqual({"infra", "users", "admin"}, set(teams))
+        self.assertEqual(["alice", "bob"], [user.name for user in teams["infra"].users])
+        self.assertEqual(3, len(self.client.queries)) # one per team, no group list
+
+        # cached, for all teams and each team
+        self.client.get_all_teams()
+        self.assertEqual("infra", self.client.get_team("infra").name)
+        self.assertEqual(3, len(self.client.queries))
+
+    def test_invalidate(self):
+        self.client.get_all_teams()
+        self.client.teams["infra"].append("carol")
+        self.client.invalidate_team("infra")
+
+        teams = self.client.get_all_teams()
+        self.assertEqual(["alice", "bob", "carol"], [user.name for user in teams["infra"].users])
+        self.assertIn("/groups/1.json?include=users", self.client.queries[3:])
+
+    def test_by_id(self):
+        # cached under the team's name, however it's asked for
+        self.assertEqual("infra", self.client.get_team("1").name)
+        self.assertEqual({"infra"}, set(self.client.team_members))
+        self.assertNotIn("1", self.client.get_all_teams())
+
+        self.client.teams["infra"].append("carol")
+        self.client.find_user = lambda name: SimpleNamespace(id=3, name=name)
+        with mock.patch("redmine.requests.post", return_value=SimpleNamespace(ok=True)):
+            self.client.join_team("carol", "1")
+        self.assertEqual(["alice", "bob", "carol"], [user.name for user in self.client.get_team("infra").users])
+
+    def test_invalidate_during_sweep(self):
+        # someone joins infra while the sweep is fetching it
+        def join(query_str):
+            if query_str.startswith("/groups/1.json"):
+                self.client.on_query = None
+                self.client.teams["infra"] = self.client.teams["infra"] + ["carol"]
+                self.client.invalidate_team("infra")
+        self.client.on_query = join
+
+        self.client.sweep_teams()
+        self.assertNotIn("infra", self.client.team_members)
+        self.assertIn("users", self.client.team_members)
+
+        teams = self.client.get_all_teams()
+        self.assertEqual(["alice", "bob", "carol"], [user.name for user in teams["infra"].users])
+
+    def test_get_team(self):
+        self.assertEqual(["alice"], [user.name for user in self.client.get_team("users").users])
+        queries = len(self.client.queries)
+        self.client.get_team("users")
+        self.assertEqual(queries, len(self.client.queries))
+        self.assertIsNone(self.client.get_team("nobody"))
+
+
+class TestFindTeam(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeClient({"infra": [], "users": []})
+        self.client.queries.clear()
+
+    def test_index_hit(self):
+        self.assertEqual(1, self.client.find_team("infra").id)
+        self.assertEqual("users", self.client.find_team(2).name)
+        self.assertEqual("users", self.client.find_team("2").name)
+        self.assertEqual([], self.client.queries)
+
+    def test_refresh_on_miss(self):
+        self.client.teams["new-team"] = []
+        self.assertEqual("new-team", self.client.find_team("new-team").name)
+        self.assertEqual(["/groups.json?limit=1000"], self.client.queries)
+
+    def test_unknown_cached(self):
+        self.assertIsNone(self.client.find_team("nobody"))
+        self.assertIsNone(self.client.find_team("nobody"))
+        self.assertEqual(1, len(self.client.queries))
+
+        # found once it exists, and the groups are indexed again
+        self.client.teams["nobody"] = []
+        self.client.reindex_groups()
+        self.assertEqual("nobody", self.client.find_team("nobody").name)
+
+    def test_unknown_bounded(self):
+        for i in range(redmine.UNKNOWN_TEAMS + 10):
+            self.client.find_team(f"unknown-{i}")
+        self.assertEqual(redmine.UNKNOWN_TEAMS, len(self.client.unknown_teams))
+        self.assertNotIn("unknown-0", self.client.unknown_teams)
+
+
+class PagedClient(redmine.Client):
+    """A redmine client with many open tickets, answered a page at a time"""
+    def __init__(self, count:int):
+        self.count = count
+        self.queries = []
+
+    def query(self, query_str:str, user:str=None):
+        self.queries.append(query_str)
+        params = dict(param.split('=', 1) for param in query_str.split('?', 1)[1].split('&'))
+        offset, limit = int(params.get("offset", 0)), int(params["limit"])
+        issues = [SimpleNamespace(id=i) for i in range(offset, min(offset + limit, self.count))]
+        return SimpleNamespace(issues=issues, total_count=self.count)
+
+
+class TestRecentOpenTickets(unittest.TestCase):
+
+    def test_all_pages(self):
+        client = PagedClient(250)
+        tickets = client.recent_open_tickets(7)
+        self.assertEqual(list(range(250)), [ticket.id for ticket in tickets])
+        self.assertEqual(3, len(client.queries))
+
+    def test_none(self):
+        self.assertEqual([], PagedClient(0).recent_open_tickets(7))
+
+
+class UpdatedClient(redmine.Client):
+    """A redmine client answering updated_on queries, sorted by updated_on and id"""
+    def __init__(self, tickets:list):
+        self.tickets = tickets
+        self.queries = []
+        self.on_query = None
+
+    def query(self, query_str:str, user:str=None):
+        self.queries.append(query_str)
+        if self.on_query:
+            self.on_query(len(self.queries))
+        params = dict(param.split('=', 1) for param in query_str.split('?', 1)[1].split('&'))
+        since = params["updated_on"].replace("%3E%3D", "")
+        offset, limit = int(params["offset"]), int(params["limit"])
+        matched = sorted((t for t in self.tickets if t.updated_on >= since), key=lambda t: (t.updated_on, t.id))
+        # copies, as parsed from each response
+        issues = [SimpleNamespace(**vars(t)) for t in matched[offset:offset + limit]]
+        return SimpleNamespace(issues=issues, total_count=len(matched))
+
+
+class TestTicketsUpdatedSince(unittest.TestCase):
+
+    def updated(self, ticket_id:int, updated_on:str):
+        return SimpleNamespace(id=ticket_id, updated_on=updated_on)
+
+    def test_same_second(self):
+        # more tickets updated in one second than fit on a page
+        tickets = [self.updated(i, "2024-01-10T12:00:00Z") for i in range(5)]
+        tickets += [self.updated(i, "2024-01-10T12:00:01Z") for i in range(5, 8)]
+        client = UpdatedClient(tickets)
+        found = client.tickets_updated_since("2024-01-10T00:00:00Z", page_size=2)
+        self.assertEqual(list(range(8)), [ticket.id for ticket in found])
+
+    def test_updated_while_paging(self):
+        # with offsets, ticket 1 moving to the end would shift ticket 2 onto
+        # the page already fetched, and it would be skipped
+        tickets = [self.updated(i, f"2024-01-10T12:00:0{i}Z") for i in range(6)]
+        client = UpdatedClient(tickets)
+        def update(queries:int):
+            if queries == 2:
+                tickets[1].updated_on = "2024-01-10T12:00:09Z"
+        client.on_query = update
+
+        found = client.tickets_updated_since("2024-01-10T00:00:00Z", page_size=2)
+        self.assertEqual([0, 2, 3, 4, 5, 1], [ticket.id for ticket in found])
+        self.assertEqual("2024-01-10T12:00:09Z", found[-1].updated_on)
+
+
+class FakeAttachment():
+    def __init__(self, name:str, payload:bytes):
+        self.name = name
+        self.content_type = "text/plain"
+        self.payload = payload
+        self.token = None
+
+    def digest(self) -> str:
+        return hashlib.sha256(self.payload).hexdigest()
+
+    def stream(self):
+        return self.payload
+
+    def set_token(self, token):
+        self.token = token
+
+
+class UploadsClient(redmine.Client):
+    """A redmine client uploading locally, tracking how many uploads run at once"""
+    def __init__(self):
+        self.url = "http://redmine.example.com"
+        self.token = None
+        self.upload_tokens = {}
+        self.uploads = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def upload_file(self, user_id, data, filename, content_type):
+        with self.lock:
+            self.uploads.append(data)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            token = f"token-{len(self.uploads)}"
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+        return token
+
+
+class TestUploadAttachments(unittest.TestCase):
+
+    def setUp(self):
+        self.client = UploadsClient()
+
+    def test_identical_payloads(self):
+        attachments = [FakeAttachment("a.txt", b"same"), FakeAttachment("b.txt", b"same"), FakeAttachment("c.txt", b"other")]
+        self.client.upload_attachments("alice", attachments)
+        self.assertCountEqual([b"same", b"other"], self.client.uploads)
+        self.assertEqual(attachments[0].token, attachments[1].token)
+        self.assertNotEqual(attachments[0].token, attachments[2].token)
+
+    def test_token_reused(self):
+        with mock.patch("redmine.time.time", return_value=1000):
+            self.client.upload_attachments("alice", [FakeAttachment("a.txt", b"same")])
+        again = FakeAttachment("a.txt", b"same")
+        with mock.patch("redmine.time.time", return_value=1000 + redmine.UPLOAD_TOKEN_TTL - 1):
+            self.client.upload_attachments("alice", [again])
+        self.assertEqual(1, len(self.client.uploads))
+        self.assertEqual("token-1", again.token)
+
+        # not for another user, or once the token has expired
+        self.client.upload_attachments("bob", [FakeAttachment("a.txt", b"same")])
+        expired = FakeAttachment("a.txt", b"same")
+        with mock.patch("redmine.time.time", return_value=1000 + redmine.UPLOAD_TOKEN_TTL):
+            self.client.upload_attachments("alice", [expired])
+        self.assertEqual(3, len(self.client.uploads))
+        self.assertEqual("token-3", expired.token)
+
+    def test_released_once_attached(self):
+        attachments = [FakeAttachment("a.txt", b"first")]
+        self.client.upload_attachments("alice", attachments)
+        created = SimpleNamespace(ok=True, text='{"issue": {"id": 42}}')
+        with mock.patch("redmine.requests.post", return_value=created):
+            self.client.create_ticket(SimpleNamespace(login="alice"), "subject", "body", attachments)
+        self.assertEqual({}, self.client.upload_tokens)
+
+        attachments = [FakeAttachment("b.txt", b"second")]
+        self.client.upload_attachments("alice", attachments)
+        with mock.patch("redmine.requests.put", return_value=SimpleNamespace(status_code=204)):
+            self.client.append_message(42, "alice", "a note", attachments)
+        self.assertEqual({}, self.client.upload_tokens)
+
+        # so the same payload is uploaded again, for a new token
+        again = FakeAttachment("b.txt", b"second")
+        self.client.upload_attachments("alice", [again])
+        self.assertEqual("token-3", again.token)
+
+    def test_concurrency_cap(self):
+        attachments = [FakeAttachment(f"{i}.txt", str(i).encode()) for i in range(6)]
+        with mock.patch.object(redmine, "UPLOAD_WORKERS", 2):
+            self.client.upload_attachments("alice", attachments)
+        self.assertEqual(6, len(self.client.uploads))
+        self.assertEqual(2, self.client.max_active)
+
+
+class UsersClient(redmine.Client):
+    """A redmine client answering the user list from responses given, in turn"""
+    def __init__(self, responses:list):
+        self.url = "http://redmine.example.com"
+        self.responses = responses
+        self.during_query = None # called while a query is running
+        self.users = {}
+        self.user_ids = {}
+        self.user_emails = {}
+        self.discord_users = {}
+        self.groups = {}
+
+    def query(self, query_str:str, user:str=None):
+        if self.during_query:
+            self.during_query()
+        return self.responses.pop(0)
+
+
+def user(user_id:int, login:str, discord:str=None):
+    fields = [SimpleNamespace(name="Discord ID", value=discord)] if discord else []
+    return SimpleNamespace(id=user_id, login=login, mail=f"{login}@example.com", custom_fields=fields)
+
+
+class TestReindexUsers(unittest.TestCase):
+
+    def setUp(self):
+        self.client = UsersClient([SimpleNamespace(users=[user(7, "alice", "alicat")])])
+        self.client.reindex_users()
+
+    def test_lookups_during_reindex(self):
+        found = []
+        self.client.during_query = lambda: found.append(self.client.find_user("alice@example.com"))
+        self.client.responses.append(SimpleNamespace(users=[user(7, "alice"), user(8, "bob")]))
+        self.client.reindex_users()
+
+        self.assertEqual(7, found[0].id) # not emptied while the request runs
+        self.assertEqual(8, self.client.find_user("bob").id)
+        self.assertIsNone(self.client.find_discord_user("alicat"))
+
+    def test_failed_reindex(self):
+        self.client.responses.append(None)
+        with self.assertLogs(redmine.log, logging.ERROR):
+            self.client.reindex_users()
+        self.assertEqual(7, self.client.find_user("alice").id)
+        self.assertEqual(["alice"], self.client.login_index.search("al"))
+
+
+if __name__ == '__main__':
+    unittest.main()
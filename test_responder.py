@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+import logging
+from unittest import mock
+
+import discord
+
+import responder
+from responder import Responder
+
+
+log = logging.getLogger(__name__)
+
+
+class TestResponder(unittest.IsolatedAsyncioTestCase):
+
+    def build_context(self):
+        ctx = mock.AsyncMock(discord.ApplicationContext)
+        # defer and edit are properties of ApplicationContext, so aren't mocked as coroutines
+        ctx.defer = mock.AsyncMock()
+        ctx.edit = mock.AsyncMock()
+        ctx.followup = mock.AsyncMock()
+        return ctx
+
+    def test_split_message(self):
+        self.assertEqual(["short"], responder.split_message("short"))
+        lines = "\n".join(f"line {i:04}" for i in range(500)) # ~5000 chars
+        messages = responder.split_message(lines)
+        self.assertEqual(3, len(messages))
+        self.assertTrue(all(len(message) <= responder.MAX_MESSAGE for message in messages))
+        self.assertEqual(lines.split("\n"), "\n".join(messages).split("\n"))
+
+    async def test_fast(self):
+        ctx = self.build_context()
+        async with Responder(ctx) as r:
+            result = await r.run(lambda: "done")
+            await r.send(result)
+        ctx.defer.assert_not_called()
+        ctx.respond.assert_called_once_with("done")
+
+    async def test_slow(self):
+        ctx = self.build_context()
+        async with Responder(ctx, budget=0.05) as r:
+            await r.run(time.sleep, 0.1) # blocking, like a redmine call
+            await r.send("done")
+        ctx.defer.assert_awaited_once()
+        ctx.respond.assert_called_once_with("done")
+
+    async def test_slow_defer_fails(self):
+        ctx = self.build_context()
+        ctx.defer.side_effect = discord.DiscordException("interaction expired")
+        with self.assertLogs(responder.log, logging.ERROR):
+            async with Responder(ctx, budget=0.05) as r:
+                await r.run(time.sleep, 0.1)
+
+    async def test_expected(self):
+        ctx = self.build_context()
+        async with Responder(ctx) as r:
+            await r.expect(100)
+            ctx.defer.assert_awaited_once()
+            await r.send("done")
+
+    async def test_updates(self):
+        ctx = self.build_context()
+        async with Responder(ctx) as r:
+            await r.update("partial")
+            await r.update("partial, throttled")
+            await r.send("line\n" * 600)
+        ctx.respond.assert_called_once_with("partial")
+        self.assertEqual(1, ctx.edit.call_count) # the final result replaces the partial one
+        self.assertEqual(1, ctx.followup.send.call_count) # and the rest follows
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import os
+import unittest
+import logging
+import tempfile
+
+import spam
+import store
+
+
+log = logging.getLogger(__name__)
+
+
+SPAM_TEXTS = [
+    "Cheap viagra pills, limited offer, click now to claim your prize",
+    "You have won a lottery prize! Claim your free money now, limited offer",
+    "Exclusive offer: cheap pills shipped free, click the link to claim",
+]
+HAM_TEXTS = [
+    "The router on the roof of the south building is offline again",
+    "Please add me to the install team, I can help with the roof install on Saturday",
+    "Network is slow in the south building since the router was replaced",
+]
+
+
+class TestSpamFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.stats = store.SpamStats(os.path.join(self.tmpdir.name, "test.db"))
+        self.filter = spam.SpamFilter(self.stats)
+        self.headers = {"message-id": "<1234@example.com>", "date": "Mon, 19 Oct 2026 10:00:00 -0700"}
+
+    def tearDown(self):
+        self.stats.close()
+        self.tmpdir.cleanup()
+
+    def train(self):
+        ticket_id = 1
+        for text in SPAM_TEXTS:
+            self.filter.train(ticket_id, "spammer@example.com", text, is_spam=True)
+            ticket_id += 1
+        for text in HAM_TEXTS:
+            self.filter.train(ticket_id, "member@example.com", text, is_spam=False)
+            ticket_id += 1
+
+    def test_untrained(self):
+        probability, reasons = self.filter.score(self.headers, "someone@example.com", "hello there")
+        self.assertEqual(0.5, probability)
+        self.assertEqual([], reasons)
+
+    def test_headers(self):
+        headers = {"x-spam-flag": "YES", "authentication-results": "mx.example.com; spf=fail dmarc=fail"}
+        probability, reasons = self.filter.score(headers, "someone@example.com", "hello there")
+        self.assertGreaterEqual(probability, spam.SPAM_THRESHOLD)
+        self.assertIn("x-spam-flag", reasons)
+        self.assertIn("no message-id", reasons)
+
+    def test_trained(self):
+        self.train()
+        self.assertEqual((3, 3), self.stats.totals())
+        self.assertTrue(self.stats.is_trained(1))
+
+        spam_p, _ = self.filter.score(self.headers, "spammer@example.com", "Claim your free prize now, cheap pills")
+        ham_p, _ = self.filter.score(self.headers, "member@example.com", "The south building router is offline")
+        self.assertGreaterEqual(spam_p, spam.SPAM_THRESHOLD)
+        self.assertLess(ham_p, 0.5)
+
+    def test_known_sender(self):
+        headers = dict(self.headers, **{"x-spam-flag": "YES"})
+        probability, reasons = self.filter.score(headers, "member@example.com", "hello there", known_sender=True)
+        self.assertLess(probability, spam.SPAM_THRESHOLD)
+        self.assertIn("known sender", reasons)
+
+    def test_known_spammer(self):
+        # an account for an address that has sent spam gets no credit
+        self.train()
+        probability, reasons = self.filter.score(self.headers, "spammer@example.com",
+            "Claim your free prize now, cheap pills", known_sender=True)
+        self.assertGreaterEqual(probability, spam.SPAM_THRESHOLD)
+        self.assertNotIn("known sender", reasons)
+
+    def test_quarantine(self):
+        self.stats.quarantine("key-1", "101", b"message data", 0.99, "x-spam-flag")
+        self.assertEqual(1, len(self.stats.quarantined()))
+
+        self.assertEqual(("101", b"message data"), self.stats.release("key-1"))
+        self.assertIsNone(self.stats.release("key-1"))
+        self.assertEqual(0, len(self.stats.quarantined()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import os
+import unittest
+import logging
+import tempfile
+
+import store
+
+
+log = logging.getLogger(__name__)
+
+
+class StoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "test.db")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+class TestIngestLog(StoreTestCase):
+
+    def test_lease(self):
+        first = store.IngestLog(self.db_path)
+        second = store.IngestLog(self.db_path)
+
+        self.assertTrue(first.acquire_lease("imap", "first", 60))
+        self.assertFalse(second.acquire_lease("imap", "second", 60))
+        self.assertTrue(first.acquire_lease("imap", "first", 60)) # renew
+
+        first.release_lease("imap", "first")
+        self.assertTrue(second.acquire_lease("imap", "second", 60))
+
+    def test_expired_lease(self):
+        first = store.IngestLog(self.db_path)
+        second = store.IngestLog(self.db_path)
+
+        self.assertTrue(first.acquire_lease("imap", "first", -1))
+        self.assertTrue(second.acquire_lease("imap", "second", 60))
+
+    def test_claim(self):
+        first = store.IngestLog(self.db_path)
+        second = store.IngestLog(self.db_path)
+        key = "<message-id@example.com>"
+
+        self.assertTrue(first.claim(key, "first", 60))
+        self.assertFalse(second.claim(key, "second", 60)) # in progress
+        first.complete(key)
+        self.assertTrue(second.is_ingested(key))
+        self.assertFalse(second.claim(key, "second", 60)) # done
+
+    def test_release(self):
+        first = store.IngestLog(self.db_path)
+        second = store.IngestLog(self.db_path)
+        key = "<message-id@example.com>"
+
+        self.assertTrue(first.claim(key, "first", 60))
+        first.release(key) # failed
+        self.assertTrue(second.claim(key, "second", 60))
+
+
+class TestDeadLetters(StoreTestCase):
+
+    def test_retry_schedule(self):
+        dead_letters = store.DeadLetters(self.db_path)
+        dead_letters.add("key-1", "101", b"message data", "RedmineException('timeout')")
+
+        self.assertEqual(0, len(dead_letters.due())) # not due yet
+        due = dead_letters.due(force=True)
+        self.assertEqual(1, len(due))
+        self.assertEqual(("key-1", "101", b"message data", 1), tuple(due[0]))
+
+        # failing again backs off further
+        dead_letters.add("key-1", "101", b"message data", "RedmineException('timeout')")
+        failures = dead_letters.failures()
+        self.assertEqual(2, failures[0][3])
+        self.assertGreater(failures[0][6] - failures[0][5], dead_letters.RETRY_DELAY)
+
+    def test_resolve(self):
+        dead_letters = store.DeadLetters(self.db_path)
+        dead_letters.add("key-1", "101", b"message data", "error")
+        dead_letters.resolve("key-1")
+
+        self.assertEqual(0, len(dead_letters.due(force=True)))
+        self.assertEqual(0, len(dead_letters.failures()))
+
+
+class TestMirroredAttachments(StoreTestCase):
+
+    def test_mirrored(self):
+        mirrored = store.MirroredAttachments(self.db_path)
+        mirrored.add(11, 218)
+        mirrored.add(12, 218)
+        mirrored.add(13, 219)
+
+        self.assertEqual({11, 12}, mirrored.mirrored(218))
+        # persisted for the next sync
+        self.assertEqual({13}, store.MirroredAttachments(self.db_path).mirrored(219))
+        self.assertEqual(set(), mirrored.mirrored(220))
+
+
+class TestEventBus(StoreTestCase):
+
+    def test_publish(self):
+        publisher = store.EventBus(self.db_path)
+        bus = store.EventBus(self.db_path)
+        publisher.publish(bus.TICKET_UPDATED, 100) # before the subscriber, not seen
+        bus.subscribe("netbot")
+
+        publisher.publish(bus.TICKET_UPDATED, 101)
+        publisher.publish(bus.TICKET_UPDATED, 102)
+        events = bus.poll("netbot")
+        self.assertEqual([101, 102], [ticket_id for _, _, ticket_id in events])
+
+        # unacknowledged events are polled again
+        self.assertEqual(2, len(bus.poll("netbot")))
+        bus.ack("netbot", events[-1][0])
+        self.assertEqual(0, len(bus.poll("netbot")))
+
+        # subscribing again doesn't move the position
+        publisher.publish(bus.TICKET_UPDATED, 103)
+        bus.subscribe("netbot")
+        self.assertEqual(1, len(bus.poll("netbot")))
+
+
+class TestThreadRoutes(StoreTestCase):
+
+    def test_routes(self):
+        routes = store.ThreadRoutes(self.db_path)
+        routes.add(1180000000000000001, 218)
+        routes.add(1180000000000000002, 219)
+        routes.add(1180000000000000002, 220) # re-routed
+        routes.remove(1180000000000000001)
+
+        self.assertEqual({1180000000000000002: 220}, store.ThreadRoutes(self.db_path).load())
+
+
+class TestSyncState(StoreTestCase):
+
+    def test_sync_state(self):
+        sync_state = store.SyncState(self.db_path)
+        self.assertEqual((None, None), sync_state.get(1180000000000000001))
+
+        sync_state.save({
+            1180000000000000001: (218, 1180000000000000100, 2001),
+            1180000000000000002: (219, None, 2002),
+        })
+        sync_state.save({1180000000000000001: (218, 1180000000000000200, 2003)})
+
+        sync_state = store.SyncState(self.db_path)
+        self.assertEqual((1180000000000000200, 2003), sync_state.get(1180000000000000001))
+        self.assertEqual((None, 2002), sync_state.get(1180000000000000002))
+
+    def test_relayed(self):
+        sync_state = store.SyncState(self.db_path)
+        sync_state.add_relayed(1, store.SyncState.MESSAGE, 1180000000000000100)
+        sync_state.add_relayed(1, store.SyncState.MESSAGE, 1180000000000000300)
+        sync_state.add_relayed(1, store.SyncState.JOURNAL, 2005)
+        self.assertEqual({2005}, sync_state.relayed(1, store.SyncState.JOURNAL))
+        self.assertEqual(set(), sync_state.relayed(2, store.SyncState.JOURNAL))
+
+        # dropped once the cursors pass them
+        sync_state.save({1: (218, 1180000000000000200, 2005)})
+        self.assertEqual({1180000000000000300}, sync_state.relayed(1, store.SyncState.MESSAGE))
+        self.assertEqual(set(), sync_state.relayed(1, store.SyncState.JOURNAL))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+import logging
+import threading
+from unittest import mock
+
+import threader
+
+
+log = logging.getLogger(__name__)
+
+
+class SlowService():
+    def __init__(self, duration:float):
+        self.duration = duration
+        self.runs = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def synchronize(self):
+        with self.lock:
+            self.runs += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.duration)
+        with self.lock:
+            self.active -= 1
+
+
+class FailingService():
+    def __init__(self):
+        self.runs = 0
+
+    def synchronize(self):
+        self.runs += 1
+        raise Exception("synchronize failed")
+
+
+class TestScheduler(unittest.TestCase):
+
+    def run_for(self, scheduler, seconds:float):
+        timer = threading.Timer(seconds, scheduler.stop)
+        timer.start()
+        scheduler.run()
+        timer.cancel()
+
+    def test_run_once_concurrent(self):
+        first, second = SlowService(0.2), SlowService(0.2)
+        scheduler = threader.Scheduler()
+        scheduler.add("first", first)
+        scheduler.add("second", second)
+
+        start = time.monotonic()
+        scheduler.run_once()
+        scheduler.shutdown()
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(1, first.runs)
+        self.assertEqual(1, second.runs)
+        self.assertLess(elapsed, 0.35) # side by side, not one after the other
+
+    def test_no_overlap(self):
+        # runs take longer than the interval: back to back, never overlapping
+        service = SlowService(0.1)
+        scheduler = threader.Scheduler()
+        scheduler.add("slow", service, interval=0.01, jitter=0)
+        self.run_for(scheduler, 0.35)
+
+        self.assertGreaterEqual(service.runs, 2)
+        self.assertEqual(1, service.max_active)
+
+    def test_intervals(self):
+        fast, slow = SlowService(0), SlowService(0)
+        scheduler = threader.Scheduler()
+        scheduler.add("fast", fast, interval=0.05)
+        scheduler.add("slow", slow, interval=10)
+        self.run_for(scheduler, 0.3)
+
+        self.assertGreaterEqual(fast.runs, 4)
+        self.assertEqual(1, slow.runs)
+
+    def test_failure(self):
+        service = FailingService()
+        scheduler = threader.Scheduler()
+        scheduler.add("failing", service, interval=0.05, jitter=0)
+        self.run_for(scheduler, 0.2)
+
+        self.assertGreaterEqual(service.runs, 2) # keeps being scheduled
+
+    def test_reindex(self):
+        redmine_client, imap_client = mock.Mock(), mock.Mock()
+        scheduler = threader.Scheduler()
+        service = scheduler.add("reindex", threader.Reindexer(redmine_client, imap_client), interval=10)
+        service.schedule(time.monotonic())
+        self.run_for(scheduler, 0.1)
+
+        # not at startup, the indexes are fresh
+        redmine_client.reindex.assert_not_called()
+
+        scheduler = threader.Scheduler()
+        scheduler.add("reindex", threader.Reindexer(redmine_client, imap_client), interval=0.05, jitter=0)
+        self.run_for(scheduler, 0.2)
+
+        self.assertGreaterEqual(redmine_client.reindex.call_count, 2)
+        self.assertEqual(redmine_client.reindex.call_count, imap_client.reset_duplicates.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -39,6 +39,9 @@ class BotTestCase(unittest.IsolatedAsyncioTestCase):
     
     def build_context(self) -> ApplicationContext:
         ctx = mock.AsyncMock(ApplicationContext)
+        # defer and edit are properties of ApplicationContext, so aren't mocked as coroutines
+        ctx.defer = mock.AsyncMock()
+        ctx.edit = mock.AsyncMock()
         ctx.user = mock.AsyncMock(discord.Member)
         ctx.user.name = self.discord_user
         log.debug(f"created ctx with {self.discord_user}: {ctx}")
@@ -1,37 +1,177 @@
 #!/usr/bin/env python3
 
+import os
+import time
+import random
+import signal
 import logging
+import threading
 from pathlib import Path
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+
+import click
 from dotenv import load_dotenv
 
 import imap
-
-# configure logging
-logpath = Path("logs")
-logpath.mkdir(parents=True, exist_ok=True)
-logfile = logpath.joinpath("threader-" + dt.datetime.now().strftime('%Y%m%d-%H%M') + ".log")
-logging.basicConfig(filename=logfile, filemode='a',
-    format="{asctime} {levelname:<8s} {name:<16} {message}", style='{',
-    level=logging.INFO) # TODO Add cmdline switch for log level.
+import redmine
+import changes
+import store
 
 log = logging.getLogger(__name__)
 
+DEFAULT_INTERVAL = 300 # seconds between runs of a service
+CHANGES_INTERVAL = 60 # seconds between polls for ticket changes
+REINDEX_INTERVAL = 3600 # seconds between refreshes of the shared user, team and duplicate indexes
+JITTER = 0.1 # fraction of the interval, so services don't run in lockstep
+WORKERS = 4 # services that can run at the same time
+
+
+def setup_logging():
+    logpath = Path("logs")
+    logpath.mkdir(parents=True, exist_ok=True)
+    logfile = logpath.joinpath("threader-" + dt.datetime.now().strftime('%Y%m%d-%H%M') + ".log")
+    logging.basicConfig(filename=logfile, filemode='a',
+        format="{asctime} {levelname:<8s} {name:<16} {message}", style='{',
+        level=logging.INFO) # TODO Add cmdline switch for log level.
+
+
+class Service():
+    """A synchronizer, and when it should next run"""
+    def __init__(self, name:str, synchronizer, interval:float=DEFAULT_INTERVAL, jitter:float=JITTER):
+        self.name = name
+        self.synchronizer = synchronizer
+        self.interval = interval
+        self.jitter = jitter
+        self.next_run = time.monotonic() # run right away
+        self.future = None
+
+    def is_running(self) -> bool:
+        return self.future is not None and not self.future.done()
+
+    def schedule(self, started:float):
+        # intervals are from the start of the last run. a run that overruns its
+        # interval is followed straight away by the next, never overlapped.
+        spread = self.interval * self.jitter
+        self.next_run = started + self.interval + random.uniform(-spread, spread)
+
+    def run(self):
+        log.info(f"synchronizing {self.name}")
+        start = time.monotonic()
+        try:
+            self.synchronizer.synchronize()
+        except Exception:
+            log.exception(f"synchronizing {self.name} failed")
+        log.info(f"synchronized {self.name} in {time.monotonic() - start:.2f} sec")
+
+
+class Reindexer():
+    """Refreshes the indexes the long-running services share, so new users
+    and teams are found and the duplicate window moves on"""
+    def __init__(self, redmine_client, imap_client):
+        self.redmine = redmine_client
+        self.imap = imap_client
+
+    def synchronize(self):
+        self.redmine.reindex()
+        self.imap.reset_duplicates()
 
-def main():
+
+class Scheduler():
+    """Runs services on a thread pool, each at its own interval. A service is
+    never started again while its last run is still going."""
+    def __init__(self, workers:int=WORKERS):
+        self.services = []
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="threader")
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+
+    def add(self, name:str, synchronizer, interval:float=DEFAULT_INTERVAL, jitter:float=JITTER) -> Service:
+        service = Service(name, synchronizer, interval, jitter)
+        self.services.append(service)
+        return service
+
+    def submit(self, service:Service):
+        service.schedule(time.monotonic())
+        service.future = self.executor.submit(service.run)
+        # re-check the schedule when it's done, in case it overran
+        service.future.add_done_callback(lambda _: self.wakeup.set())
+
+    def run_once(self):
+        """run every service once, concurrently, and wait for them all"""
+        for service in self.services:
+            self.submit(service)
+        for service in self.services:
+            service.future.result()
+
+    def run(self):
+        """run the services until stopped"""
+        log.info(f"starting scheduler: {', '.join(service.name for service in self.services)}")
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            now = time.monotonic()
+            next_run = None
+            for service in self.services:
+                if service.is_running():
+                    continue
+                if service.next_run <= now:
+                    self.submit(service)
+                if next_run is None or service.next_run < next_run:
+                    next_run = service.next_run
+
+            timeout = max(0.0, next_run - now) if next_run is not None else None
+            self.wakeup.wait(timeout)
+        self.shutdown()
+
+    def stop(self, *args):
+        # safe to call from a signal handler
+        self.stopping.set()
+        self.wakeup.set()
+
+    def shutdown(self):
+        log.info("stopping scheduler, waiting for running services")
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        for service in self.services:
+            close = getattr(service.synchronizer, "close", None)
+            if close:
+                close()
+
+
+@click.command()
+@click.option("--once", is_flag=True, help="Run each service once and exit, as a cron job")
+def main(once:bool):
+    """Run the threader services"""
+    setup_logging()
     log.info(f"starting threader")
-    # load credentials 
+    # load credentials
     load_dotenv()
 
-    # load some threading services
-    services = {
-        "imap": imap.Client(),
-    }
+    # one redmine client, with its warm user and team indexes, shared by all the services
+    redmine_client = redmine.Client()
+
+    scheduler = Scheduler()
+    imap_client = imap.Client(redmine_client)
+    scheduler.add("imap", imap_client, int(os.getenv('IMAP_INTERVAL', DEFAULT_INTERVAL)))
+    # changes made in redmine, not by email, are passed to the bot too
+    events = store.EventBus()
+    feed = changes.ChangeFeed(redmine_client)
+    feed.subscribe(lambda event: events.publish(store.EventBus.TICKET_UPDATED, event.ticket.id))
+    scheduler.add("changes", feed, int(os.getenv('CHANGES_INTERVAL', CHANGES_INTERVAL)))
 
-    for name, service in services.items():
-        log.info(f"synchronizing {name}")
-        service.synchronize()
+    if once:
+        scheduler.run_once()
+        scheduler.shutdown()
+    else:
+        # the indexes are fresh at startup, so the first refresh is after an interval
+        reindexer = scheduler.add("reindex", Reindexer(redmine_client, imap_client),
+            int(os.getenv('REINDEX_INTERVAL', REINDEX_INTERVAL)))
+        reindexer.schedule(time.monotonic())
+        # keep the imap sessions open between runs
+        imap_client.pool.start_keepalive()
+        signal.signal(signal.SIGTERM, scheduler.stop)
+        signal.signal(signal.SIGINT, scheduler.stop)
+        scheduler.run()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -25,4 +25,4 @@ if [ ! -x "$PYTHON" ]; then
     $PYTHON -m pip install -r requirements.txt
 fi
 
-$PYTHON "$project_dir/threader.py"
+$PYTHON "$project_dir/threader.py" --once